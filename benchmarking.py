@@ -0,0 +1,10 @@
+"""
+Helpers shared by the benchmarks.py of scalars, sev and population.
+"""
+import timeit
+
+
+def best_time(func, *args, **kwargs):
+    ''' Return the best wall time in seconds of three calls to func. '''
+    timer = timeit.Timer(lambda: func(*args, **kwargs))
+    return min(timer.repeat(repeat=3, number=1))
@@ -0,0 +1,220 @@
+"""
+Benchmarks of the population forecasting code on synthetic inputs.
+
+Example:
+    python benchmarks.py repeat_weeks --draws 100 1000
+"""
+import argparse
+import logging
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import population
+
+# benchmarking.py is shared with the benchmarks of the other projects.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarking import best_time  # noqa: E402
+
+
+__modname__ = "fbd_research.population.benchmarks"
+logger = logging.getLogger(__modname__)
+
+
+def synthetic_weeks(num_draws, seed=0):
+    ''' Return the 52 week ages of one location, sex and year with draws of
+        week 0 population and probability of dying, like the input of
+        repeat_weeks, and draws of weekly new borns.
+    '''
+    rng = np.random.RandomState(seed)
+    x = pd.DataFrame({'location_id': 6, 'sex_id': 1, 'year_id': 2016,
+                      'age_group_id': [2] + [3] * 3 + [4] * 48,
+                      'age': ['enn'] + ['lnn'] * 3 + ['pnn'] * 48})
+    pop = pd.DataFrame(rng.uniform(1e3, 1e4, (52, num_draws)),
+                       columns=['wk0_{}'.format(i) for i in range(num_draws)])
+    nqx = pd.DataFrame(rng.uniform(0, 1e-2, (52, num_draws)),
+                       columns=['draw{}'.format(i) for i in range(num_draws)])
+    new_borns = rng.uniform(1e3, 2e3, num_draws)
+    return pd.concat([x, pop, nqx], axis=1), new_borns
+
+
+def repeat_weeks_loop(x, new_borns):
+    '''repeat_weeks one draw and week at a time.'''
+    c_x = x.copy()
+
+    for _ in np.arange(1, 52+1):
+        for i in np.arange(population.DRAW):
+            # The population of each age(week) of the new week(t) depends on the 
+            # population and probability of survival of last week(t-1).
+            c_x['wk1_{i}'.format(i=i)] = c_x['wk0_{i}'.format(i=i)].shift(1) * \
+                                        (1 - c_x['draw{i}'.format(i=i)].shift(1))
+            # The population of starting age(week) of the new week(t) depends 
+            # on the number of weekly new borns and their probability of survival.
+            c_x.loc[0, 'wk1_{i}'.format(i=i)] = \
+                (1 - c_x.loc[0, 'draw{i}'.format(i=i)]) * new_borns[i-1]
+            # The population of each age(week) in the new week(t) becomes that of 
+            # the past week(t-1) for calculation of new cycle.
+            c_x['wk0_{i}'.format(i=i)] = c_x['wk1_{i}'.format(i=i)]
+    return c_x
+
+
+def average_pop_loop(df):
+    '''average_pop one draw column at a time.'''
+    for i in range(population.DRAW):
+        df['wk0_{i}'.format(i=i)] = df['pop_{i}'.format(i=i)] / len(df)
+    return df
+
+
+def aggregate_weeks_pop_loop(x, week_str):
+    '''aggregate_weeks_pop one draw column at a time.'''
+    pop_draws = [\
+        x.groupby(['location_id', 'sex_id', 'year_id', \
+            'age_group_id', 'age'])['{week_str}_{i}'.format(week_str=week_str, i=i)].sum() \
+                                        for i in np.arange(population.DRAW)]
+    pop = pd.concat(pop_draws, axis=1) \
+            .reset_index() \
+            .rename(columns={'{week_str}_{i}'.format(week_str=week_str, i=i): \
+                        'pop_{i}'.format(i=i) for i in np.arange(population.DRAW)})
+    return pop
+
+
+def benchmark_repeat_weeks(num_draws=100):
+    ''' Compare pushing the envelop one draw and week at a time and all
+        draws at once.
+    '''
+    draws = population.DRAW
+    population.DRAW = num_draws
+    try:
+        x, new_borns = synthetic_weeks(num_draws)
+        pd.testing.assert_frame_equal(
+            population.repeat_weeks(x, new_borns),
+            repeat_weeks_loop(x, new_borns), check_exact=True)
+        return {'loop': best_time(repeat_weeks_loop, x, new_borns),
+                'numpy': best_time(population.repeat_weeks, x, new_borns)}
+    finally:
+        population.DRAW = draws
+
+
+def _draws(rng, prefix, low, high, num_rows, num_draws):
+    return pd.DataFrame(rng.uniform(low, high, (num_rows, num_draws)),
+                        columns=['{}{}'.format(prefix, i)
+                                 for i in range(num_draws)])
+
+
+def synthetic_under_one(num_locations, num_draws, seed=0):
+    ''' Return population, weekly nqx and new borns of age under one of
+        num_locations locations and both sexes, like the inputs of
+        forecast_under_one_batch.
+    '''
+    rng = np.random.RandomState(seed)
+    index = pd.DataFrame(
+        [(location_id, age_group_id, sex_id, 2016, age)
+         for location_id in range(1, num_locations + 1) for sex_id in (1, 2)
+         for age_group_id, age in zip((2, 3, 4), population.UNDER_ONE_AGES)],
+        columns=['location_id', 'age_group_id', 'sex_id', 'year_id', 'age'])
+    pop = pd.concat([index, _draws(rng, 'pop_', 1e3, 1e5, len(index),
+                                   num_draws)], axis=1)
+    nqx = pd.concat([index, _draws(rng, 'draw', 0, 1e-2, len(index),
+                                   num_draws)], axis=1)
+    newborns = pd.concat(
+        [pd.DataFrame({'location_id': range(1, num_locations + 1),
+                       'year_id': 2017}),
+         _draws(rng, 'live_births_males_weekly_', 100, 200, num_locations,
+                num_draws),
+         _draws(rng, 'live_births_females_weekly_', 100, 200, num_locations,
+                num_draws)], axis=1)
+    return pop, nqx, newborns
+
+
+def forecast_under_one_by_location(pop, nqx, newborns):
+    ''' Return forecast_under_one of each location and sex, concatenated
+        and sorted like forecast_under_one_batch.
+    '''
+    pops = [population.forecast_under_one(
+                pop.loc[pop.location_id == location_id],
+                nqx.loc[nqx.location_id == location_id],
+                newborns.loc[newborns.location_id == location_id], sex_id)
+            for location_id in pop.location_id.unique() for sex_id in (1, 2)]
+    return pd.concat(pops, ignore_index=True).sort_values(
+        ['location_id', 'sex_id', 'year_id', 'age_group_id']).\
+        reset_index(drop=True)
+
+
+def benchmark_under_one(num_draws=100, num_locations=20, workers=1):
+    ''' Compare forecast_under_one by location and sex and
+        forecast_under_one_batch.
+    '''
+    draws = population.DRAW
+    population.DRAW = num_draws
+    try:
+        inputs = synthetic_under_one(num_locations, num_draws)
+        pd.testing.assert_frame_equal(
+            population.forecast_under_one_batch(*inputs, workers=workers),
+            forecast_under_one_by_location(*inputs), check_exact=False,
+            rtol=1e-12)
+        return {'by_location': best_time(forecast_under_one_by_location,
+                                         *inputs),
+                'batch': best_time(population.forecast_under_one_batch,
+                                   *inputs, workers=workers)}
+    finally:
+        population.DRAW = draws
+
+
+def benchmark_average_pop(num_draws=100):
+    ''' Compare average_pop one draw column at a time and at once. '''
+    draws = population.DRAW
+    population.DRAW = num_draws
+    try:
+        rng = np.random.RandomState(0)
+        df = pd.concat([pd.DataFrame({'age': ['pnn'] * 48}),
+                        _draws(rng, 'pop_', 1e3, 1e5, 48, num_draws)],
+                       axis=1)
+        pd.testing.assert_frame_equal(
+            population.average_pop(df),
+            average_pop_loop(df.copy()), check_exact=True)
+        return {'loop': best_time(lambda: average_pop_loop(df.copy())),
+                'block': best_time(population.average_pop, df)}
+    finally:
+        population.DRAW = draws
+
+
+def benchmark_aggregate_weeks_pop(num_draws=100):
+    ''' Compare aggregate_weeks_pop one draw column at a time and at
+        once.
+    '''
+    draws = population.DRAW
+    population.DRAW = num_draws
+    try:
+        x, _ = synthetic_weeks(num_draws)
+        x = population.repeat_weeks(x, np.ones(num_draws))
+        pd.testing.assert_frame_equal(
+            population.aggregate_weeks_pop(x, 'wk1'),
+            aggregate_weeks_pop_loop(x, 'wk1'), check_exact=True)
+        return {'loop': best_time(aggregate_weeks_pop_loop, x,
+                                  'wk1'),
+                'block': best_time(population.aggregate_weeks_pop, x, 'wk1')}
+    finally:
+        population.DRAW = draws
+
+
+BENCHMARKS = {'aggregate_weeks_pop': benchmark_aggregate_weeks_pop,
+              'average_pop': benchmark_average_pop,
+              'repeat_weeks': benchmark_repeat_weeks,
+              'under_one': benchmark_under_one}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark population code")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--draws", type=int, nargs="+", default=[100])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for num_draws in args.draws:
+        timings = BENCHMARKS[args.benchmark](num_draws=num_draws)
+        for path, seconds in sorted(timings.items()):
+            logger.info("{} at {} draws: {} {:.3f}s".format(
+                args.benchmark, num_draws, path, seconds))
@@ -1,11 +1,17 @@
 '''Code snippets related to population forecasting using cohort component model.
 '''
+import multiprocessing
+
 import pandas as pd
 import numpy as np
 
 
 DRAW = 1000
 
+# Age groups under one and their number of week ages.
+UNDER_ONE_AGES = ['enn', 'lnn', 'pnn']
+UNDER_ONE_WEEKS = [1, 3, 48]
+
 
 def merge_pop_nqx_under_one(pop, weekly_nqx, sex_id):
     ''' Merge age under one population with nqx(probability of dying).
@@ -38,13 +44,83 @@ def merge_pop_nqx_under_one(pop, weekly_nqx, sex_id):
     return x
 
 
+def _assign_draws(df, cols, values):
+    '''Return df with the draw columns cols set to the 2-D array values,
+       all in one block instead of column by column. Existing columns keep
+       their place and new ones are appended in order.
+    '''
+    draws = pd.DataFrame(values, index=df.index, columns=cols)
+    existing_cols = [col for col in cols if col in df.columns]
+    if existing_cols:
+        df = df.copy()
+        df[existing_cols] = draws[existing_cols]
+        draws = draws.drop(existing_cols, axis=1)
+    return pd.concat([df, draws], axis=1)
+
+
 def average_pop(df):
     '''Get the population at week0; assume weekly population within the same
        age group are the same and the number of weekly new borns are the same.
     '''
-    for i in range(DRAW):
-        df['wk0_{i}'.format(i=i)] = df['pop_{i}'.format(i=i)] / len(df)
-    return df
+    pop_cols = ['pop_{i}'.format(i=i) for i in range(DRAW)]
+    wk0_cols = ['wk0_{i}'.format(i=i) for i in range(DRAW)]
+    return _assign_draws(df, wk0_cols, df[pop_cols].values / len(df))
+
+
+def push_weeks(pop, nqx, new_borns, weeks=52, first=0, lag_draws=True,
+               aged_out=False):
+    '''Push the envelop of every draw forward for weeks weeks at once.
+
+       Each week, the population of each age(week) becomes that of the
+       previous age in the past week times its probability of survival,
+       and the population of the starting age that of the weekly new borns
+       times theirs. The first age has no previous age and is NaN unless it
+       is the starting age.
+
+       Parameters
+       ----------
+       pop: array
+        Population of each week age (rows) and draw (columns), optionally
+        stacked along leading axes, e.g. locations and sexes.
+       nqx: array
+        Probability of dying of each week age and draw, shaped like pop.
+       new_borns: array
+        Draws of new borns, along the last axis, stacked like pop.
+       weeks: int
+        Number of weeks to push the envelop forward.
+       first: int
+        Position of the starting age(week).
+       lag_draws: bool
+        Like repeat_weeks, draw i gets new_borns[i-1]. If False, each draw
+        gets its own new borns.
+       aged_out: bool
+        Whether to also return the survivors of the last age, who leave
+        the envelop, summed over the weeks.
+
+       Returns
+       -------
+       pop: array
+        Population of each week age and draw after weeks weeks.
+       out: array
+        Only if aged_out, survivors of the last age by draw, stacked like
+        pop.
+    '''
+    survival = 1 - nqx
+    if lag_draws:
+        new_borns = np.roll(new_borns, 1, axis=-1)[..., :pop.shape[-1]]
+    births = survival[..., first, :] * new_borns
+    out = np.zeros_like(births)
+    for _ in range(weeks):
+        next_pop = np.empty_like(survival)
+        next_pop[..., 0, :] = np.nan
+        next_pop[..., 1:, :] = pop[..., :-1, :] * survival[..., :-1, :]
+        next_pop[..., first, :] = births
+        if aged_out:
+            out += pop[..., -1, :] * survival[..., -1, :]
+        pop = next_pop
+    if aged_out:
+        return pop, out
+    return pop
 
 
 def repeat_weeks(x, new_borns):
@@ -64,22 +140,16 @@ def repeat_weeks(x, new_borns):
         Population of each week after pushing the envelop forward for 52 weeks.
 
     '''
-    c_x = x.copy()
-
-    for _ in np.arange(1, 52+1):
-        for i in np.arange(DRAW):
-            # The population of each age(week) of the new week(t) depends on the 
-            # population and probability of survival of last week(t-1).
-            c_x['wk1_{i}'.format(i=i)] = c_x['wk0_{i}'.format(i=i)].shift(1) * \
-                                        (1 - c_x['draw{i}'.format(i=i)].shift(1))
-            # The population of starting age(week) of the new week(t) depends 
-            # on the number of weekly new borns and their probability of survival.
-            c_x.loc[0, 'wk1_{i}'.format(i=i)] = \
-                (1 - c_x.loc[0, 'draw{i}'.format(i=i)]) * new_borns[i-1]
-            # The population of each age(week) in the new week(t) becomes that of 
-            # the past week(t-1) for calculation of new cycle.
-            c_x['wk0_{i}'.format(i=i)] = c_x['wk1_{i}'.format(i=i)]
-    return c_x
+    # The new borns go to the row(s) labelled 0, usually the first.
+    first = x.index.get_loc(0)
+    wk0_cols = ['wk0_{i}'.format(i=i) for i in np.arange(DRAW)]
+    wk1_cols = ['wk1_{i}'.format(i=i) for i in np.arange(DRAW)]
+    nqx_cols = ['draw{i}'.format(i=i) for i in np.arange(DRAW)]
+    pop = push_weeks(x[wk0_cols].values.astype(float), x[nqx_cols].values,
+                     new_borns, first=first)
+
+    c_x = _assign_draws(x, wk0_cols, pop)
+    return _assign_draws(c_x, wk1_cols, pop)
 
 
 def aggregate_weeks_pop(x, week_str):
@@ -93,11 +163,10 @@ def aggregate_weeks_pop(x, week_str):
        week_str: str
         'week_0' or 'week_1'
     '''
-    pop_draws = [\
-        x.groupby(['location_id', 'sex_id', 'year_id', \
-            'age_group_id', 'age'])['{week_str}_{i}'.format(week_str=week_str, i=i)].sum() \
-                                        for i in np.arange(DRAW)]
-    pop = pd.concat(pop_draws, axis=1) \
+    week_cols = ['{week_str}_{i}'.format(week_str=week_str, i=i)
+                 for i in np.arange(DRAW)]
+    pop = x.groupby(['location_id', 'sex_id', 'year_id', 'age_group_id',
+                     'age'])[week_cols].sum() \
             .reset_index() \
             .rename(columns={'{week_str}_{i}'.format(week_str=week_str, i=i): \
                         'pop_{i}'.format(i=i) for i in np.arange(DRAW)})
@@ -128,7 +197,8 @@ def forecast_under_one(pop_t, weekly_nqx, newborns_df, sex_id):
     '''
     pop_nqx = merge_pop_nqx_under_one(pop_t, weekly_nqx, sex_id)
     # Obtain population at week 0.
-    pop_nqx = pop_nqx.groupby(['age', 'year_id', 'location_id', 'sex_id', 'age_group_id']) \
+    pop_nqx = pop_nqx.groupby(['age', 'year_id', 'location_id', 'sex_id', 'age_group_id'],
+                              group_keys=False) \
                      .apply(average_pop)
     # Assign 1 - 52 for each week ages.
     pop_nqx['age_wks'] = np.arange(1, 52+1)
@@ -148,3 +218,175 @@ def forecast_under_one(pop_t, weekly_nqx, newborns_df, sex_id):
     pop_tplus1 = aggregate_weeks_pop(x, 'wk1')
 
     return pop_tplus1
+
+
+def push_under_one(pop, nqx, new_borns, lag_draws=True, aged_out=False):
+    '''Push the envelop of age under one forward for a year, like
+       forecast_under_one without the dataframes.
+
+       The population of each age group is spread evenly over its weeks
+       like in average_pop, pushed forward 52 weeks with push_weeks and
+       summed back into age groups in week order.
+
+       Parameters
+       ----------
+       pop: array
+        Population of enn, lnn and pnn (second to last axis) and draw (last
+        axis), optionally stacked along leading axes.
+       nqx: array
+        Weekly probability of dying of enn, lnn and pnn, shaped like pop.
+       new_borns: array
+        Draws of weekly new borns, see push_weeks.
+       lag_draws: bool
+        See push_weeks.
+       aged_out: bool
+        Whether to also return the population turning one over the year.
+
+       Returns
+       -------
+       pop: array
+        Population of enn, lnn and pnn a year later, shaped like pop.
+       turned_one: array
+        Only if aged_out, survivors of the last week of pnn over the year,
+        by draw, stacked like pop.
+    '''
+    weeks = np.repeat(np.arange(len(UNDER_ONE_AGES)), UNDER_ONE_WEEKS)
+    pop_weeks = pop[..., weeks, :] / np.array(UNDER_ONE_WEEKS)[weeks, None]
+    pushed = push_weeks(pop_weeks, nqx[..., weeks, :], new_borns,
+                        lag_draws=lag_draws, aged_out=aged_out)
+    pop_weeks = pushed[0] if aged_out else pushed
+    starts = np.cumsum([0] + UNDER_ONE_WEEKS[:-1])
+    pop_ages = np.add.reduceat(pop_weeks, starts, axis=-2)
+    if aged_out:
+        return pop_ages, pushed[1]
+    return pop_ages
+
+
+def _weekly_new_borns(newborns_df, index):
+    '''Return the draws of weekly new borns of each row of index, summing
+       the rows of newborns_df of its location like forecast_under_one.
+
+       Parameters
+       ----------
+       newborns_df: dataframe
+        Draws of new borns for male and female of every location.
+       index: dataframe
+        Contains location_id and sex_id.
+
+       Returns
+       -------
+       new_borns: 2-D array
+        Draws of new borns of each row of index.
+    '''
+    draws_live_births_males_weekly = \
+        ['live_births_males_weekly_{i}'.format(i=i) for i in np.arange(DRAW)]
+    draws_live_births_females_weekly = \
+        ['live_births_females_weekly_{i}'.format(i=i) for i in np.arange(DRAW)]
+    sums = {}
+    for location_id, df in newborns_df.groupby('location_id'):
+        sums[location_id, 1] = \
+            df[draws_live_births_males_weekly].values.sum(axis=0)
+        sums[location_id, 2] = \
+            df[draws_live_births_females_weekly].values.sum(axis=0)
+    return np.array([sums[location_id, 1 if sex_id == 1 else 2]
+                     for location_id, sex_id in
+                     zip(index.location_id, index.sex_id)])
+
+
+def _forecast_under_one_block(args):
+    '''Forecast population for age under one of all locations and sexes of
+       a block at once, see forecast_under_one_batch.
+
+       Parameters
+       ----------
+       args: tuple
+        (pop_t, weekly_nqx, newborns_df) of the locations of the block.
+
+       Returns
+       -------
+       pop_tplus1: dataframe
+        Population for age group under one in year t+1.
+    '''
+    pop_t, weekly_nqx, newborns_df = args
+    group_cols = ['location_id', 'sex_id', 'year_id']
+    draws_pop = ['pop_{i}'.format(i=i) for i in np.arange(DRAW)]
+    draws_nqx = ['draw{i}'.format(i=i) for i in np.arange(DRAW)]
+
+    under_one = pop_t.loc[pop_t.age.isin(UNDER_ONE_AGES)]
+    under_one = under_one.merge(weekly_nqx, on=['location_id', 'age_group_id',
+                                                'sex_id', 'year_id', 'age'])
+    under_one = under_one.assign(
+        age_order=under_one.age.map(
+            {age: i for i, age in enumerate(UNDER_ONE_AGES)}))
+    under_one = under_one.sort_values(group_cols + ['age_order'])
+    num_groups = len(under_one.drop_duplicates(group_cols))
+    if len(under_one) != len(UNDER_ONE_AGES) * num_groups:
+        raise ValueError("Every location, sex and year needs population and "
+                         "nqx of each of {}.".format(UNDER_ONE_AGES))
+    shape = (num_groups, len(UNDER_ONE_AGES), DRAW)
+    pop = under_one[draws_pop].values.reshape(shape)
+    nqx = under_one[draws_nqx].values.reshape(shape)
+    index = under_one.iloc[::len(UNDER_ONE_AGES)]
+
+    pop_ages = push_under_one(pop, nqx, _weekly_new_borns(newborns_df, index))
+
+    pop_tplus1 = under_one[group_cols + ['age_group_id', 'age']].\
+        reset_index(drop=True)
+    pop_tplus1 = pd.concat([pop_tplus1, pd.DataFrame(
+        pop_ages.reshape(-1, DRAW), columns=draws_pop)], axis=1)
+    return pop_tplus1[['location_id', 'sex_id', 'year_id', 'age_group_id',
+                       'age'] + draws_pop]
+
+
+def forecast_under_one_batch(pop_t, weekly_nqx, newborns_df, workers=1,
+                             block_size=50):
+    '''Forecast population for age under one of every location and sex at
+       once, like forecast_under_one for each of them.
+
+       Population, nqx and new borns are held as (location and sex, week
+       age, draw) arrays, and the envelop of all of them pushed forward
+       with push_weeks. Locations are split in blocks of block_size,
+       forecast by a pool of workers processes if workers isn't 1.
+       Population of the weeks of an age group is summed in week order,
+       so it may differ from aggregate_weeks_pop in the last digits.
+
+       Parameters
+       ----------
+       pop_t: dataframe
+        Population of age under one in year t of every location and sex.
+       weekly_nqx: dataframe
+        Probability of dying for age_group enn, lnn, pnn.
+       newborns_df: dataframe
+        Draws of new borns for male and female. Rows of a location are
+        summed.
+       workers: int
+        Number of processes, all CPUs if None.
+       block_size: int
+        Number of locations per block.
+
+       Returns
+       -------
+       pop_tplus1: dataframe
+        Population for age group under one in year t+1, sorted by
+        location_id, sex_id, year_id and age_group_id.
+    '''
+    location_ids = pop_t.location_id.unique()
+    tasks = []
+    for start in range(0, len(location_ids), block_size):
+        block = location_ids[start:start + block_size]
+        tasks.append((pop_t.loc[pop_t.location_id.isin(block)],
+                      weekly_nqx.loc[weekly_nqx.location_id.isin(block)],
+                      newborns_df.loc[newborns_df.location_id.isin(block)]))
+
+    if workers != 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            blocks = pool.map(_forecast_under_one_block, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        blocks = [_forecast_under_one_block(task) for task in tasks]
+    pop_tplus1 = pd.concat(blocks, ignore_index=True)
+    return pop_tplus1.sort_values(['location_id', 'sex_id', 'year_id',
+                                   'age_group_id']).reset_index(drop=True)
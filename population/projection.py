@@ -0,0 +1,228 @@
+'''Cohort component projection of population by location, sex, age group and
+draw over many years.
+
+Population of a year is one contiguous (location, sex, age group, draw)
+array. Each year is projected from the previous one with project_year and
+saved to its own .npy checkpoint, and the rates of a year are only loaded
+when it is projected. Only one or two years of population are in memory at
+once, and an interrupted projection resumes from its last checkpoint.
+'''
+import json
+import logging
+import os
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from population import UNDER_ONE_AGES, push_under_one
+
+from settings import AGE_GROUP_IDS, END_YEAR, SEX_IDS, START_YEAR
+
+
+__modname__ = "fbd_research.population.projection"
+logger = logging.getLogger(__modname__)
+
+# Width in years of the age groups from 1 to 4 years old to 75 to 79.
+AGE_GROUP_YEARS = np.array([4] + [5] * 15, dtype=float)
+# Age groups of mothers, 15 to 49.
+FERTILE_AGE_GROUP_IDS = list(range(8, 15))
+# Male births per female birth.
+SEX_RATIO_AT_BIRTH = 1.05
+
+CHECKPOINT_INFO = 'projection.json'
+
+
+def project_year(pop, qx, weekly_nqx, asfr, migration=None,
+                 sex_ratio=SEX_RATIO_AT_BIRTH):
+    '''Project population one year ahead.
+
+       - Births are the female population of each fertile age group times
+         its age specific fertility rate, split into sexes by sex_ratio.
+         Population under one is pushed forward week by week from them
+         with population.push_under_one.
+       - Population leaving the last week of pnn over the year turns one.
+         Birthdays are assumed spread evenly over the year and the hazard
+         of ages 1 to 4 constant within it, so having spent half the year
+         in ages 1 to 4 on average, it survives with sqrt(1 - qx) of that
+         age group rather than its annual 1 - qx.
+       - Population of each age group from one up survives the year, then
+         1 / width of the survivors of each but the last, open age group
+         move to the next age group.
+       - Net migrants are added last, and negative population set to 0.
+
+       Parameters
+       ----------
+       pop: 4-D array
+        Population by location, sex (SEX_IDS), age group (AGE_GROUP_IDS)
+        and draw.
+       qx: 4-D array
+        Annual probability of dying by location, sex, age group from 1 to
+        4 years old (AGE_GROUP_IDS[3:]) and draw.
+       weekly_nqx: 4-D array
+        Weekly probability of dying by location, sex, enn, lnn and pnn, and
+        draw.
+       asfr: 3-D array
+        Age specific fertility rate by location, FERTILE_AGE_GROUP_IDS and
+        draw.
+       migration: 4-D array, optional
+        Net migrants over the year, shaped like pop.
+       sex_ratio: float
+        Male births per female birth.
+
+       Returns
+       -------
+       pop_tplus1: 4-D array
+        Population a year later, shaped like pop.
+    '''
+    num_under_one = len(UNDER_ONE_AGES)
+    fertile = [AGE_GROUP_IDS.index(age_group_id)
+               for age_group_id in FERTILE_AGE_GROUP_IDS]
+
+    births = (pop[:, SEX_IDS.index(2), fertile] * asfr).sum(axis=1)
+    male_births = births * sex_ratio / (1 + sex_ratio)
+    weekly_births = np.stack([male_births, births - male_births],
+                             axis=1) / 52
+
+    pop_tplus1 = np.empty_like(pop)
+    pop_tplus1[:, :, :num_under_one], turned_one = push_under_one(
+        pop[:, :, :num_under_one], weekly_nqx, weekly_births,
+        lag_draws=False, aged_out=True)
+
+    survivors = pop[:, :, num_under_one:] * (1 - qx)
+    aging = survivors[:, :, :-1] / AGE_GROUP_YEARS[:, None]
+    older = pop_tplus1[:, :, num_under_one:]
+    older[...] = survivors
+    older[:, :, :-1] -= aging
+    older[:, :, 1:] += aging
+    # Half a year of survival in ages 1 to 4, see the docstring.
+    older[:, :, 0] += turned_one * np.sqrt(1 - qx[:, :, 0])
+
+    if migration is not None:
+        pop_tplus1 += migration
+        np.maximum(pop_tplus1, 0, out=pop_tplus1)
+    return pop_tplus1
+
+
+def checkpoint_path(checkpoint_dir, year):
+    return os.path.join(checkpoint_dir, 'pop_{}.npy'.format(year))
+
+
+def _save_checkpoint(checkpoint_dir, year, pop):
+    ''' Save pop of year, atomically so that a preempted save leaves no
+        checkpoint rather than a truncated one.
+    '''
+    path = checkpoint_path(checkpoint_dir, year)
+    tmp_path = '{}.{}.tmp.npy'.format(path, uuid.uuid4().hex)
+    np.save(tmp_path, np.ascontiguousarray(pop))
+    os.rename(tmp_path, path)
+
+
+def _check_info(checkpoint_dir, info):
+    ''' Record info of the projection in checkpoint_dir, or check that its
+        checkpoints are of the same projection.
+    '''
+    path = os.path.join(checkpoint_dir, CHECKPOINT_INFO)
+    if os.path.exists(path):
+        with open(path) as f:
+            recorded = json.load(f)
+        if recorded != json.loads(json.dumps(info)):
+            raise ValueError("{} holds checkpoints of another projection: "
+                             "{}".format(checkpoint_dir, recorded))
+    else:
+        with open(path, 'w') as f:
+            json.dump(info, f, indent=2, sort_keys=True)
+
+
+def latest_checkpoint(checkpoint_dir, start_year, end_year):
+    ''' Return the last year from start_year to end_year with a
+        checkpoint, None if there isn't any.
+    '''
+    for year in range(end_year, start_year - 1, -1):
+        if os.path.exists(checkpoint_path(checkpoint_dir, year)):
+            return year
+    return None
+
+
+def project(pop, get_rates, checkpoint_dir, rates_version,
+            start_year=START_YEAR, end_year=END_YEAR,
+            sex_ratio=SEX_RATIO_AT_BIRTH):
+    '''Project population from start_year to end_year, checkpointing every
+       year in checkpoint_dir and resuming from the last checkpoint there.
+
+       Parameters
+       ----------
+       pop: 4-D array
+        Population of start_year, see project_year.
+       get_rates: function
+        Called with a year, returns a dict of the qx, weekly_nqx, asfr and
+        optionally migration keyword arguments of project_year, used to
+        project that year to the next.
+       checkpoint_dir: str
+        Directory of the checkpoints pop_{year}.npy.
+       rates_version: str
+        Version of the rates of get_rates, recorded with the checkpoints so
+        that a projection with other rates never resumes from them.
+       start_year: int
+       end_year: int
+       sex_ratio: float
+        Male births per female birth.
+
+       Returns
+       -------
+       pop: 4-D array
+        Population of end_year, memory-mapped from its checkpoint.
+    '''
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    _check_info(checkpoint_dir, {'start_year': start_year,
+                                 'shape': list(pop.shape),
+                                 'age_group_ids': AGE_GROUP_IDS,
+                                 'sex_ratio': sex_ratio,
+                                 'rates_version': rates_version})
+
+    year = latest_checkpoint(checkpoint_dir, start_year, end_year)
+    if year is None:
+        year = start_year
+        _save_checkpoint(checkpoint_dir, year, pop)
+    else:
+        logger.info("Resuming from {}".format(year))
+        pop = np.load(checkpoint_path(checkpoint_dir, year), mmap_mode='r')
+
+    while year < end_year:
+        start = time.time()
+        pop = project_year(pop, sex_ratio=sex_ratio, **get_rates(year))
+        year += 1
+        _save_checkpoint(checkpoint_dir, year, pop)
+        logger.info("Projected {} in {:.1f}s".format(year,
+                                                    time.time() - start))
+    return np.load(checkpoint_path(checkpoint_dir, end_year), mmap_mode='r')
+
+
+def projection_to_dataframe(pop, location_ids, year_id):
+    '''Return pop as a dataframe of population draws like those of
+       population.py.
+
+       Parameters
+       ----------
+       pop: 4-D array
+        Population of a year, see project_year.
+       location_ids: list of int
+        Location of each row of pop.
+       year_id: int
+
+       Returns
+       -------
+       df: dataframe
+        Contains location_id, sex_id, age_group_id, year_id and pop_0 to
+        pop_{DRAW - 1}.
+    '''
+    index = pd.MultiIndex.from_product(
+        [location_ids, SEX_IDS, AGE_GROUP_IDS],
+        names=['location_id', 'sex_id', 'age_group_id']).to_frame(index=False)
+    index['year_id'] = year_id
+    draws = pd.DataFrame(np.asarray(pop).reshape(len(index), -1),
+                         columns=['pop_{i}'.format(i=i)
+                                  for i in np.arange(pop.shape[-1])])
+    return pd.concat([index, draws], axis=1)
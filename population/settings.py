@@ -0,0 +1,7 @@
+START_YEAR = 1990
+END_YEAR = 2040
+
+# GBD age groups: 2 to 4 are enn, lnn and pnn, 5 is ages 1 to 4, 6 to 20
+# are five-year age groups from 5 to 79 and 21 is 80 plus.
+AGE_GROUP_IDS = list(range(2, 22))
+SEX_IDS = [1, 2]
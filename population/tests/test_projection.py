@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+import projection
+from projection import (AGE_GROUP_IDS, FERTILE_AGE_GROUP_IDS, SEX_IDS,
+                        project, project_year)
+from population import UNDER_ONE_AGES
+
+
+NUM_LOCATIONS = 2
+NUM_DRAWS = 5
+
+
+def synthetic_pop(seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(1e3, 1e5, (NUM_LOCATIONS, len(SEX_IDS),
+                                  len(AGE_GROUP_IDS), NUM_DRAWS))
+
+
+def synthetic_rates(year, scale=1.):
+    ''' Return the rates of project_year of year, times scale. '''
+    rng = np.random.RandomState(year)
+    num_older = len(AGE_GROUP_IDS) - len(UNDER_ONE_AGES)
+    return {'qx': scale * rng.uniform(
+                0, 0.1, (NUM_LOCATIONS, len(SEX_IDS), num_older, NUM_DRAWS)),
+            'weekly_nqx': scale * rng.uniform(
+                0, 1e-3, (NUM_LOCATIONS, len(SEX_IDS), len(UNDER_ONE_AGES),
+                          NUM_DRAWS)),
+            'asfr': scale * rng.uniform(
+                0, 0.2, (NUM_LOCATIONS, len(FERTILE_AGE_GROUP_IDS),
+                         NUM_DRAWS))}
+
+
+def test_project_year_conserves_population_at_zero_rates():
+    pop = synthetic_pop()
+    pop_tplus1 = project_year(pop, **synthetic_rates(2000, scale=0.))
+    np.testing.assert_allclose(pop_tplus1.sum(axis=(1, 2)),
+                               pop.sum(axis=(1, 2)), rtol=1e-12)
+    # Without births, everyone under one turned one.
+    assert (pop_tplus1[:, :, :len(UNDER_ONE_AGES)] == 0).all()
+
+
+def test_project_year_keeps_births_of_each_draw():
+    pop = synthetic_pop()
+    rates = synthetic_rates(2000)
+    rates['weekly_nqx'][...] = 0
+    pop_tplus1 = project_year(pop, **rates)
+    fertile = [AGE_GROUP_IDS.index(age_group_id)
+               for age_group_id in FERTILE_AGE_GROUP_IDS]
+    births = (pop[:, SEX_IDS.index(2), fertile] * rates['asfr']).sum(axis=1)
+    np.testing.assert_allclose(
+        pop_tplus1[:, :, :len(UNDER_ONE_AGES)].sum(axis=(1, 2)), births,
+        rtol=1e-12)
+
+
+def test_resume_equals_uninterrupted(tmpdir):
+    pop = synthetic_pop()
+    expected = np.array(project(pop, synthetic_rates, str(tmpdir.join('a')),
+                                'v1', start_year=2000, end_year=2006))
+
+    checkpoint_dir = str(tmpdir.join('b'))
+    project(pop, synthetic_rates, checkpoint_dir, 'v1', start_year=2000,
+            end_year=2003)
+    resumed_from = []
+
+    def get_rates(year):
+        resumed_from.append(year)
+        return synthetic_rates(year)
+
+    result = project(pop, get_rates, checkpoint_dir, 'v1', start_year=2000,
+                     end_year=2006)
+    assert resumed_from == [2003, 2004, 2005]
+    np.testing.assert_array_equal(np.array(result), expected)
+
+
+def test_resume_with_other_rates_fails(tmpdir):
+    pop = synthetic_pop()
+    checkpoint_dir = str(tmpdir)
+    project(pop, synthetic_rates, checkpoint_dir, 'v1', start_year=2000,
+            end_year=2001)
+    with pytest.raises(ValueError):
+        project(pop, synthetic_rates, checkpoint_dir, 'v2', start_year=2000,
+                end_year=2002)
+    assert projection.latest_checkpoint(checkpoint_dir, 2000, 2002) == 2001
@@ -0,0 +1,298 @@
+"""
+Benchmarks of the scalars pipeline on synthetic inputs.
+
+Example:
+    python benchmarks.py aggregate_paf --draws 100 1000
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from calculate_pafs import merge_sev_rrmax
+from calculate_scalars import product_of_mediated_pafs
+
+import kernels
+from storage import BACKENDS, get_storage, storage_path, zarr
+from utils import xarray_to_dataframe
+
+from settings import (DEMOGRAPHY_COLS, DRAW_PREFIX, PAF_DRAW_PREFIX,
+                      RR_MAX_DRAW_PREFIX)
+
+# benchmarking.py is shared with the benchmarks of the other projects.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarking import best_time  # noqa: E402
+
+
+__modname__ = "fbd_research.scalars.benchmarks"
+logger = logging.getLogger(__modname__)
+
+
+def synthetic_demography(num_locations=20, num_years=51):
+    ''' Return a dataframe of a full, sorted demography grid.
+
+        Parameters
+        ----------
+        num_locations: int, number of locations.
+        num_years: int, number of years.
+
+        Returns
+        ----------
+        df: dataframe with DEMOGRAPHY_COLS.
+    '''
+    indices = [range(1, num_locations + 1), range(2, 22), [1, 2],
+               range(1990, 1990 + num_years), [-1, 0, 1]]
+    index = pd.MultiIndex.from_product(indices, names=DEMOGRAPHY_COLS)
+    return index.to_frame(index=False)
+
+
+def synthetic_draws(demography, draw_prefix, num_draws, low=0., high=1.,
+                    seed=0):
+    ''' Return demography with num_draws uniform draw columns appended. '''
+    rng = np.random.RandomState(seed)
+    draw_cols = [draw_prefix + '{}'.format(i) for i in range(num_draws)]
+    values = rng.uniform(low, high, size=(len(demography), num_draws))
+    draws = pd.DataFrame(values, columns=draw_cols, index=demography.index)
+    return pd.concat([demography, draws], axis=1)
+
+
+def product_of_mediated_pafs_merge(mediated_pafs, paf_cols):
+    ''' Merge-based equivalent of product_of_mediated_pafs. '''
+    paf_x_cols = [col + '_x' for col in paf_cols]
+    paf_y_cols = [col + '_y' for col in paf_cols]
+    paf_prod = None
+    for paf, mediation_prod in mediated_pafs:
+        paf = paf.copy()
+        paf[paf_cols] = 1 - paf[paf_cols] * mediation_prod
+        if paf_prod is None:
+            paf_prod = paf[DEMOGRAPHY_COLS + paf_cols]
+            continue
+        paf_prod = paf_prod.merge(paf, on=DEMOGRAPHY_COLS)
+        paf_values = paf_prod[paf_x_cols].values * paf_prod[paf_y_cols].values
+        paf_prod[paf_cols] = paf_values
+        paf_prod = paf_prod[DEMOGRAPHY_COLS + paf_cols]
+
+    if paf_prod is None:
+        return pd.DataFrame()
+
+    paf_prod = paf_prod.reset_index(drop=True)
+    paf_prod[paf_cols] = 1 - paf_prod[paf_cols]
+    return paf_prod
+
+
+def xarray_to_dataframe_pivot(ds, cols, draw_prefix, num_draws):
+    ''' Pivot-based equivalent of xarray_to_dataframe. '''
+    cols = list(cols)
+    df = ds.to_dataframe().reset_index()
+    # the draw column name
+    draw_dim_name =\
+        ["_".join(draw_prefix.split("_")[0:-1])]  # "paf_x_" -> ["paf_x"]
+    # The data variable name
+    data_var_name = str(list(ds.data_vars.keys())[0])
+
+    df = pd.pivot_table(df,
+                        values=data_var_name,
+                        index=cols,
+                        columns=draw_dim_name)\
+           .reset_index()\
+           .rename(columns={i: draw_prefix + '{}'.format(i)
+                            for i in range(num_draws)})
+    return df
+
+
+def merge_sev_rrmax_outer(sev, rr_max, sev_cols, rr_max_cols):
+    ''' Outer-merge equivalent of merge_sev_rrmax. '''
+    share_cols = [col for col in ['location_id', 'age_group_id', 'sex_id',
+                                  'year_id'] if col in rr_max.columns]
+    sev_rr_max = pd.merge(sev, rr_max, on=share_cols, how='outer')
+    sev_rr_max[sev_cols] = sev_rr_max[sev_cols].fillna(0)
+    sev_rr_max[rr_max_cols] = sev_rr_max[rr_max_cols].fillna(1)
+    sev_rr_max = sev_rr_max.sort_values(DEMOGRAPHY_COLS)
+    return sev_rr_max
+
+
+def benchmark_aggregate_paf(num_risks=10, num_draws=100, num_locations=20):
+    ''' Compare the merge-based and array-based PAF aggregation.
+
+        Each synthetic risk misses a few demographies, so both paths also
+        have to agree on which rows survive the alignment.
+    '''
+    demography = synthetic_demography(num_locations)
+    paf_cols = [PAF_DRAW_PREFIX + '{}'.format(i) for i in range(num_draws)]
+    mediated_pafs = []
+    for seed in range(num_risks):
+        paf = synthetic_draws(demography, PAF_DRAW_PREFIX, num_draws,
+                              high=0.3, seed=seed)
+        paf = paf.drop(paf.index[seed::997]).reset_index(drop=True)
+        mediated_pafs.append((paf, 1 - 0.05 * seed))
+
+    expected = product_of_mediated_pafs_merge(mediated_pafs, paf_cols)
+    result = product_of_mediated_pafs(mediated_pafs, paf_cols)
+    pd.testing.assert_frame_equal(result, expected)
+
+    timings = {
+        'merge': best_time(product_of_mediated_pafs_merge, mediated_pafs,
+                           paf_cols),
+        'array': best_time(product_of_mediated_pafs, mediated_pafs,
+                           paf_cols)}
+    return timings
+
+
+def benchmark_xarray_to_dataframe(num_draws=100, num_locations=20):
+    ''' Compare the pivot-based and reshape-based xarray_to_dataframe.
+
+        Some demographies have no value at all, which pivot_table drops.
+    '''
+    demography = synthetic_demography(num_locations)
+    rng = np.random.RandomState(0)
+    shape = [len(demography[col].unique()) for col in DEMOGRAPHY_COLS]
+    values = rng.uniform(size=shape + [num_draws])
+    values[0, :, 0, :5] = np.nan
+    dims = list(DEMOGRAPHY_COLS) + ['draw']
+    coords = [demography[col].unique() for col in DEMOGRAPHY_COLS]
+    coords.append(range(num_draws))
+    ds = xr.DataArray(values, coords=coords, dims=dims,
+                      name='value').to_dataset()
+
+    expected = xarray_to_dataframe_pivot(ds, DEMOGRAPHY_COLS, DRAW_PREFIX,
+                                          num_draws)
+    result = xarray_to_dataframe(ds, DEMOGRAPHY_COLS, DRAW_PREFIX, num_draws)
+    pd.testing.assert_frame_equal(result, expected, check_names=False)
+
+    timings = {
+        'pivot': best_time(xarray_to_dataframe_pivot, ds, DEMOGRAPHY_COLS,
+                           DRAW_PREFIX, num_draws),
+        'reshape': best_time(xarray_to_dataframe, ds, DEMOGRAPHY_COLS,
+                             DRAW_PREFIX, num_draws)}
+    return timings
+
+
+def benchmark_merge_sev_rrmax(num_draws=100, num_locations=20):
+    ''' Compare the outer merge and the broadcast of age/sex rrmax.
+
+        Some SEV draws are missing, so their fill value is exercised.
+    '''
+    sev_cols = [DRAW_PREFIX + '{}'.format(i) for i in range(num_draws)]
+    rr_max_cols = [RR_MAX_DRAW_PREFIX + '{}'.format(i)
+                   for i in range(num_draws)]
+    sev = synthetic_draws(synthetic_demography(num_locations), DRAW_PREFIX,
+                          num_draws)
+    sev.loc[sev.index[::101], sev_cols] = np.nan
+    age_sex = pd.MultiIndex.from_product([list(range(2, 22)), [1, 2]],
+                                         names=['age_group_id', 'sex_id'])
+    rr_max = synthetic_draws(age_sex.to_frame(index=False),
+                             RR_MAX_DRAW_PREFIX, num_draws, low=1, high=3)
+
+    expected = merge_sev_rrmax_outer(sev, rr_max, sev_cols, rr_max_cols)
+    result = merge_sev_rrmax(sev, rr_max, sev_cols, rr_max_cols)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True),
+                                  expected.reset_index(drop=True))
+
+    timings = {
+        'merge': best_time(merge_sev_rrmax_outer, sev, rr_max, sev_cols,
+                           rr_max_cols),
+        'broadcast': best_time(merge_sev_rrmax, sev, rr_max, sev_cols,
+                               rr_max_cols)}
+    return timings
+
+
+def benchmark_paf_storage(num_draws=100, num_locations=20):
+    ''' Compare writing then reading a PAF with each storage backend.
+
+        The PAF is shuffled, so backends that sort on write pay for it.
+    '''
+    demography = synthetic_demography(num_locations)
+    paf = synthetic_draws(demography, PAF_DRAW_PREFIX, num_draws, high=0.3)
+    paf = paf.sample(frac=1, random_state=0).reset_index(drop=True)
+    expected = paf.sort_values(DEMOGRAPHY_COLS).reset_index(drop=True)
+
+    def write_read(storage, path):
+        storage.write(paf, path, DEMOGRAPHY_COLS)
+        result = storage.read(path)
+        if not storage.presorted:
+            result = result.sort_values(DEMOGRAPHY_COLS)
+        return result.reset_index(drop=True)
+
+    outdir = tempfile.mkdtemp()
+    timings = {}
+    try:
+        for backend in sorted(BACKENDS.keys()):
+            if backend == 'zarr' and zarr is None:
+                continue
+            storage = get_storage(backend)
+            path = storage_path(os.path.join(outdir, 'paf.h5'), backend)
+            pd.testing.assert_frame_equal(write_read(storage, path),
+                                          expected)
+            timings[backend] = best_time(write_read, storage, path)
+    finally:
+        shutil.rmtree(outdir)
+    return timings
+
+
+def benchmark_kernels(num_draws=100, num_locations=20):
+    ''' Compare the PAF and scalar transforms as chains of NumPy
+        operations and as kernels, with numexpr if installed and without.
+    '''
+    size = (len(synthetic_demography(num_locations)), num_draws)
+    rng = np.random.RandomState(0)
+    sev = rng.uniform(0, 1, size=size)
+    rr_max = rng.uniform(1, 3, size=size)
+    paf = rng.uniform(0, 0.3, size=size)
+
+    def numpy_chain():
+        scalar = sev * (rr_max - 1) + 1
+        return 1 - 1.0/scalar, 1 / (1 - paf)
+
+    def fused():
+        scalar = kernels.paf_scalar(sev, rr_max)
+        return (kernels.paf_from_scalar(scalar, out=scalar),
+                kernels.scalar_from_paf(paf))
+
+    backends = [('numpy', None)]
+    try:
+        import numexpr
+        backends.append(('numexpr', numexpr))
+    except ImportError:
+        pass
+
+    timings = {'numpy_chain': best_time(numpy_chain)}
+    expected = numpy_chain()
+    installed = kernels.ne
+    try:
+        for name, ne in backends:
+            kernels.ne = ne
+            for result, expected_result in zip(fused(), expected):
+                np.testing.assert_allclose(result, expected_result,
+                                           rtol=1e-12)
+            timings['kernels_{}'.format(name)] = best_time(fused)
+    finally:
+        kernels.ne = installed
+    return timings
+
+
+BENCHMARKS = {'aggregate_paf': benchmark_aggregate_paf,
+              'kernels': benchmark_kernels,
+              'merge_sev_rrmax': benchmark_merge_sev_rrmax,
+              'paf_storage': benchmark_paf_storage,
+              'xarray_to_dataframe': benchmark_xarray_to_dataframe}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark scalars code")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--draws", type=int, nargs="+", default=[100, 1000])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for num_draws in args.draws:
+        timings = BENCHMARKS[args.benchmark](num_draws=num_draws)
+        for path, seconds in sorted(timings.items()):
+            logger.info("{} at {} draws: {} {:.3f}s".format(
+                args.benchmark, num_draws, path, seconds))
@@ -0,0 +1,131 @@
+"""
+Size-capped in-memory and on-disk caches shared by the scalars pipeline.
+"""
+from collections import OrderedDict
+import logging
+import os
+import uuid
+
+import xarray as xr
+
+
+__modname__ = "fbd_research.scalars.cache"
+logger = logging.getLogger(__modname__)
+
+
+class LRUCache(object):
+    ''' In-memory cache evicting least recently used values beyond max_bytes.
+
+        Parameters
+        ----------
+        max_bytes: int, cap on the summed nbytes of cached values.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._values = OrderedDict()
+        self._nbytes = 0
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        if key not in self._values:
+            return default
+        value = self._values.pop(key)
+        self._values[key] = value
+        return value
+
+    def put(self, key, value):
+        nbytes = value.nbytes
+        if key in self._values:
+            self._nbytes -= self._values.pop(key).nbytes
+        if nbytes > self.max_bytes:
+            return
+        self._values[key] = value
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes:
+            _, evicted = self._values.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+
+    def clear(self):
+        self._values.clear()
+        self._nbytes = 0
+
+
+class DiskCache(object):
+    ''' Directory of netCDF files evicting least recently used beyond
+        max_bytes.
+
+        Reads touch a file's mtime, which is what eviction orders by. Writes
+        go to a temporary file that is renamed into place, so processes
+        sharing the directory never read a partial file.
+
+        Parameters
+        ----------
+        directory: str, cache directory, created on first write.
+        max_bytes: int, cap on the summed size of cached files.
+    '''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, '{}.nc'.format(key))
+
+    def get(self, key):
+        ''' Return the cached xarray.Dataset loaded in memory, or None. '''
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with xr.open_dataset(path) as ds:
+                ds = ds.load()
+            os.utime(path, None)
+        except (IOError, OSError, RuntimeError):
+            logger.warning("Unreadable cache file {}".format(path))
+            return None
+        return ds
+
+    def put(self, key, ds):
+        ''' Cache ds under key. Failing to write only logs a warning. '''
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:  # Created by a concurrent process.
+                pass
+        path = self.path(key)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            ds.to_netcdf(tmp_path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError, RuntimeError):
+            logger.warning("Could not cache {}".format(path))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        ''' Remove least recently used files until under max_bytes. '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.nc'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # Removed by a concurrent process.
+                pass
+            total -= size
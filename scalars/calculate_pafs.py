@@ -2,7 +2,10 @@
 This script aims to calculate risk-acause specific PAFs
 '''
 import logging
+import multiprocessing
 import os
+import time
+import numpy as np
 import pandas as pd
 import xarray as xr
 from fbd_core import argparse
@@ -10,41 +13,97 @@ from fbd_core.db import get_cause_id
 from fbd_core.demog.draws import truncate_draws
 from fbd_core.etl.transformation import resample
 
+from cache import DiskCache, LRUCache
+from kernels import as_draws, paf_from_scalar, paf_scalar
+from manifest import input_signature, is_up_to_date, record_signature
+from storage import get_storage, storage_path
 from utils import (get_acause_related_risks, get_modeling_risks,
-                   dataframe_to_hdf, get_whole_index, xarray_to_dataframe)
+                   get_whole_index, xarray_to_dataframe)
 
 from settings import (DRAW_PREFIX, INDIR_SEV, INDIR_RRMAX,
                       OUTDIR_PAF_FORECAST, OUTDIR_PAF_PAST, DEMOGRAPHY_COLS,
-                      RR_MAX_DRAW_PREFIX, DEFAULT_YEARS, VACCINE_RISKS)
+                      DEMOGRAPHY_INDICES,
+                      RR_MAX_DRAW_PREFIX, DEFAULT_YEARS, VACCINE_RISKS,
+                      SEV_CACHE_DIR, SEV_CACHE_DISK_BYTES,
+                      SEV_CACHE_MEMORY_BYTES, PAF_STORAGE_BACKEND)
 
 
 __modname__ = "fbd_research.scalars.calculate_pafs"
 logger = logging.getLogger(__modname__)
 
 
-def read_xarray_sev(risk, date):
+_SEV_MEMORY_CACHE = LRUCache(SEV_CACHE_MEMORY_BYTES)
+_SEV_DISK_CACHE = DiskCache(SEV_CACHE_DIR, SEV_CACHE_DISK_BYTES)
+
+
+def sev_inpath(risk, date):
+    ''' Return the netCDF path of the SEV of risk. '''
+    return os.path.join(INDIR_SEV.format(d=date), '{}.nc'.format(risk))
+
+
+def rrmax_inpath(risk):
+    ''' Return the HDF path of the rrmax of risk. '''
+    return os.path.join(INDIR_RRMAX, '{}.h5'.format(risk))
+
+
+def read_xarray_sev(risk, date, chunks=None, year_ids=None):
     """
     Read SEV in an xarray format.
 
+    SEV resampled to NUMBER_OF_DRAWS is cached in memory and on disk, keyed
+    by risk, date, number of draws and the modification time of the source
+    file, so a refreshed SEV file is never served from the cache. All years
+    are cached, so the past and forecast PAFs of a risk share one read.
+
     Args:
         risk (str): risk name.
         date (str): date str indicating the folder where data comes from.
+        chunks (dict): if given, SEV is opened lazily as dask chunks of this
+            size and bypasses the caches, so only the selected part is ever
+            read.
+        year_ids (list[int]): if given, only those of these years in the
+            SEV file are returned, all years otherwise.
 
     Returns:
         ds (xarray.Dataset): contains sev values, indexed by demography dims.
     """
-    inpath = os.path.join(INDIR_SEV.format(d=date), '{}.nc'.format(risk))
-    # We need to use open_dataset if there are more than one variable, like
-    # summary data (mean, median, lower, upper).
-    ds = xr.open_dataset(inpath)
-
-    num_of_draws_in = len(ds.coords["draw"])
-    if num_of_draws_in != NUMBER_OF_DRAWS:
-        da_name = ds.data_vars.keys()[0]
-        da = resample(ds[da_name], NUMBER_OF_DRAWS)
-        ds = da.to_dataset()
-
-    return ds
+    inpath = sev_inpath(risk, date)
+    if chunks is not None:
+        ds = _select_years(xr.open_dataset(inpath, chunks=chunks), year_ids)
+        if len(ds.coords["draw"]) != NUMBER_OF_DRAWS:
+            da_name = list(ds.data_vars.keys())[0]
+            ds = resample(ds[da_name], NUMBER_OF_DRAWS).to_dataset()
+        return ds
+
+    key = '{risk}_{date}_{draws}_{mtime}'.format(
+        risk=risk, date=date, draws=NUMBER_OF_DRAWS,
+        mtime=int(os.path.getmtime(inpath) * 1e6))
+
+    ds = _SEV_MEMORY_CACHE.get(key)
+    if ds is None:
+        ds = _SEV_DISK_CACHE.get(key)
+        if ds is None:
+            # We need to use open_dataset if there are more than one
+            # variable, like summary data (mean, median, lower, upper).
+            with xr.open_dataset(inpath) as ds:
+                ds = ds.load()
+
+            num_of_draws_in = len(ds.coords["draw"])
+            if num_of_draws_in != NUMBER_OF_DRAWS:
+                da_name = list(ds.data_vars.keys())[0]
+                da = resample(ds[da_name], NUMBER_OF_DRAWS)
+                ds = da.to_dataset()
+                # Only resampled SEV is worth a copy on disk.
+                _SEV_DISK_CACHE.put(key, ds)
+        _SEV_MEMORY_CACHE.put(key, ds)
+    return _select_years(ds, year_ids)
+
+
+def _select_years(ds, year_ids):
+    if year_ids is None:
+        return ds
+    return ds.isel(year_id=np.flatnonzero(
+        ds.coords['year_id'].isin(list(year_ids)).values))
 
 
 def get_past_sev(risk, date, years=None):
@@ -61,8 +120,7 @@ def get_past_sev(risk, date, years=None):
         pandas.DataFrame: past sev data for the risk.
     """
     years = years or DEFAULT_YEARS
-    ds = read_xarray_sev(risk, date)
-    ds = ds.loc[{'year_id': range(years[0], years[1])}]
+    ds = read_xarray_sev(risk, date, year_ids=_year_ids('past', years))
     raw_sev =\
         xarray_to_dataframe(ds, DEMOGRAPHY_COLS, DRAW_PREFIX, NUMBER_OF_DRAWS)
     full_index = get_whole_index("past", years)
@@ -70,7 +128,15 @@ def get_past_sev(risk, date, years=None):
     return sev
 
 
-def get_sev(risk, version, date, years=None):
+def _year_ids(version, years):
+    if version == 'past':
+        return range(years[0], years[1])
+    elif version == 'forecast':
+        return range(years[1], years[2]+1)
+    raise ValueError("Version should be 'past' or 'forecast'.")
+
+
+def get_sev(risk, version, date, years=None, location_ids=None):
     """Get SEV data for past or future for the given risk.
 
     Args:
@@ -79,23 +145,48 @@ def get_sev(risk, version, date, years=None):
         date (str): date indicating the data folder to pull data from.
         years (list[int]): three years for past start, forecast start, and
             forecast end.
+        location_ids (list[int]): if given, only these locations are read,
+            lazily from the SEV file.
 
     Returns:
         pandas.DataFrame: SEV data.
     """
     years = years or DEFAULT_YEARS
-    if version == 'past':
-        year_ids = range(years[0], years[1])
-    elif version == 'forecast':
-        year_ids = range(years[1], years[2]+1)
+    year_ids = _year_ids(version, years)
+    if location_ids is None:
+        ds = read_xarray_sev(risk, date, year_ids=year_ids)
     else:
-        raise ValueError("Version should be 'past' or 'forecast'.")
-    ds = read_xarray_sev(risk, date)
+        ds = read_xarray_sev(risk, date,
+                             chunks={'location_id': len(location_ids)},
+                             year_ids=year_ids)
+    return sev_to_dataframe(ds, version, years, location_ids=location_ids)
+
+
+def sev_to_dataframe(ds, version, years=None, location_ids=None):
+    """Get SEV data of version on the complete demographies from the SEV
+    dataset of read_xarray_sev.
+
+    Args:
+        ds (xarray.Dataset): SEV of read_xarray_sev.
+        version (str): past or future.
+        years (list[int]): three years for past start, forecast start, and
+            forecast end.
+        location_ids (list[int]): if given, SEV of these locations only.
+
+    Returns:
+        pandas.DataFrame: SEV data.
+    """
+    years = years or DEFAULT_YEARS
+    year_ids = _year_ids(version, years)
+    if location_ids is not None:
+        ds = ds.reindex(location_id=location_ids)
     ds = ds.loc[{'year_id': year_ids}]
     raw_sev =\
         xarray_to_dataframe(ds, DEMOGRAPHY_COLS, DRAW_PREFIX, NUMBER_OF_DRAWS)
     # To get the whole sets of demographies.
     full_index = get_whole_index(version, years)
+    if location_ids is not None:
+        full_index = full_index.loc[full_index.location_id.isin(location_ids)]
     # Merge SEV with complete demographies,
     # so no demography will be missing.
     sev = full_index.merge(raw_sev, on=DEMOGRAPHY_COLS, how='left')
@@ -115,8 +206,7 @@ def get_rrmax(risk, cause_id):
         ----------
         df: dataframe of rrmax.
     """
-    inpath = os.path.join(INDIR_RRMAX, '{}.h5'.format(risk))
-    df = pd.read_hdf(inpath)
+    df = pd.read_hdf(rrmax_inpath(risk))
     df = df.loc[(df.cause_id == cause_id)] \
            .drop(['risk_id', 'cause_id'], axis=1)
     # Set rrmax below 1 to 1.001.
@@ -127,37 +217,85 @@ def get_rrmax(risk, cause_id):
     return df
 
 
-def merge_sev_rrmax(sev, rr_max):
+def merge_sev_rrmax(sev, rr_max, sev_cols=None, rr_max_cols=None):
     """ Merge SEV and rrmax.
 
+        rrmax usually varies by fewer demography columns than SEV, e.g. only
+        by age and sex, so it is looked up once per SEV row by its own
+        columns and broadcast along the others, without a join. The result
+        is the outer merge of both on the columns they share: missing SEV is
+        filled with 0 and missing rrmax with 1. If rrmax has duplicated
+        demographies or demographies missing from SEV, they are outer merged
+        instead.
+
         Parameters
         ----------
         sev: dataframe of SEV.
         rr_max: dataframe of RR(max).
+        sev_cols: SEV draw columns, SEV_COLS by default.
+        rr_max_cols: RR(max) draw columns, RR_MAX_COLS by default.
 
         Returns
         ----------
         sev_rr_max: dataframe of merged SEV and RR(max) draws.
     """
-
+    sev_cols = sev_cols or SEV_COLS
+    rr_max_cols = rr_max_cols or RR_MAX_COLS
     # For metab risks, rrmax are age/sex specific.
-    share_cols = ['location_id', 'age_group_id', 'sex_id', 'year_id']
-
-    for col in share_cols:
-        if col not in rr_max.columns:
-            share_cols.remove(col)
-
-    sev_rr_max = pd.merge(sev, rr_max, on=share_cols, how='outer')
+    share_cols = [col for col in ['location_id', 'age_group_id', 'sex_id',
+                                  'year_id'] if col in rr_max.columns]
+
+    rr_max_index = pd.MultiIndex.from_arrays([rr_max[col].values
+                                              for col in share_cols])
+    sev_index = pd.MultiIndex.from_arrays([sev[col].values
+                                           for col in share_cols])
+    if not rr_max_index.is_unique or \
+            not rr_max_index.isin(sev_index).all():
+        sev_rr_max = pd.merge(sev, rr_max, on=share_cols, how='outer')
+    else:
+        # Positions of the rrmax row of each SEV row, -1 (NaN) if there is
+        # none.
+        indexer = rr_max_index.get_indexer(sev_index)
+        sev_rr_max = pd.concat(
+            [sev.reset_index(drop=True),
+             rr_max.drop(share_cols, axis=1).reset_index(drop=True)
+                   .reindex(indexer).reset_index(drop=True)], axis=1)
     # We can replace NA with 0 because these will not affect the result.
-    sev_rr_max[SEV_COLS] = sev_rr_max[SEV_COLS].fillna(0, axis=1)
+    sev_rr_max[sev_cols] = sev_rr_max[sev_cols].fillna(0)
     # Filling rr_max's NA with 1 will also ensure calculation runs
     # and the 1 will not change the result.
-    sev_rr_max[RR_MAX_COLS] = sev_rr_max[RR_MAX_COLS].fillna(1, axis=1)
-    # sev_rr_max = sev_rr_max.loc[~ sev_rr_max.year_id.isnull()]
-    sev_rr_max = sev_rr_max.sort_values(DEMOGRAPHY_COLS)
+    sev_rr_max[rr_max_cols] = sev_rr_max[rr_max_cols].fillna(1)
+    if not pd.MultiIndex.from_arrays(
+            [sev_rr_max[col].values
+             for col in DEMOGRAPHY_COLS]).is_monotonic_increasing:
+        sev_rr_max = sev_rr_max.sort_values(DEMOGRAPHY_COLS)
     return sev_rr_max
 
 
+def paf_outpath(risk, acause, version, date):
+    ''' Return the path of the (risk, acause) PAF of version, with the
+        extension of PAF_STORAGE_BACKEND.
+    '''
+    if version == 'past':
+        outdir = OUTDIR_PAF_PAST
+    elif version == 'forecast':
+        outdir = OUTDIR_PAF_FORECAST.format(d=date)
+    return storage_path(os.path.join(outdir, '{acause}_{risk}.h5'.format(
+        acause=acause, risk=risk)))
+
+
+def paf_signature(risk, version, date, years):
+    ''' Return the manifest signature of the (risk, acause) PAF of version.
+
+        The cause is part of the output path, so only the files read and the
+        parameters of the run make up the signature.
+    '''
+    inputs = {'sev': sev_inpath(risk, date), 'rrmax': rrmax_inpath(risk)}
+    params = {'draws': NUMBER_OF_DRAWS,
+              'years': list(_year_ids(version, years))}
+    return input_signature(inputs, params)
+
+
 def save_paf(risk, acause, df_paf, version, date):
     ''' Save PAF under the directory specified in settings.py
 
@@ -169,21 +307,16 @@ def save_paf(risk, acause, df_paf, version, date):
         version: "past" or "forecast"
         date: the version of this run
     '''
-    if version == 'past':
-        outdir = OUTDIR_PAF_PAST
-    elif version == 'forecast':
-        outdir = OUTDIR_PAF_FORECAST.format(d=date)
-    outpath_paf = os.path.join(outdir,
-                               '{acause}_{risk}.h5'.format(acause=acause,
-                                                           risk=risk))
+    outpath_paf = paf_outpath(risk, acause, version, date)
     if not os.path.exists(os.path.dirname(outpath_paf)):
         os.makedirs(os.path.dirname(outpath_paf))
 
-    dataframe_to_hdf(df_paf, outpath_paf, DEMOGRAPHY_COLS)
+    get_storage().write(df_paf, outpath_paf, DEMOGRAPHY_COLS)
     logger.info('{} pafs saved {}'.format(version, outpath_paf))
 
 
-def calculate_paf(risk, acause, version, date, years=None):
+def calculate_paf(risk, acause, version, date, years=None,
+                  location_ids=None):
     """Calculate PAF for (risk, acause).
 
     Args:
@@ -193,23 +326,37 @@ def calculate_paf(risk, acause, version, date, years=None):
         date (str): date string indicating the folder to pull data from.
         years (list[int]): three years for past start, forecast start, and
             forecast end.
+        location_ids (list[int]): if given, PAF of these locations only.
 
     Returns:
         pandas.DataFrame: PAF data.
     """
     years = years or DEFAULT_YEARS
     cause_id = get_cause_id(acause)
-    sev = get_sev(risk, version, date, years)
+    sev = get_sev(risk, version, date, years, location_ids=location_ids)
     rr_max = get_rrmax(risk, cause_id)
+    return paf_from_sev_rrmax(sev, rr_max)
+
+
+def paf_from_sev_rrmax(sev, rr_max):
+    """Calculate PAF from SEV and rrmax.
+
+    Args:
+        sev (pandas.DataFrame): SEV of get_sev.
+        rr_max (pandas.DataFrame): rrmax of get_rrmax.
+
+    Returns:
+        pandas.DataFrame: PAF data.
+    """
     sev_rr_max = merge_sev_rrmax(sev, rr_max)
-    sev_values = sev_rr_max[SEV_COLS].values
-    rrmax_values = sev_rr_max[RR_MAX_COLS].values
-    # Calculate scalars.
-    scalar = sev_values * (rrmax_values - 1) + 1
-    scalar = truncate_draws(scalar)
+    sev_values = as_draws(sev_rr_max[SEV_COLS].values)
+    rrmax_values = as_draws(sev_rr_max[RR_MAX_COLS].values)
+    # Calculate scalars, reusing the rrmax copy.
+    scalar = paf_scalar(sev_values, rrmax_values, out=rrmax_values)
+    scalar = as_draws(truncate_draws(scalar))
 
     # Calculate PAF.
-    paf = 1 - 1.0/scalar
+    paf = paf_from_scalar(scalar, out=scalar)
     # Save PAF.
     df_paf = sev_rr_max.loc[:, DEMOGRAPHY_COLS].copy()
     paf_draws = ['paf_{draw}'.format(draw=i) for i in range(NUMBER_OF_DRAWS)]
@@ -222,45 +369,288 @@ def calculate_paf(risk, acause, version, date, years=None):
     return df_paf
 
 
-def main(acause, date, years=None):
+def get_sev_xr(risk, version, date, years=None):
+    """Get SEV on the complete demography grid of version, as a DataArray.
+
+    Args:
+        risk (str): risk to get sev data for.
+        version (str): past or future.
+        date (str): date indicating the data folder to pull data from.
+        years (list[int]): three years for past start, forecast start, and
+            forecast end.
+
+    Returns:
+        xarray.DataArray: SEV with dims DEMOGRAPHY_COLS and draw, NaN for
+            missing demographies.
+    """
+    years = years or DEFAULT_YEARS
+    year_ids = _year_ids(version, years)
+    ds = read_xarray_sev(risk, date, year_ids=year_ids)
+    da = ds[list(ds.data_vars.keys())[0]]
+    grid = dict(DEMOGRAPHY_INDICES, year_id=year_ids)
+    return da.reindex(**grid).transpose(*(list(DEMOGRAPHY_COLS) + ['draw']))
+
+
+def get_rrmax_xr(risk, cause_id):
+    """Get rrmax as a DataArray over the demography dims it varies by.
+
+    Args:
+        risk (str): risk name.
+        cause_id (int): cause id.
+
+    Returns:
+        xarray.DataArray: rrmax with a draw dim.
+    """
+    df = get_rrmax(risk, cause_id)
+    dims = [col for col in DEMOGRAPHY_COLS if col in df.columns]
+    rr_cols = [RR_MAX_DRAW_PREFIX + '{}'.format(i)
+               for i in range(NUMBER_OF_DRAWS)]
+    rr_max = df.set_index(dims)[rr_cols]
+    rr_max.columns = pd.Index(range(NUMBER_OF_DRAWS), name='draw')
+    return xr.DataArray.from_series(rr_max.stack())
+
+
+def calculate_paf_xr(risk, acause, version, date, years=None):
+    """Calculate PAF for (risk, acause) without leaving xarray.
+
+    rrmax is broadcast over the demography dims it does not vary by. Missing
+    SEV is filled with 0 and missing rrmax with 1, as in merge_sev_rrmax.
+
+    Args:
+        risk (str): risk to calculate paf for.
+        acause (str): acause to calculate paf for.
+        version (str): "past" or "forecast".
+        date (str): date string indicating the folder to pull data from.
+        years (list[int]): three years for past start, forecast start, and
+            forecast end.
+
+    Returns:
+        xarray.DataArray: PAF named "value" with dims DEMOGRAPHY_COLS and
+            draw.
+    """
+    years = years or DEFAULT_YEARS
+    cause_id = get_cause_id(acause)
+    sev = get_sev_xr(risk, version, date, years)
+    rr_max = get_rrmax_xr(risk, cause_id)
+    sev, rr_max = xr.align(sev, rr_max, join='outer')
+    scalar = sev.fillna(0) * (rr_max.fillna(1) - 1) + 1
+    scalar = scalar.transpose(*(list(DEMOGRAPHY_COLS) + ['draw']))
+
+    values = as_draws(truncate_draws(scalar.values.reshape(-1,
+                                                          scalar.shape[-1])))
+    paf = scalar.copy(data=paf_from_scalar(values, out=values).reshape(
+        scalar.shape))
+    paf.name = 'value'
+    return paf
+
+
+def save_paf_xr(risk, acause, da_paf, version, date):
+    """Save PAF as netCDF next to the PAFs of save_paf.
+
+    Args:
+        risk (str): risk name.
+        acause (str): acause.
+        da_paf (xarray.DataArray): PAF.
+        version (str): "past" or "forecast".
+        date (str): the version of this run.
     """
-    TODO: what does this script do?
+    outpath_paf = os.path.splitext(paf_outpath(risk, acause, version,
+                                               date))[0] + '.nc'
+    if not os.path.exists(os.path.dirname(outpath_paf)):
+        os.makedirs(os.path.dirname(outpath_paf))
+
+    da_paf.to_netcdf(outpath_paf)
+    logger.info('{} pafs saved {}'.format(version, outpath_paf))
+
+
+def calculate_paf_chunked(risk, acause, version, date, years, chunk_size):
+    """Calculate PAF by blocks of locations.
+
+    SEV is opened, and resampled to NUMBER_OF_DRAWS, once, and rrmax and the
+    cause id are read once, so every block has the same draws. Rows from
+    rrmax that match no SEV row of a block are left out.
+
+    Args:
+        risk (str): risk to calculate paf for.
+        acause (str): acause to calculate paf for.
+        version (str): "past" or "forecast".
+        date (str): date string indicating the folder to pull data from.
+        years (list[int]): three years for past start, forecast start, and
+            forecast end.
+        chunk_size (int): number of locations per block.
+
+    Yields:
+        pandas.DataFrame: PAF data of each block of locations.
+    """
+    years = years or DEFAULT_YEARS
+    cause_id = get_cause_id(acause)
+    rr_max = get_rrmax(risk, cause_id)
+    ds = read_xarray_sev(risk, date, chunks={'location_id': chunk_size},
+                         year_ids=_year_ids(version, years))
+    location_ids = list(DEMOGRAPHY_INDICES['location_id'])
+    for start in range(0, len(location_ids), chunk_size):
+        block = location_ids[start:start + chunk_size]
+        sev = sev_to_dataframe(ds, version, years, location_ids=block)
+        df_paf = paf_from_sev_rrmax(sev, rr_max)
+        yield df_paf.loc[df_paf.location_id.isin(block)]
+
+
+def calculate_and_save_paf_chunked(risk, acause, version, date, years,
+                                   chunk_size):
+    """Calculate PAF by blocks of locations, appending each to the HDF file.
+
+    Peak memory is set by chunk_size, not by the number of locations, see
+    calculate_paf_chunked.
+
+    Args:
+        risk (str): risk to calculate paf for.
+        acause (str): acause to calculate paf for.
+        version (str): "past" or "forecast".
+        date (str): date string indicating the folder to pull data from.
+        years (list[int]): three years for past start, forecast start, and
+            forecast end.
+        chunk_size (int): number of locations per block.
+    """
+    outpath_paf = paf_outpath(risk, acause, version, date)
+    if not os.path.exists(os.path.dirname(outpath_paf)):
+        os.makedirs(os.path.dirname(outpath_paf))
+
+    storage = get_storage()
+    num_locations = 0
+    blocks = calculate_paf_chunked(risk, acause, version, date, years,
+                                   chunk_size)
+    for i, df_paf in enumerate(blocks):
+        storage.write(df_paf, outpath_paf, DEMOGRAPHY_COLS, append=i > 0)
+        num_locations += df_paf.location_id.nunique()
+        logger.info('{} pafs of {} locations appended to {}'.format(
+            version, num_locations, outpath_paf))
+
+
+def _paf_outpath(risk, acause, version, date, use_xarray):
+    outpath_paf = paf_outpath(risk, acause, version, date)
+    if use_xarray:
+        outpath_paf = os.path.splitext(outpath_paf)[0] + '.nc'
+    return outpath_paf
+
+
+def _calculate_and_save_paf(task):
+    """Calculate and save one (risk, version) PAF and time it.
+
+    Args:
+        task (tuple): (risk, acause, version, date, years, use_xarray,
+            chunk_size, signature), signature being recorded in the manifest
+            of the saved PAF.
+
+    Returns:
+        tuple: (risk, version, seconds taken).
+    """
+    (risk, acause, version, date, years, use_xarray, chunk_size,
+     signature) = task
+    start = time.time()
+    if chunk_size:
+        calculate_and_save_paf_chunked(risk, acause, version, date, years,
+                                       chunk_size)
+    elif use_xarray:
+        da_paf = calculate_paf_xr(risk, acause, version, date, years)
+        save_paf_xr(risk, acause, da_paf, version, date)
+    else:
+        df_paf = calculate_paf(risk, acause, version, date, years)
+        save_paf(risk, acause, df_paf, version, date)
+    record_signature(_paf_outpath(risk, acause, version, date, use_xarray),
+                     signature)
+    seconds = time.time() - start
+    logger.info('{} {} {} PAF took {:.1f}s'.format(acause, risk, version,
+                                                   seconds))
+    return risk, version, seconds
+
+
+def _init_paf_worker(sev_cache_memory_bytes):
+    """Cap the SEV cached in memory by a worker of main."""
+    _SEV_MEMORY_CACHE.clear()
+    _SEV_MEMORY_CACHE.max_bytes = sev_cache_memory_bytes
+
+
+def main(acause, date, years=None, workers=1, use_xarray=False,
+         chunk_size=None, force=False, update_past=False):
+    """
+    Calculate and save past and forecast PAFs of every risk of acause.
+
+    A forecast PAF is only recalculated if its SEV, its rrmax or the
+    parameters of the run changed since it was saved, see manifest.py.
+    Past PAFs are shared by every date, so they are only calculated if
+    missing, unless update_past.
 
     Args:
         acause (str): the cause whcih we are doing this thing to.
         date (str): not sure, but I think this is the version string?
         years (list[int]): three years for past start, forecast start, and
             forecast end.
+        workers (int): number of processes running (risk, version) pairs.
+            Each worker holds one draw matrix at a time, so at most `workers`
+            are resident at once, on top of the SEV cached in memory, at
+            most SEV_CACHE_MEMORY_BYTES in all. Workers run task after task
+            in the same process, so that its caches of SEV and metadata
+            serve the tasks that follow. The trade-off is that memory a
+            task freed isn't always returned to the system, so a worker
+            stays about as large as its largest task plus its cache.
+        use_xarray (bool): compute PAFs as DataArrays and save them as
+            netCDF instead of PAF_STORAGE_BACKEND.
+        chunk_size (int): if given, compute PAFs by blocks of this many
+            locations and stream them to HDF. Only available with the "hdf"
+            PAF_STORAGE_BACKEND and without use_xarray.
+        force (bool): recalculate every PAF, even those up to date.
+        update_past (bool): recalculate past PAFs even if they exist.
     """
     years = years or DEFAULT_YEARS
+    if chunk_size and (use_xarray or PAF_STORAGE_BACKEND != 'hdf'):
+        raise ValueError("chunk_size is only available for HDF PAFs.")
 
     # All risks contributing to acause.
     risks = get_acause_related_risks(acause)
     modeling_risks = get_modeling_risks()
     vaccine_risks = VACCINE_RISKS
 
+    tasks = []
     for risk in risks:
         # PAFs of vaccine_risks are calculated differently.
         if risk in vaccine_risks:
             continue
         elif risk in modeling_risks:
-            outpath_paf_past =\
-                os.path.join(OUTDIR_PAF_PAST,
-                             '{acause}_{risk}.h5'.format(acause=acause,
-                                                         risk=risk))
-            # If past PAF exists, we don't need to recalculate.
-            if not os.path.exists(outpath_paf_past):
-                version = 'past'
-                df_paf = calculate_paf(risk, acause, version, date, years)
-                save_paf(risk, acause, df_paf, version, date)
-
-            version = 'forecast'
-            df_paf = calculate_paf(risk, acause, version, date, years)
-            save_paf(risk, acause, df_paf, version, date)
+            for version in ['past', 'forecast']:
+                outpath_paf = _paf_outpath(risk, acause, version, date,
+                                           use_xarray)
+                # Signatures only stat the inputs, see manifest.py.
+                signature = paf_signature(risk, version, date, years)
+                if version == 'past' and not (force or update_past):
+                    if os.path.exists(outpath_paf):
+                        logger.info("{} exists".format(outpath_paf))
+                        continue
+                elif version == 'forecast' and not force:
+                    if is_up_to_date(outpath_paf, signature):
+                        continue
+                tasks.append((risk, acause, version, date, years, use_xarray,
+                              chunk_size, signature))
         else:
             logger.error('No {risk} available for {acause}'.
                          format(risk=risk, acause=acause))
 
+    start = time.time()
+    if workers > 1:
+        pool = multiprocessing.Pool(
+            workers, initializer=_init_paf_worker,
+            initargs=(SEV_CACHE_MEMORY_BYTES // workers,))
+        try:
+            timings = list(pool.imap_unordered(_calculate_and_save_paf,
+                                               tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        timings = [_calculate_and_save_paf(task) for task in tasks]
+    logger.info('{} PAFs of {} took {:.1f}s in total, {:.1f}s of work'.format(
+        len(timings), acause, time.time() - start,
+        sum(seconds for _, _, seconds in timings)))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Calculate PAFS")
@@ -270,6 +660,17 @@ if __name__ == '__main__':
                         help="String denoting file directory. Ex: 2015_03_21")
     parser.add_arg_years()
     parser.add_arg_draws()
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes computing PAFs.")
+    parser.add_argument("--xarray", action="store_true",
+                        help="Keep PAFs as xarray and save them as netCDF.")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="Compute PAFs by blocks of this many locations.")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute PAFs even if their inputs are "
+                             "unchanged.")
+    parser.add_argument("--update-past", action="store_true",
+                        help="Recompute past PAFs even if they exist.")
 
     args = parser.parse_args()
 
@@ -284,5 +685,7 @@ if __name__ == '__main__':
     RR_MAX_COLS = [RR_MAX_DRAW_PREFIX + '{}'.format(i)
                    for i in range(NUMBER_OF_DRAWS)]
 
-    main(args.acause, args.date, year_args)
+    main(args.acause, args.date, year_args, workers=args.workers,
+         use_xarray=args.xarray, chunk_size=args.chunk_size,
+         force=args.force, update_past=args.update_past)
     logger.debug("exit from script")
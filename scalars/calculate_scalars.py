@@ -1,20 +1,24 @@
 """
 This script calculates aggregated acause specific PAFs and scalars
 """
-import argparse
 from collections import defaultdict
 import cPickle as pickle
 import logging
+import multiprocessing
 import numpy as np
 import os
 import pandas as pd
 import xarray as xr
 
+from fbd_core import argparse
 from fbd_core.etl.extraction import subset_and_index, df_to_xr
 
+from kernels import (as_draws, cap, replace_ones, scalar_from_paf,
+                     scale_to_max)
+from manifest import input_signature, is_up_to_date, record_signature
 from plot_tools import plot_scalars
-from utils import (get_acause_related_risks, dataframe_to_hdf,
-                   read_risk_table_from_db)
+from storage import get_storage, storage_for_path, storage_path
+from utils import get_acause_related_risks, read_risk_table_from_db
 
 from settings import (INPATH_MEDIATION, INPATH_PAF_SET_ONE,
                       INDIR_PAF_FORECAST, INDIR_PAF_PAST,
@@ -42,13 +46,31 @@ def bound_zero_one(paf):
         paf_bounded: dataframe
     '''
     paf_bounded = paf.fillna(0)
-    matrix = paf_bounded.loc[:, PAF_COLS].values
-    replacements = ((matrix).T == 1).T
-    matrix[replacements] = 0.9999
-    paf_bounded.loc[:, PAF_COLS] = matrix
+    matrix = as_draws(paf_bounded.loc[:, PAF_COLS].values)
+    paf_bounded.loc[:, PAF_COLS] = replace_ones(matrix, 0.9999)
     return paf_bounded
 
 
+def paf_inpath(acause, risk, version, date):
+    ''' Return the path of the (acause, risk) PAF of version.
+
+        Vaccine PAFs are always HDF, other PAFs have the extension of
+        PAF_STORAGE_BACKEND.
+    '''
+    # TODO need better flow, and perhaps put the risks in settings.py
+    if risk in VACCINE_RISKS:
+        return os.path.join(INDIR_VACCINE_PAF.format(d=date),
+                            '{}_{}.h5'.format(acause, risk))
+    if version == 'past':
+        inpath = os.path.join(INDIR_PAF_PAST, '{}_{}.h5'.format(acause, risk))
+    elif version == 'forecast':
+        inpath = os.path.join(INDIR_PAF_FORECAST.format(d=date),
+                              '{}_{}.h5'.format(acause, risk))
+    else:
+        raise ValueError("Version should be 'past' or 'forecast'.")
+    return storage_path(inpath)
+
+
 def read_paf(acause, risk, version, date, years):
     """
     Read past or forecast PAF.
@@ -65,21 +87,13 @@ def read_paf(acause, risk, version, date, years):
         paf (pandas.DataFrame): dataframe of PAF.
     """
 
-    try:  # TODO need better flow, and perhaps put the risks in settings.py
-        if risk in VACCINE_RISKS:
-            infile = os.path.join(INDIR_VACCINE_PAF.format(d=date),
-                                  '{}_{}.h5'.format(acause, risk))
-        else:
-            if version == 'past':
-                infile = os.path.join(INDIR_PAF_PAST,
-                                      '{}_{}.h5'.format(acause, risk))
-            elif version == 'forecast':
-                infile = os.path.join(INDIR_PAF_FORECAST.format(d=date),
-                                      '{}_{}.h5'.format(acause, risk))
+    try:
+        infile = paf_inpath(acause, risk, version, date)
         if not os.path.exists(infile):
             raise ValueError("Path {} doesn't exist! ".format(infile))
 
-        paf = pd.read_hdf(infile, 'data')
+        storage = storage_for_path(infile)
+        paf = storage.read(infile)
 
     except:
         logger.error("{}, {} Error: "
@@ -87,11 +101,114 @@ def read_paf(acause, risk, version, date, years):
         return pd.DataFrame()
 
     paf = bound_zero_one(paf)
-    paf = paf.sort_values(DEMOGRAPHY_COLS).reset_index(drop=True)
+    if not storage.presorted:
+        paf = paf.sort_values(DEMOGRAPHY_COLS).reset_index(drop=True)
     paf = paf[paf['year_id'] >= years[0]]
     return paf
 
 
+class MediationIndex(object):
+    ''' Mediation factors compiled into an (acause, mediator, risk) array.
+
+        Each cell holds prod(1 - mean) over the rows of the mediation table
+        for that triple, and 1 where the table has no row, so the mediation
+        product for a set of risks is a product over one slice of the array.
+
+        Parameters
+        ----------
+        med: dataframe with columns of acause, mediator, risk, mean.
+    '''
+
+    def __init__(self, med):
+        acause_codes, acauses = pd.factorize(med.acause)
+        mediator_codes, mediators = pd.factorize(med.mediator)
+        risk_codes, risks = pd.factorize(med.risk)
+        self._acause_ids = dict(zip(acauses, range(len(acauses))))
+        self._mediator_ids = dict(zip(mediators, range(len(mediators))))
+        self._risk_ids = dict(zip(risks, range(len(risks))))
+
+        self._factors = np.ones((len(acauses), len(mediators), len(risks)))
+        np.multiply.at(self._factors,
+                       (acause_codes, mediator_codes, risk_codes),
+                       1 - med['mean'].values)
+
+    def _risk_codes(self, cause_risks):
+        return sorted(set(self._risk_ids[risk] for risk in cause_risks
+                          if risk in self._risk_ids))
+
+    def product(self, acause, mediator, cause_risks):
+        ''' Return the mediation factor for (acause, mediator).
+
+            Parameters
+            ----------
+            acause: str, acause.
+            mediator: str, risk whose PAF is mediated.
+            cause_risks: risks related to acause.
+
+            Returns
+            ----------
+            mediation_products: float, 1.0 if nothing is mediated.
+        '''
+        if (acause not in self._acause_ids or
+                mediator not in self._mediator_ids):
+            return 1.0
+        factors = self._factors[self._acause_ids[acause],
+                                self._mediator_ids[mediator],
+                                self._risk_codes(cause_risks)]
+        return float(np.prod(factors))
+
+    def products(self, acause, cause_risks):
+        ''' Return the mediation factors of every risk of acause at once.
+
+            Parameters
+            ----------
+            acause: str, acause.
+            cause_risks: risks related to acause, used both as mediators and
+                         as the risks they are mediated through.
+
+            Returns
+            ----------
+            mediation_products: pandas.Series indexed by cause_risks.
+        '''
+        mediation_products = pd.Series(1.0, index=cause_risks)
+        if acause not in self._acause_ids:
+            return mediation_products
+
+        mediators = [risk for risk in cause_risks
+                     if risk in self._mediator_ids]
+        mediator_codes = [self._mediator_ids[risk] for risk in mediators]
+        factors = self._factors[self._acause_ids[acause]]
+        factors = factors[np.ix_(mediator_codes,
+                                 self._risk_codes(cause_risks))]
+        mediation_products[mediators] = np.prod(factors, axis=1)
+        return mediation_products
+
+
+_MEDIATION_INDICES = {}
+
+
+def get_mediation_index(inpath=INPATH_MEDIATION):
+    ''' Return the MediationIndex of inpath, reading it once per process. '''
+    if inpath not in _MEDIATION_INDICES:
+        logger.info("Reading mediation: {}".format(inpath))
+        _MEDIATION_INDICES[inpath] = MediationIndex(pd.read_csv(inpath))
+    return _MEDIATION_INDICES[inpath]
+
+
+_PAF_SET_ONE = {}
+
+
+def get_paf_set_one(inpath=INPATH_PAF_SET_ONE):
+    ''' Return the (acause, risk) pairs whose PAF is set to one.
+
+        The pickled list is read once per process.
+    '''
+    if inpath not in _PAF_SET_ONE:
+        with open(inpath, 'rb') as f:
+            _PAF_SET_ONE[inpath] = pickle.load(f)
+    return _PAF_SET_ONE[inpath]
+
+
 def product_of_mediation(acause, risk, cause_risks):
     """ Return the mediation factor for (acause, risk).
 
@@ -106,20 +223,9 @@ def product_of_mediation(acause, risk, cause_risks):
         mediation_products: float, mediation products for (acause, risk).
     """
     logger.info("Doing some mediation.")
-    # Read the dataframe of mediation for risk factors.
-    med = pd.read_csv(INPATH_MEDIATION)
-    mediation_factors = med.loc[(med.acause == acause) &
-                                (med.mediator == risk) &
-                                (med.risk.isin(cause_risks))
-                                ]['mean'].values
-
-    if len(mediation_factors):
-        mediation_products = np.prod(1 - mediation_factors)
-    else:
-        # The mediation of each risk factor through itself is
-        # assumed to be zero.
-        mediation_products = 1.0
-    return mediation_products
+    # The mediation of each risk factor through itself is
+    # assumed to be zero, so risks without mediation get 1.0.
+    return get_mediation_index().product(acause, risk, cause_risks)
 
 
 def get_id_risk(risk_table):
@@ -136,10 +242,80 @@ def get_id_risk(risk_table):
     return id_risk
 
 
+def _parse_path(path):
+    ''' Return path_to_top_parent as an int array, -1 where not an int. '''
+    try:
+        parts = path.split(',')
+    except AttributeError:
+        return np.array([], dtype=int)
+    ids = []
+    for part in parts:
+        try:
+            ids.append(int(part))
+        except ValueError:
+            ids.append(-1)
+    return np.array(ids, dtype=int)
+
+
+class RiskHierarchy(object):
+    ''' The risk table indexed for looking up level 1, 2, 3 parents.
+
+        Built once from the risk table and shared by every cause of a run.
+
+        Parameters
+        ----------
+        risk_table: dataframe with columns of rei, rei_id,
+                    path_to_top_parent, level.
+        id_risk: dictionary of risk_id, risk, get_id_risk(risk_table) if
+                 None.
+    '''
+
+    levels = [1, 2, 3]
+
+    def __init__(self, risk_table, id_risk=None):
+        self.id_risk = get_id_risk(risk_table) if id_risk is None else id_risk
+        self.rows = {}
+        self.paths = {}
+        reis = risk_table['rei'].values
+        paths = risk_table['path_to_top_parent'].values
+        for row, (rei, path) in enumerate(zip(reis, paths)):
+            # Like risk_table.loc[risk_table.rei == rei], first row wins.
+            if rei not in self.rows:
+                self.rows[rei] = row
+                self.paths[rei] = _parse_path(path)
+        self._parents = {rei: [self._parent(path, level)
+                               for level in self.levels]
+                         for rei, path in self.paths.items()}
+
+    def _parent(self, path, level):
+        if level >= len(path):
+            return None
+        return self.id_risk.get(path[level])
+
+    def parents(self, risk):
+        ''' Return the level 1, 2, 3 parents of risk, None where missing. '''
+        return self._parents.get(risk, [None] * len(self.levels))
+
+    def cluster_risks(self, cause_risks):
+        ''' Return a dictionary. key: level 1, 2, 3 risk; value: list of
+            sub-risks, in the order of levels then cause_risks.
+        '''
+        risk_lst = defaultdict(list)
+        parents = [self.parents(risk) for risk in cause_risks]
+        for ix in range(len(self.levels)):
+            for risk, risk_parents in zip(cause_risks, parents):
+                if risk_parents[ix] is not None:
+                    risk_lst[risk_parents[ix]].append(risk)
+        return risk_lst
+
+
 def get_cluster_risks(cause_risks, id_risk, risk_table):
     ''' Return a dictionary. key: level 1, 2, 3 risk; value: list of sub-risks.
         {'_env': ['air_hap'], 'metab': ['metab_bmi'], '_behav': ['activity']}
 
+        Builds a RiskHierarchy, reuse one instead when looking up many
+        causes.
+
         Parameters
         ----------
         cause_risks: list of risks contributing to 'cause'.
@@ -148,19 +324,91 @@ def get_cluster_risks(cause_risks, id_risk, risk_table):
                     path_to_top_parent, level.
 
     '''
-    risk_lst = defaultdict(list)
-
-    for level in [1, 2, 3]:
-        for risk in cause_risks:
-            try:
-                parent_id = int(risk_table.loc[risk_table.rei == risk]
-                                ['path_to_top_parent'].values[0].
-                                split(',')[level])
-                parent_risk = id_risk[parent_id]
-                risk_lst[parent_risk].append(risk)
-            except:
-                continue
-    return risk_lst
+    return RiskHierarchy(risk_table, id_risk).cluster_risks(cause_risks)
+
+
+def _iter_mediated_pafs(acause, cause_risks, version, date, years,
+                        paf_set_one_tuple, mediation_prods, reader=None):
+    ''' Yield (paf, mediation_prod) for every usable risk of acause.
+
+        Risks in paf_set_one_tuple and risks without PAF are skipped.
+        PAFs are read with reader, read_paf by default.
+    '''
+    reader = reader or read_paf
+    for risk in cause_risks:
+        logger.info('Doing risk: {}'.format(risk))
+        # Ignore (acause, risk) if it's in paf_set_one_tuple.
+        # So we wouldn't get flat scalars for the acause.
+        if (acause, risk) in paf_set_one_tuple:
+            logger.info("{}, {} in paf_set_one_tuple".format(acause, risk))
+            continue
+        paf = reader(acause, risk, version, date, years)
+
+        if paf is None or not len(paf):
+            logger.info("len(paf) == 0: {}".format(risk))
+            continue
+
+        yield paf, mediation_prods[risk]
+
+
+def _demography_index(df):
+    ''' Return a MultiIndex over the DEMOGRAPHY_COLS of df. '''
+    return pd.MultiIndex.from_arrays([df[col].values
+                                      for col in DEMOGRAPHY_COLS])
+
+
+def product_of_mediated_pafs(mediated_pafs, paf_cols):
+    ''' Aggregate PAFs as 1 - prod(1 - mediation_prod * paf).
+
+        Every PAF is aligned onto the demography grid of the first PAF once,
+        and the product is accumulated in place on a single
+        (demography x draw) array, so no wide frame is ever merged.
+        Only demographies present in every PAF are kept, as with an inner
+        merge on DEMOGRAPHY_COLS. Duplicated demographies of a PAF, as in
+        some vaccine PAFs, are dropped but for their first row.
+
+        Parameters
+        ----------
+        mediated_pafs: iterable of (dataframe of PAF, float mediation_prod).
+        paf_cols: list of draw columns.
+
+        Returns
+        ----------
+        paf_aggregated: dataframe of aggregated PAF, empty if there are no
+                        PAFs.
+    '''
+    base_index = None
+    for paf, mediation_prod in mediated_pafs:
+        index = _demography_index(paf)
+        if not index.is_unique:
+            first = ~index.duplicated()
+            paf, index = paf.loc[first], index[first]
+        values = paf[paf_cols].values
+        if base_index is None:
+            base = paf[DEMOGRAPHY_COLS].reset_index(drop=True)
+            base_index = index
+            paf_prod = values * mediation_prod
+            np.subtract(1, paf_prod, out=paf_prod)
+            present = np.ones(len(base_index), dtype=bool)
+            continue
+
+        indexer = index.get_indexer(base_index)
+        found = indexer >= 0
+        present &= found
+        if not (found.all() and np.array_equal(indexer,
+                                               np.arange(len(indexer)))):
+            # Rows missing from this PAF are dropped through `present`.
+            values = values.take(np.where(found, indexer, 0), axis=0)
+        factor = values * mediation_prod
+        np.subtract(1, factor, out=factor)
+        paf_prod *= factor
+
+    if base_index is None:
+        return pd.DataFrame()
+
+    paf_aggregated = base.loc[present].reset_index(drop=True)
+    paf_values = pd.DataFrame(1 - paf_prod[present], columns=paf_cols)
+    return pd.concat([paf_aggregated, paf_values], axis=1)
 
 
 def aggregate_paf(acause, cause_risks, version, date, years,
@@ -182,54 +430,22 @@ def aggregate_paf(acause, cause_risks, version, date, years,
     '''
     logger.info('Start aggregating {} PAF:'.format(version))
     # Read the list of risk-acause pairs that are supposed to have PAF of one.
-    with open(INPATH_PAF_SET_ONE, 'rb') as f:
-        paf_set_one_tuple = pickle.load(f)
-
-    index = 0
+    paf_set_one_tuple = get_paf_set_one()
 
     logger.info("Risks: {}".format(cause_risks))
 
-    for risk in cause_risks:
-        logger.info('Doing risk: {}'.format(risk))
-        # Ignore (acause, risk) if it's in paf_set_one_tuple.
-        # So we wouldn't get flat scalars for the acause.
-        if (acause, risk) in paf_set_one_tuple:
-            logger.info("{}, {} in paf_set_one_tuple".format(acause, risk))
-            continue
-        paf = read_paf(acause, risk, version, date, years)
-
-        if not len(paf):
-            logger.info("len(paf) == 0: {}".format(risk))
-            continue
-
-        mediation_prod = product_of_mediation(acause, risk, cause_risks)
+    mediation_prods = get_mediation_index().products(acause, cause_risks)
+    mediated_pafs = _iter_mediated_pafs(acause, cause_risks, version, date,
+                                        years, paf_set_one_tuple,
+                                        mediation_prods)
+    paf_aggregated = product_of_mediated_pafs(mediated_pafs, PAF_COLS)
 
-        if index == 0:
-            logger.info("Index is 0. Starting the paf_prod.")
-            paf_prod = paf[DEMOGRAPHY_COLS].copy()
-            paf_prod[PAF_COLS] = 1 - paf[PAF_COLS] * mediation_prod
-            index += 1
-        else:
-            logger.info("Index is {}.".format(index))
-            paf[PAF_COLS] = 1 - paf[PAF_COLS] * mediation_prod
-            paf_prod = paf_prod.merge(paf, on=DEMOGRAPHY_COLS)
-            paf_values = paf_prod[PAF_X_COLS].values *\
-                paf_prod[PAF_Y_COLS].values
-            paf_prod[PAF_COLS] = pd.DataFrame(paf_values)
-            keep_cols = DEMOGRAPHY_COLS + PAF_COLS
-            paf_prod = paf_prod[keep_cols]
-            index += 1
-
-    if index > 0:
+    if len(paf_aggregated):
         logger.info("We got some pafs.")
-        paf_prod[PAF_COLS] = 1 - paf_prod[PAF_COLS]
-        paf_aggregated = paf_prod.copy()
-
         # Cap PAF at 0.9999.
-        array = paf_aggregated.loc[:, PAF_COLS].values
-        if len(np.where(array > 0.9999)[0]):
+        array = as_draws(paf_aggregated.loc[:, PAF_COLS].values)
+        if cap(array, 0.9999):
             logger.info("Gotta scale some down to 0.9999")
-            array[array > 0.9999] = 0.9999
             paf_aggregated.loc[:, PAF_COLS] = array
     else:
         logger.error('No risks available for {}'.format(acause))
@@ -255,7 +471,8 @@ def generate_scalars_from_aggregated_paf(paf):
     '''
     logger.info("Generating scalars from paf.")
     scalar = paf.loc[:, DEMOGRAPHY_COLS].copy()
-    scalar_values = 1 / (1 - paf.loc[:, PAF_COLS].values)
+    paf_values = as_draws(paf.loc[:, PAF_COLS].values)
+    scalar_values = scalar_from_paf(paf_values, out=paf_values)
     scalar[SCALAR_COLS] = pd.DataFrame(scalar_values, index=scalar.index)
     scalar = scalar.sort_values(DEMOGRAPHY_COLS).reset_index(drop=True)
     return scalar
@@ -274,22 +491,18 @@ def scale_paf(paf):
        scaled_paf: dataframe of scaled PAF.
     '''
     scaled_paf = paf.copy()
-    paf_values = paf.loc[:, PAF_COLS].values
-    max_paf = np.max(paf_values)
-
-    if max_paf > 0.95:
-        scale = 0.95 / max_paf
-        paf_values = paf_values * scale
+    paf_values = as_draws(paf.loc[:, PAF_COLS].values)
+    if scale_to_max(paf_values, 0.95) != 1:
         scaled_paf.loc[:, PAF_COLS] = paf_values
     return scaled_paf
 
 
-def save_paf(paf, version, acause, date, cluster_risk=None):
-    ''' Save mediated PAF at cause level.
+def agg_paf_outpath(version, acause, date, cluster_risk=None):
+    ''' Return the path of the mediated PAF of acause, with the extension
+        of PAF_STORAGE_BACKEND.
 
         Parameters
         ----------
-        paf: dataframe of PAF.
         version: 'past' or 'forecast'.
         cluster_risk: if none, it will be just risk.
     '''
@@ -310,50 +523,250 @@ def save_paf(paf, version, acause, date, cluster_risk=None):
         else:
             outpath = os.path.join(OUTDIR_AGG_PAF_FORECAST.format(d=date),
                                    '{}.h5'.format(acause))
+    return storage_path(outpath)
+
+
+def save_paf(paf, version, acause, date, cluster_risk=None):
+    ''' Save mediated PAF at cause level.
 
+        Parameters
+        ----------
+        paf: dataframe of PAF.
+        version: 'past' or 'forecast'.
+        cluster_risk: if none, it will be just risk.
+    '''
+    outpath = agg_paf_outpath(version, acause, date, cluster_risk)
     if not os.path.exists(os.path.dirname(outpath)):
         os.makedirs(os.path.dirname(outpath))
 
     logger.info("Saving some pafs: {}".format(outpath))
-    dataframe_to_hdf(paf, outpath, DEMOGRAPHY_COLS)
+    get_storage().write(paf, outpath, DEMOGRAPHY_COLS)
+
+
+def _netcdf_path(path):
+    return os.path.splitext(path)[0] + '.nc'
+
+
+def _paf_dataframe_to_xr(paf):
+    ''' Convert a wide dataframe of PAF to a DataArray with a draw dim. '''
+    draws = paf.set_index(DEMOGRAPHY_COLS)[PAF_COLS]
+    draws.columns = pd.Index(range(len(PAF_COLS)), name='draw')
+    return xr.DataArray.from_series(draws.stack()).rename('value')
+
+
+def read_paf_xr(acause, risk, version, date, years):
+    """
+    Read past or forecast PAF saved by calculate_pafs in xarray mode.
+
+    Vaccine PAFs only exist as HDF and are converted after reading.
+
+    Args:
+        acause (str): cause name.
+        risk (str): risk name.
+        version (str): "past" or "forecast".
+        date (str): date str indiciating folder where data comes from.
+        years (list[int]): three years for past start, forecast start, and
+            forecast end.
+
+    Returns
+        paf (xarray.DataArray): PAF bounded like bound_zero_one, None if it
+            can't be read.
+    """
+    if risk in VACCINE_RISKS:
+        paf = read_paf(acause, risk, version, date, years)
+        return _paf_dataframe_to_xr(paf) if len(paf) else None
+
+    infile = _netcdf_path(paf_inpath(acause, risk, version, date))
+    if not os.path.exists(infile):
+        logger.error("{}, {} Error: "
+                     "read_paf_xr broken, {} doesn't exist".format(
+                         acause, risk, infile))
+        return None
+
+    with xr.open_dataarray(infile) as paf:
+        paf = paf.loc[{'year_id': paf['year_id'] >= years[0]}].load()
+    paf = paf.fillna(0)
+    return paf.where(paf != 1, 0.9999)
+
+
+def product_of_mediated_pafs_xr(mediated_pafs):
+    ''' Aggregate PAF DataArrays as 1 - prod(1 - mediation_prod * paf).
+
+        Only demographies present in every PAF are kept.
+
+        Parameters
+        ----------
+        mediated_pafs: iterable of (DataArray of PAF, float mediation_prod).
+
+        Returns
+        ----------
+        paf_aggregated: DataArray of aggregated PAF, None if there are no
+                        PAFs.
+    '''
+    paf_prod = None
+    for paf, mediation_prod in mediated_pafs:
+        if paf_prod is None:
+            paf_prod = 1 - paf * mediation_prod
+            continue
+        paf_prod, paf = xr.align(paf_prod, paf, join='inner')
+        paf_prod = paf_prod * (1 - paf * mediation_prod)
+
+    if paf_prod is None:
+        return None
+    return 1 - paf_prod
+
+
+def aggregate_paf_xr(acause, cause_risks, version, date, years,
+                     cluster_risk=None):
+    ''' Aggregate PAFs through mediation, keeping them as DataArrays.
+
+        Same steps as aggregate_paf, and the result is saved as netCDF.
+
+        Returns:
+            paf_mediated (xarray.DataArray): aggregated PAF, None if no risk
+                has PAF.
+    '''
+    logger.info('Start aggregating {} PAF:'.format(version))
+    mediation_prods = get_mediation_index().products(acause, cause_risks)
+    mediated_pafs = _iter_mediated_pafs(acause, cause_risks, version, date,
+                                        years, get_paf_set_one(),
+                                        mediation_prods, reader=read_paf_xr)
+    paf_aggregated = product_of_mediated_pafs_xr(mediated_pafs)
+    if paf_aggregated is None:
+        logger.error('No risks available for {}'.format(acause))
+        return None
+
+    # Cap PAF at 0.9999, then scale like scale_paf. Demographies missing
+    # from a PAF are NaN, like the rows the dataframe path drops, and stay
+    # NaN.
+    paf_mediated = xr.where(paf_aggregated > 0.9999, 0.9999, paf_aggregated)
+    max_paf = float(paf_mediated.max())
+    if max_paf > 0.95:
+        paf_mediated = paf_mediated * (0.95 / max_paf)
+    paf_mediated.name = 'value'
+
+    outpath = _netcdf_path(agg_paf_outpath(version, acause, date,
+                                           cluster_risk))
+    if not os.path.exists(os.path.dirname(outpath)):
+        os.makedirs(os.path.dirname(outpath))
+    logger.info("Saving some pafs: {}".format(outpath))
+    paf_mediated.to_netcdf(outpath)
+    return paf_mediated
 
 
-def main(acause, date, years=None, update_past=True):
+def generate_scalars_from_aggregated_paf_xr(paf):
+    ''' Calculate scalars from an aggregated PAF DataArray.
+
+        The result only keeps the labels of DEMOGRAPHY_INDICES, like
+        subset_and_index does in the dataframe path.
+    '''
+    scalar = 1 / (1 - paf)
+    keep = {}
+    for dim, labels in DEMOGRAPHY_INDICES.items():
+        present = set(scalar[dim].values)
+        keep[dim] = [label for label in labels if label in present]
+    scalar = scalar.loc[keep]
+    scalar.name = 'value'
+    return scalar
+
+
+def aggregate_signature(acause, risks, version, date, years,
+                        use_xarray=False):
+    ''' Return the manifest signature of the PAF of acause aggregated over
+        risks, which is also that of the scalars made from it.
+
+        Parameters
+        ----------
+        use_xarray: whether the netCDF PAFs of calculate_pafs --xarray are
+            read.
+    '''
+    inputs = {'mediation': INPATH_MEDIATION,
+              'paf_set_one': INPATH_PAF_SET_ONE}
+    for risk in risks:
+        inpath = paf_inpath(acause, risk, version, date)
+        if use_xarray and risk not in VACCINE_RISKS:
+            inpath = _netcdf_path(inpath)
+        inputs['paf_{}'.format(risk)] = inpath
+    params = {'draws': len(PAF_COLS), 'years': list(years)}
+    return input_signature(inputs, params)
+
+
+def load_reference_data(acauses):
+    """
+    Load the reference data shared by every cause of a run.
+
+    The risk table and its RiskHierarchy, the cause-risk pairs, the
+    mediation index and the paf_set_one list are read once here instead of
+    once per cause.
+
+    Args:
+        acauses (list[str]): causes of the run.
+
+    Returns:
+        dict: with keys "risk_table", "id_risk", "risk_hierarchy" and
+            "cause_risks", the latter mapping each acause to its related
+            risks.
+    """
+    risk_table = read_risk_table_from_db()
+    get_mediation_index()
+    get_paf_set_one()
+    id_risk = get_id_risk(risk_table)
+    return {'risk_table': risk_table,
+            'id_risk': id_risk,
+            'risk_hierarchy': RiskHierarchy(risk_table, id_risk),
+            'cause_risks': {acause: get_acause_related_risks(acause)
+                            for acause in acauses}}
+
+
+def main(acause, date, years=None, update_past=False, reference=None,
+         use_xarray=False, force=False):
     """
     The mother function that runs scalars calculations
 
+    Aggregated PAFs and scalars are only recalculated if the PAFs, the
+    mediation table or the parameters of the run they were made from
+    changed, or if they are missing, see manifest.py. Scalars are
+    recalculated along with the PAF of all risks they come from.
+
     Args:
         acause (str): cause to compute scalars for
         date (str): date string pointing to folder to pull data from
         years (list[int]): three years for past start, forecast start, and
             forecast end.
-        update_past (boolean): whether to update past scalars by overwriting.
+        update_past (boolean): whether to recalculate past scalars even if
+            they are up to date.
+        reference (dict): output of load_reference_data covering acause.
+            Loaded for acause alone if None.
+        use_xarray (bool): read the netCDF PAFs of calculate_pafs --xarray
+            and keep PAFs and scalars as DataArrays throughout.
+        force (bool): recalculate every aggregated PAF and scalar, even
+            those up to date.
     """
+    aggregate = aggregate_paf_xr if use_xarray else aggregate_paf
     years = years or DEFAULT_YEARS
-    risk_table = read_risk_table_from_db()
-    id_risk = get_id_risk(risk_table)
+    reference = reference or load_reference_data([acause])
+    risk_hierarchy = reference['risk_hierarchy']
+    cause_risks = reference['cause_risks'][acause]
     lst_scalar = []
     for version in ['past', 'forecast']:
         logger.info("OH BOY WE'RE DOING THE: {}".format(version))
         if version == 'past':
             outpath_scalar = os.path.join(OUTDIR_SCALAR_PAST,
                                           '{}.nc'.format(acause))
-            # We only need to calculate past scalars once.
-            if os.path.exists(outpath_scalar) and not update_past:
-                scalar = xr.open_dataset(outpath_scalar)
-                # we just want the past here:
-                scalar = scalar.loc[{'year_id': range(years[0], years[1])}]
-                lst_scalar.append(scalar)
-                continue
+            year_ids = range(years[0], years[1])
         elif version == 'forecast':
             outpath_scalar =\
                 os.path.join(OUTDIR_SCALAR_FORECAST.format(d=date),
                              '{}.nc'.format(acause))
+            year_ids = range(years[1], years[2]+1)
+
+        signature = aggregate_signature(acause, cause_risks, version, date,
+                                        years, use_xarray)
+        recalculate = force or (version == 'past' and update_past)
 
-        cause_risks = get_acause_related_risks(acause)
         # Aggregate PAF for level-1 cluster risks
         # We don't need to use the PAF for scalar.
-        risk_lst = get_cluster_risks(cause_risks, id_risk, risk_table)
+        risk_lst = risk_hierarchy.cluster_risks(cause_risks)
 
         for key in risk_lst.keys():
             logger.info("In the middle of a for-loop.")
@@ -362,38 +775,61 @@ def main(acause, date, years=None, update_past=True):
             if len(subrisks) == 1 and subrisks[0] == key:
                 continue
 
+            cluster_signature = aggregate_signature(acause, subrisks,
+                                                    version, date, years,
+                                                    use_xarray)
+            outpath_cluster = agg_paf_outpath(version, acause, date,
+                                              cluster_risk=key)
+            if use_xarray:
+                outpath_cluster = _netcdf_path(outpath_cluster)
+            if not recalculate and is_up_to_date(outpath_cluster,
+                                                 cluster_signature):
+                continue
+
             logger.info('Start aggregating cluster risk: {}'.format(key))
-            _ = aggregate_paf(acause, subrisks, version, date, years,
-                              cluster_risk=key)
+            paf_cluster = aggregate(acause, subrisks, version, date, years,
+                                    cluster_risk=key)
+            if paf_cluster is not None and len(paf_cluster):
+                record_signature(outpath_cluster, cluster_signature)
+
+        # Scalars are only up to date along with the PAF they come from.
+        outpath_paf = agg_paf_outpath(version, acause, date)
+        if use_xarray:
+            outpath_paf = _netcdf_path(outpath_paf)
+        if not recalculate and is_up_to_date(outpath_paf, signature) and \
+                is_up_to_date(outpath_scalar, signature):
+            scalar = xr.open_dataset(outpath_scalar)
+            lst_scalar.append(scalar.loc[{'year_id': year_ids}])
+            continue
 
         # Aggregate PAF for all risks.
         # We need to use the PAF for scalar.
-        paf_mediated = aggregate_paf(acause, cause_risks, version, date, years)
-        if len(paf_mediated) == 0:
+        paf_mediated = aggregate(acause, cause_risks, version, date, years)
+        if paf_mediated is None or len(paf_mediated) == 0:
             logger.info("No paf_mediated. Early return.")
             return
+        record_signature(outpath_paf, signature)
 
-        scalar_df = generate_scalars_from_aggregated_paf(paf_mediated)
-        # now convert df to xr and save as .nc
         if not os.path.exists(os.path.dirname(outpath_scalar)):
             os.makedirs(os.path.dirname(outpath_scalar))
-        # TODO could we deprecate subset_and_index, given the latest df_to_xr?
-        subset_df = subset_and_index(scalar_df, index_columns=DEMOGRAPHY_COLS,
-                                     index_vals_to_keep=DEMOGRAPHY_INDICES,
-                                     draw_prefix='scalar_')
-        subset_df.rename({'value': acause}, inplace=True)
-        xr_scalar = df_to_xr(subset_df)
+        if use_xarray:
+            xr_scalar = generate_scalars_from_aggregated_paf_xr(paf_mediated)
+        else:
+            scalar_df = generate_scalars_from_aggregated_paf(paf_mediated)
+            # now convert df to xr and save as .nc
+            # TODO could we deprecate subset_and_index, given the latest
+            # df_to_xr?
+            subset_df = subset_and_index(scalar_df,
+                                         index_columns=DEMOGRAPHY_COLS,
+                                         index_vals_to_keep=DEMOGRAPHY_INDICES,
+                                         draw_prefix='scalar_')
+            subset_df.rename({'value': acause}, inplace=True)
+            xr_scalar = df_to_xr(subset_df)
         xr_scalar.to_netcdf(outpath_scalar)
+        record_signature(outpath_scalar, signature)
 
-        # We just want the future here for forecast data:
-        if version == 'forecast':
-            xr_scalar = xr_scalar.loc[{'year_id': range(years[1], years[2]+1)}]
-        elif version == 'past':
-            xr_scalar = xr_scalar.loc[{"year_id": range(years[0], years[1])}]
-        else:
-            raise Exception(
-                    "Version is {}. Can only be 'forecast' or 'past'".format(
-                        version))
+        # We just want the years of version here:
+        xr_scalar = xr_scalar.loc[{'year_id': year_ids}]
         lst_scalar.append(xr_scalar.to_dataset())
 
     logger.info("A big thing: {}".format(lst_scalar))
@@ -420,10 +856,84 @@ def main(acause, date, years=None, update_past=True):
                  start_age_group_id=10, end_age_group_id=22)
 
 
+_REFERENCE = None
+
+
+def _init_batch_worker(reference):
+    global _REFERENCE
+    _REFERENCE = reference
+
+
+def _run_batch_cause(args):
+    """Run main for one cause of a batch and report whether it failed."""
+    acause, date, years, update_past, use_xarray, force = args
+    try:
+        main(acause, date, years=years, update_past=update_past,
+             reference=_REFERENCE, use_xarray=use_xarray, force=force)
+    except Exception:
+        logger.exception("{} Error: scalars broken".format(acause))
+        return acause, False
+    return acause, True
+
+
+def main_batch(acauses, date, years=None, update_past=False, workers=None,
+               use_xarray=False, force=False):
+    """
+    Run scalars calculations for several causes over a process pool.
+
+    Reference data is loaded once in the parent process and handed to the
+    workers, which inherit it on fork instead of querying it again.
+
+    Args:
+        acauses (list[str]): causes to compute scalars for.
+        date (str): date string pointing to folder to pull data from
+        years (list[int]): three years for past start, forecast start, and
+            forecast end.
+        update_past (boolean): passed on to main.
+        workers (int): number of processes, defaults to the number of CPUs.
+        use_xarray (bool): passed on to main.
+        force (bool): passed on to main.
+
+    Returns:
+        list[str]: causes that failed.
+    """
+    years = years or DEFAULT_YEARS
+    reference = load_reference_data(acauses)
+    tasks = [(acause, date, years, update_past, use_xarray, force)
+             for acause in acauses]
+
+    pool = multiprocessing.Pool(workers, initializer=_init_batch_worker,
+                                initargs=(reference,))
+    try:
+        results = list(pool.imap_unordered(_run_batch_cause, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [acause for acause, succeeded in results if not succeeded]
+    if failed:
+        logger.error("Scalars failed for: {}".format(failed))
+    return failed
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Calculate Scalars")
-    parser.add_argument("--acause", type=str, required=True,
+    causes = parser.add_mutually_exclusive_group(required=True)
+    causes.add_argument("--acause", type=str,
                         help="It's `A Cause', get it?")
+    causes.add_argument("--acauses", type=str, nargs="+",
+                        help="Causes to run in one batch over a process pool.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes for --acauses.")
+    parser.add_argument("--xarray", action="store_true",
+                        help="Read netCDF PAFs of calculate_pafs --xarray "
+                             "and stay in xarray.")
+    parser.add_argument("--update-past", action="store_true",
+                        help="Recompute past scalars even if their inputs "
+                             "are unchanged.")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute all scalars even if their inputs "
+                             "are unchanged.")
     parser.add_argument("--date", type=str, required=True,
                         help="String denoting file directory. Ex: 2015_03_21")
     parser.add_arg_years()
@@ -439,16 +949,17 @@ if __name__ == '__main__':
                    for i in range(NUMBER_OF_DRAWS)]
     PAF_COLS = [PAF_DRAW_PREFIX + '{}'.format(i)
                 for i in range(NUMBER_OF_DRAWS)]
-    PAF_X_COLS = [PAF_DRAW_PREFIX + '{}_x'.format(i)
-                  for i in range(NUMBER_OF_DRAWS)]
-    PAF_Y_COLS = [PAF_DRAW_PREFIX + '{}_y'.format(i)
-                  for i in range(NUMBER_OF_DRAWS)]
 
     logging.basicConfig(level=logging.INFO)
     logger.debug("Arguments {}".format(args))
 
-    to_update_past = True  # O M G
-
-    main(args.acause, args.date, years=year_args, update_past=to_update_past)
+    if args.acauses:
+        main_batch(args.acauses, args.date, years=year_args,
+                   update_past=args.update_past, workers=args.workers,
+                   use_xarray=args.xarray, force=args.force)
+    else:
+        main(args.acause, args.date, years=year_args,
+             update_past=args.update_past, use_xarray=args.xarray,
+             force=args.force)
 
     logger.debug("Exit from script")
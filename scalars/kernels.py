@@ -0,0 +1,113 @@
+"""
+Element-wise kernels of the PAF and scalar transforms on draw matrices.
+
+Each transform is one pass writing into a single output array, which can be
+the input itself, instead of a chain of NumPy operations each allocating a
+full-size temporary. They are NumPy in place operations, or numexpr
+expressions if KERNEL_BACKEND is "numexpr".
+"""
+import logging
+
+import numpy as np
+
+from settings import DRAW_DTYPE, KERNEL_BACKEND
+
+if KERNEL_BACKEND == 'numexpr':
+    import numexpr as ne
+elif KERNEL_BACKEND == 'numpy':
+    ne = None
+else:
+    raise ValueError("Kernel backend should be one of ['numexpr', "
+                     "'numpy'].")
+
+
+__modname__ = "fbd_research.scalars.kernels"
+logger = logging.getLogger(__modname__)
+
+
+def as_draws(values, dtype=DRAW_DTYPE):
+    ''' Return values as a writable array of dtype, without copying if it
+        already is one.
+    '''
+    values = np.asarray(values, dtype=dtype)
+    if not values.flags.writeable:
+        values = values.copy()
+    return values
+
+
+def _out(values, out):
+    return np.empty_like(values) if out is None else out
+
+
+def paf_scalar(sev, rr_max, out=None):
+    ''' Return sev * (rr_max - 1) + 1.
+
+        Parameters
+        ----------
+        sev: array of SEV draws.
+        rr_max: array of rrmax draws of the same shape.
+        out: array to write the result to, a new one if None.
+    '''
+    if ne is not None:
+        return ne.evaluate('sev * (rr_max - 1) + 1', out=out,
+                           casting='same_kind')
+    out = np.subtract(rr_max, 1, out=out)
+    out *= sev
+    out += 1
+    return out
+
+
+def paf_from_scalar(scalar, out=None):
+    ''' Return 1 - 1 / scalar, in place if out is scalar. '''
+    if ne is not None:
+        return ne.evaluate('1 - 1 / scalar', out=out, casting='same_kind')
+    out = np.reciprocal(scalar, out=_out(scalar, out))
+    return np.subtract(1, out, out=out)
+
+
+def scalar_from_paf(paf, out=None):
+    ''' Return 1 / (1 - paf), in place if out is paf. '''
+    if ne is not None:
+        return ne.evaluate('1 / (1 - paf)', out=out, casting='same_kind')
+    out = np.subtract(1, paf, out=_out(paf, out))
+    return np.reciprocal(out, out=out)
+
+
+def replace_ones(values, replacement=0.9999):
+    ''' Replace PAFs of exactly 1 in values, in place. '''
+    if ne is not None:
+        return ne.evaluate('where(values == 1, replacement, values)',
+                           out=values, casting='same_kind')
+    np.copyto(values, replacement, where=values == 1)
+    return values
+
+
+def cap(values, upper):
+    ''' Cap values at upper, in place, keeping NaNs.
+
+        Returns
+        ----------
+        capped: bool, whether any value was over upper.
+    '''
+    with np.errstate(invalid='ignore'):
+        capped = bool((values > upper).any())
+    if capped:
+        np.minimum(values, upper, out=values)
+    return capped
+
+
+def scale_to_max(values, max_value):
+    ''' Scale values in place so that their maximum is max_value, if over.
+
+        Like np.max, a NaN anywhere leaves values as they are.
+
+        Returns
+        ----------
+        scale: float, the factor values were multiplied by.
+    '''
+    maximum = np.max(values)
+    if maximum > max_value:
+        scale = max_value / maximum
+        values *= scale
+        return scale
+    return 1.
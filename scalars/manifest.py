@@ -0,0 +1,170 @@
+"""
+Manifests recording what each output of the scalars pipeline was computed
+from, so that reruns only recompute outputs whose inputs changed.
+
+Every output gets a sidecar JSON file next to it holding the size, mtime
+and content hash of each input file plus the run parameters (number of
+draws, years, ...). An output is up to date when it exists and its sidecar
+matches the current inputs and parameters.
+
+Checking whether an output is up to date only stats its inputs. An input
+whose size or mtime differs from the sidecar is hashed, and still counts
+as unchanged if its content hash is the recorded one, so a copy of an
+unchanged SEV file under a new date folder doesn't trigger a recompute.
+Inputs are otherwise only hashed when an output is recorded, right after
+being recomputed from them.
+"""
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+
+__modname__ = "fbd_research.scalars.manifest"
+logger = logging.getLogger(__modname__)
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+# Hashes of files already hashed by this process, keyed by
+# (path, size, mtime) of every file hashed.
+_HASHES = {}
+
+
+def _files(path):
+    ''' Return the sorted paths of the files under path, or path itself. '''
+    if not os.path.isdir(path):
+        return [path]
+    paths = []
+    for dirpath, _, filenames in os.walk(path):
+        paths.extend(os.path.join(dirpath, name) for name in filenames)
+    return sorted(paths)
+
+
+def file_stats(path):
+    ''' Return [name, size, mtime] of path, or of every file under it if it
+        is a directory, None if it doesn't exist.
+    '''
+    try:
+        paths = _files(path)
+        stats = [os.stat(p) for p in paths]
+    except OSError:
+        return None
+    return [[os.path.relpath(p, path), stat.st_size, stat.st_mtime]
+            for p, stat in zip(paths, stats)]
+
+
+def file_hash(path, block_size=2 ** 24):
+    ''' Return the sha1 of the contents of path, None if it doesn't exist.
+
+        Directories, like the npy and zarr PAF stores, are hashed over the
+        names and contents of all the files under them.
+    '''
+    stats = file_stats(path)
+    if stats is None:
+        return None
+    key = (path,) + tuple(tuple(stat) for stat in stats)
+    if key not in _HASHES:
+        sha1 = hashlib.sha1()
+        for name, _, _ in stats:
+            sha1.update(name.encode('utf-8'))
+            with open(os.path.normpath(os.path.join(path, name)), 'rb') as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    sha1.update(block)
+        _HASHES[key] = sha1.hexdigest()
+    return _HASHES[key]
+
+
+def input_signature(inputs, params=None):
+    ''' Return the signature of inputs and params, without reading inputs.
+
+        Parameters
+        ----------
+        inputs: dict of input name to file path.
+        params: dict of JSON-serializable run parameters.
+
+        Returns
+        ----------
+        signature: dict with the path and file_stats of every input and
+            params.
+    '''
+    return {'inputs': {name: {'path': path, 'stats': file_stats(path)}
+                       for name, path in inputs.items()},
+            'params': params or {}}
+
+
+def _manifest_path(outpath):
+    return outpath + MANIFEST_SUFFIX
+
+
+def _read_manifest(outpath):
+    try:
+        with open(_manifest_path(outpath)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_manifest(outpath, manifest):
+    manifest_path = _manifest_path(outpath)
+    tmp_path = '{}.{}.tmp'.format(manifest_path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, manifest_path)
+
+
+def is_up_to_date(outpath, signature):
+    ''' Return whether outpath exists and was made from signature.
+
+        Only inputs whose size or mtime changed since outpath was recorded
+        are hashed. If their contents didn't change either, the sidecar is
+        updated with their new size and mtime so they aren't hashed again.
+    '''
+    if not os.path.exists(outpath):
+        return False
+    recorded = _read_manifest(outpath)
+    # Round trip through JSON so that e.g. tuples compare equal to lists.
+    signature = json.loads(json.dumps(signature))
+    if not isinstance(recorded, dict) or \
+            recorded.get('params') != signature['params']:
+        return False
+    recorded_inputs = recorded.get('inputs')
+    if not isinstance(recorded_inputs, dict) or \
+            set(recorded_inputs) != set(signature['inputs']):
+        return False
+
+    restat = False
+    for name, current in signature['inputs'].items():
+        entry = recorded_inputs[name]
+        if not isinstance(entry, dict) or current['stats'] is None:
+            return False
+        if entry.get('stats') == current['stats']:
+            continue
+        sha1 = entry.get('sha1')
+        if sha1 is None or file_hash(current['path']) != sha1:
+            return False
+        entry['stats'] = current['stats']
+        restat = True
+
+    if restat:
+        _write_manifest(outpath, recorded)
+    logger.info("{} is up to date".format(outpath))
+    return True
+
+
+def record_signature(outpath, signature):
+    ''' Record that outpath was just made from signature, hashing its
+        inputs.
+
+        Pass the signature taken before reading the inputs. An input that
+        changed since gets no hash, so the next run recomputes outpath.
+    '''
+    inputs = {}
+    for name, current in signature['inputs'].items():
+        path = current['path']
+        unchanged = current['stats'] is not None and \
+            file_stats(path) == json.loads(json.dumps(current['stats']))
+        inputs[name] = dict(current,
+                            sha1=file_hash(path) if unchanged else None)
+    _write_manifest(outpath, {'inputs': inputs,
+                              'params': signature['params']})
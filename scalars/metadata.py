@@ -0,0 +1,137 @@
+"""
+Process-wide cache of the metadata queried from the database.
+
+Ages, modeled locations, GBD demographics and cause-risk pairs are queried
+once per process and kept for METADATA_CACHE_TTL seconds, or until
+METADATA_VERSION changes.
+If METADATA_SNAPSHOT_DIR is set, every query is also saved there, and later
+processes load the snapshot instead of querying as long as it's fresh.
+
+The returned dataframes are shared, so don't modify them.
+"""
+import logging
+import os
+import pickle
+import time
+import uuid
+
+from fbd_core.db import get_ages as _query_ages
+from fbd_core.db import get_cause_risk_pairs as _query_cause_risk_pairs
+from fbd_core.db import get_modeled_locations as _query_modeled_locations
+from fbd_core.demog.construct import \
+    get_gbd_demographics as _query_gbd_demographics
+
+from settings import (METADATA_CACHE_TTL, METADATA_SNAPSHOT_DIR,
+                      METADATA_VERSION)
+
+
+__modname__ = "fbd_research.scalars.metadata"
+logger = logging.getLogger(__modname__)
+
+QUERIES = {'ages': _query_ages,
+           'cause_risk_pairs': _query_cause_risk_pairs,
+           'modeled_locations': _query_modeled_locations,
+           'gbd_demographics': _query_gbd_demographics}
+
+# name: (time loaded, version, dataframe)
+_METADATA = {}
+
+
+def _snapshot_path(name, version, snapshot_dir):
+    return os.path.join(snapshot_dir, '{}_{}.pkl'.format(name, version))
+
+
+def _read_snapshot(path, ttl):
+    ''' Return the dataframe in the snapshot at path if fresh, else None. '''
+    try:
+        if time.time() - os.path.getmtime(path) >= ttl:
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _write_snapshot(path, df):
+    ''' Snapshot df at path. Failing to write only logs a warning. '''
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(df, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        logger.warning("Could not snapshot {}".format(path))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_metadata(name, version=METADATA_VERSION, ttl=METADATA_CACHE_TTL,
+                 snapshot_dir=METADATA_SNAPSHOT_DIR):
+    ''' Return the metadata of name, querying it only if not cached.
+
+        Parameters
+        ----------
+        name: str, one of QUERIES.
+        version: anything identifying the metadata, e.g. the GBD round.
+            Cached metadata of another version is queried again.
+        ttl: float, seconds cached metadata and snapshots stay fresh.
+        snapshot_dir: str, directory of snapshots, None for no snapshots.
+
+        Returns
+        ----------
+        df: dataframe of the metadata.
+    '''
+    now = time.time()
+    entry = _METADATA.get(name)
+    if entry is not None:
+        loaded_at, cached_version, df = entry
+        if cached_version == version and now - loaded_at < ttl:
+            return df
+
+    df = None
+    if snapshot_dir is not None:
+        path = _snapshot_path(name, version, snapshot_dir)
+        df = _read_snapshot(path, ttl)
+    if df is None:
+        logger.info("Querying {}".format(name))
+        df = QUERIES[name]()
+        if snapshot_dir is not None:
+            _write_snapshot(path, df)
+
+    _METADATA[name] = (now, version, df)
+    return df
+
+
+def clear_metadata():
+    ''' Forget the metadata cached by this process. '''
+    _METADATA.clear()
+
+
+def get_ages():
+    return get_metadata('ages')
+
+
+def get_modeled_locations():
+    return get_metadata('modeled_locations')
+
+
+def get_gbd_demographics():
+    return get_metadata('gbd_demographics')
+
+
+def get_cause_risk_pairs():
+    return get_metadata('cause_risk_pairs')
+
+
+def age_group_names():
+    ''' Return a dict of age_group_id to age_group_name. '''
+    return get_ages().set_index('age_group_id')['age_group_name'].to_dict()
+
+
+def location_names():
+    ''' Return a dict of location_id to location_name of modeled locations.
+    '''
+    return get_modeled_locations().\
+        set_index('location_id')['location_name'].to_dict()
@@ -2,12 +2,13 @@
 A module that stores all the scalars-related plotting tools.
 """
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
 
 import numpy as np
-
-from fbd_core.db import get_ages, get_modeled_locations
-from fbd_core.demog.construct import get_gbd_demographics
+import xarray as xr
 
 import matplotlib as mpl
 mpl.use('Agg')
@@ -16,6 +17,16 @@ import matplotlib.gridspec as gridspec
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
 
+from metadata import age_group_names, get_gbd_demographics, location_names
+
+try:
+    from PyPDF2 import PdfMerger
+except ImportError:
+    try:
+        from PyPDF2 import PdfFileMerger as PdfMerger
+    except ImportError:
+        PdfMerger = None
+
 
 __modname__ = "fbd_research.scalars.plot_tools"
 logger = logging.getLogger(__modname__)
@@ -23,9 +34,197 @@ logger = logging.getLogger(__modname__)
 
 # TODO this needs to be refactored, and possibly moved to fbd_core
 
+# Renders a page in the workers of render_pdf, with its keyword arguments,
+# see _init_page_worker.
+_RENDER_PAGE = None
+_RENDER_KWARGS = None
+
+
+def summarize_draws(values, lower=2.5, upper=97.5):
+    ''' Return the mean and the lower and upper percentiles of values over
+        the last axis. Both percentiles come from one partition of the
+        draws, and NaNs are skipped like xarray does.
+
+        Parameters
+        ----------
+        values: array with draws on the last axis.
+        lower: float, percentile of the lower bound.
+        upper: float, percentile of the upper bound.
+
+        Returns
+        ----------
+        mean, lower, upper: arrays over the other axes.
+    '''
+    if np.isnan(values).any():
+        mean = np.nanmean(values, axis=-1)
+        bounds = np.nanpercentile(values, [lower, upper], axis=-1)
+    else:
+        mean = values.mean(axis=-1)
+        bounds = np.percentile(values, [lower, upper], axis=-1)
+    return mean, bounds[0], bounds[1]
+
+
+def summarize_dataset(ds, selection, var='value'):
+    ''' Summarize the draws of ds[var] at selection.
+
+        Parameters
+        ----------
+        ds: xarray.Dataset with a draw dim.
+        selection: dict of dim to label, the slice to summarize.
+        var: str, data variable to summarize.
+
+        Returns
+        ----------
+        summary: xarray.Dataset of mean, lower and upper over the dims left.
+    '''
+    da = ds[var].loc[selection]
+    dims = [dim for dim in da.dims if dim != 'draw']
+    da = da.transpose(*(dims + ['draw']))
+    stats = summarize_draws(da.values)
+    return xr.Dataset({name: (dims, values) for name, values in
+                       zip(['mean', 'lower', 'upper'], stats)},
+                      coords={dim: da[dim].values for dim in dims})
+
+
+def summarize_dataframe(df, draw_cols, selection):
+    ''' Summarize the draws of the rows of df at selection.
+
+        Parameters
+        ----------
+        df: dataframe with draw_cols.
+        draw_cols: list of draw columns.
+        selection: dict of column to value, the rows to summarize.
+
+        Returns
+        ----------
+        summary: dataframe of the other columns of the rows, with mean,
+            lower and upper instead of draw_cols.
+    '''
+    mask = np.ones(len(df), dtype=bool)
+    for col, value in selection.items():
+        mask &= (df[col] == value).values
+    rows = df.loc[mask]
+    summary = rows.drop(draw_cols, axis=1)
+    stats = summarize_draws(rows[draw_cols].values)
+    for name, values in zip(['mean', 'lower', 'upper'], stats):
+        summary[name] = values
+    return summary
+
+
+def _init_page_worker(render_page, render_kwargs):
+    global _RENDER_PAGE, _RENDER_KWARGS
+    _RENDER_PAGE = render_page
+    _RENDER_KWARGS = render_kwargs
+
+
+def _save_page(task):
+    ''' Render one page to its own PDF file and close its figure. '''
+    page, path, savefig_kwargs = task
+    fig = _RENDER_PAGE(*page, **_RENDER_KWARGS)
+    try:
+        fig.savefig(path, format='pdf', **savefig_kwargs)
+    finally:
+        plt.close(fig)
+    return path
+
+
+def render_pdf(outfile, render_page, pages, workers=1, render_kwargs=None,
+               **savefig_kwargs):
+    ''' Save the figure render_page(*page, **render_kwargs) of every page
+        of pages, in order, as the pages of the PDF outfile.
+
+        With workers > 1, pages are rendered by a pool of processes into
+        single-page PDFs that are then merged, which requires PyPDF2.
+        Without it, pages are rendered serially. render_page and
+        render_kwargs are pickled to every worker once, so render_page has
+        to be a module-level function, and each page only to the worker
+        rendering it, so data specific to a page belongs in the page. Every
+        figure is closed as soon as it is saved, so memory doesn't grow with
+        the pages.
+
+        Parameters
+        ----------
+        outfile: str, path of the PDF.
+        render_page: module-level function of the arguments of a page and
+            render_kwargs returning a matplotlib Figure.
+        pages: tuples of the arguments of render_page of each page, e.g. a
+            location id and the data of that location.
+        workers: int, number of processes, all CPUs if None.
+        render_kwargs: dict of picklable keyword arguments of render_page.
+        savefig_kwargs: passed on to savefig.
+    '''
+    render_kwargs = render_kwargs or {}
+    pages = list(pages)
+    parallel = workers != 1 and len(pages) > 1
+    if parallel and PdfMerger is None:
+        logger.warning("PyPDF2 is not installed, rendering pages serially.")
+        parallel = False
+
+    if not parallel:
+        with PdfPages(outfile) as pp:
+            for page in pages:
+                fig = render_page(*page, **render_kwargs)
+                try:
+                    pp.savefig(fig, **savefig_kwargs)
+                finally:
+                    plt.close(fig)
+        return
+
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(outfile))
+    try:
+        tasks = [(page, os.path.join(tmpdir, '{:06d}.pdf'.format(ix)),
+                  savefig_kwargs) for ix, page in enumerate(pages)]
+        pool = multiprocessing.Pool(workers, initializer=_init_page_worker,
+                                    initargs=(render_page, render_kwargs))
+        try:
+            paths = pool.map(_save_page, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        merger = PdfMerger()
+        for path in paths:
+            merger.append(path)
+        merger.write(outfile)
+        merger.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _render_scalars_page(location_id, scalar_ds, acause, sex_id, scenario,
+                         start_age_group_id, end_age_group_id, age_map,
+                         location_map):
+    ''' Return the page of location_id of plot_scalars. '''
+    loc_ds = summarize_dataset(scalar_ds, {'scenario': scenario,
+                                           'sex_id': sex_id,
+                                           'location_id': location_id})
+    nrow = 4
+    ncol = 3
+    fig = plt.figure(figsize=(12, 10))
+    grid = gridspec.GridSpec(nrow, ncol)
+
+    for ix, age_group_id in enumerate(xrange(start_age_group_id,
+                                             end_age_group_id)):
+        ax = fig.add_subplot(grid[ix])
+        age_ds = loc_ds.loc[{"age_group_id": age_group_id}]
+        ax.plot(age_ds['year_id'], age_ds['mean'])
+        ax.fill_between(age_ds['year_id'], age_ds['lower'],
+                        age_ds['upper'])
+        ax.text(0.7, 0.95, age_map[age_group_id],
+                verticalalignment='top',
+                horizontalalignment='left', transform=ax.transAxes,
+                color='black', fontsize=12)
+
+    location = location_map[location_id]
+    suptitle = "{location}, {acause}; Scenario: {scenario}".format(
+                location=location, acause=acause, scenario=scenario)
+    fig.suptitle(suptitle, fontsize=15)
+    return fig
+
 
 def plot_scalars(scalar_ds, acause, sex_id, location_ids, scenario, date,
-                 outdir, start_age_group_id=10, end_age_group_id=22):
+                 outdir, start_age_group_id=10, end_age_group_id=22,
+                 workers=1):
     ''' Plot scalars with uncertainties.
 
         Parameters
@@ -39,64 +238,67 @@ def plot_scalars(scalar_ds, acause, sex_id, location_ids, scenario, date,
         outdir: output directory
         start_age_group_id: int, default 10
         end_age_group_id: int, default 22
+        workers: int, number of processes rendering pages, see render_pdf.
     '''
     outfile = os.path.join(outdir.format(d=date),
                            '{}_{}.pdf'.format(acause, scenario))
     if not os.path.exists(os.path.dirname(outfile)):
         os.makedirs(os.path.dirname(outfile))
 
-    ds = scalar_ds.loc[{'scenario': scenario, 'sex_id': sex_id}]
-    # Calculate statistics.
-    ds['mean'] = ds['value'].mean(dim='draw')
-    ds['lower'] = ds['value'].quantile(0.025, dim='draw')
-    ds['upper'] = ds['value'].quantile(0.975, dim='draw')
-
-    age_map = get_ages().set_index('age_group_id')['age_group_name'].to_dict()
-
-    with PdfPages(outfile) as pp:
-        for location_id in location_ids:
-            loc_ds = ds.loc[{"location_id": location_id}]
-            nrow = 4
-            ncol = 3
-            fig = plt.figure(figsize=(12, 10))
-            grid = gridspec.GridSpec(nrow, ncol)
-
-            for ix, age_group_id in enumerate(xrange(start_age_group_id,
-                                                     end_age_group_id)):
-                ax = fig.add_subplot(grid[ix])
-                age_ds = loc_ds.loc[{"age_group_id": age_group_id}]
-                ax.plot(age_ds['year_id'], age_ds['mean'])
-                ax.fill_between(age_ds['year_id'], age_ds['lower'],
-                                age_ds['upper'])
-                ax.text(0.7, 0.95, age_map[age_group_id],
-                        verticalalignment='top',
-                        horizontalalignment='left', transform=ax.transAxes,
-                        color='black', fontsize=12)
-
-            location_map = get_modeled_locations().\
-                set_index('location_id')['location_name'].to_dict()
-            location = location_map[location_id]
-            suptitle = "{location}, {acause}; Scenario: {scenario}".format(
-                        location=location, acause=acause, scenario=scenario)
-            fig.suptitle(suptitle, fontsize=15)
-            pp.savefig(bbox_inches='tight')
+    pages = [(location_id,
+              scalar_ds.loc[{'location_id': [location_id],
+                             'sex_id': [sex_id], 'scenario': [scenario]}])
+             for location_id in location_ids]
+    render_kwargs = {'acause': acause, 'sex_id': sex_id,
+                     'scenario': scenario,
+                     'start_age_group_id': start_age_group_id,
+                     'end_age_group_id': end_age_group_id,
+                     'age_map': age_group_names(),
+                     'location_map': location_names()}
+    render_pdf(outfile, _render_scalars_page, pages, workers=workers,
+               render_kwargs=render_kwargs, bbox_inches='tight')
     logger.info('Scalars plotting finished: {}'.format(acause))
 
 
-def plot_paf(df, acause, risk, date, paf_cols, demography_cols):
-    ''' Plot cause specific scalars.'''
-
-    age_map = get_ages().\
-        set_index('age_group_id')['age_group_name'].to_dict()
-    location_map = get_modeled_locations().\
-        set_index('location_id')['location_name'].to_dict()
-
-    df['mean'] = np.mean(df.loc[:, paf_cols].values, axis=1)
-    df['lower'] = np.percentile(df.loc[:, paf_cols].values, 2.5, axis=1)
-    df['upper'] = np.percentile(df.loc[:, paf_cols].values, 97.5, axis=1)
-    df = df[demography_cols + ['mean', 'lower', 'upper']]
-    df = df.loc[df.scenario == 0]
-
+def _render_paf_page(location_id, df, acause, paf_cols, demography_cols,
+                     age_map, location_map):
+    ''' Return the page of location_id of plot_paf. '''
+    test = summarize_dataframe(df, paf_cols,
+                               {'location_id': location_id,
+                                'scenario': 0})
+    nrow = 4
+    ncol = 3
+    fig = plt.figure(figsize=(12, 10))
+    grid = gridspec.GridSpec(nrow, ncol)
+
+    for ix, age_group_id in enumerate(xrange(2, 14)):
+        ax = fig.add_subplot(grid[ix])
+        tmp = test.loc[test.age_group_id == age_group_id]
+        tmp = tmp.drop_duplicates(demography_cols)
+        ax.plot(tmp.year_id.unique(),
+                tmp.loc[tmp.sex_id == 2]['mean'].values, 'b',
+                label='Female')
+        ax.fill_between(tmp.year_id.unique(),
+                        tmp.loc[tmp.sex_id == 2]['lower'].values,
+                        tmp.loc[tmp.sex_id == 2]['upper'].values)
+
+        ax.text(0.7, 0.95, age_map[age_group_id],
+                verticalalignment='top',
+                horizontalalignment='left', transform=ax.transAxes,
+                color='black', fontsize=12)
+    location = location_map[location_id]
+    suptitle = '{location}, {acause}'.format(location=location,
+                                             acause=acause)
+    fig.suptitle(suptitle, fontsize=15)
+    return fig
+
+
+def plot_paf(df, acause, risk, date, paf_cols, demography_cols, workers=1):
+    ''' Plot cause specific scalars.
+
+        Pages of locations are rendered by workers processes, see
+        render_pdf.
+    '''
     outfile = ('/ihme/forecasting/data/paf/{date}/plots/'
                '{acause}_{risk}_2.pdf'.format(date=date,
                                               risk=risk,
@@ -107,38 +309,56 @@ def plot_paf(df, acause, risk, date, paf_cols, demography_cols):
 
     location_ids = get_gbd_demographics().location_id.unique()
 
-    with PdfPages(outfile) as pp:
-        for location_id in location_ids:  # [6, 102]
-            test = df.loc[df.location_id == location_id]
-            nrow = 4
-            ncol = 3
-            fig = plt.figure(figsize=(12, 10))
-            grid = gridspec.GridSpec(nrow, ncol)
-
-            for ix, age_group_id in enumerate(xrange(2, 14)):
-                ax = fig.add_subplot(grid[ix])
-                tmp = test.loc[test.age_group_id == age_group_id]
-                tmp = tmp.drop_duplicates(demography_cols)
-                ax.plot(tmp.year_id.unique(),
-                        tmp.loc[tmp.sex_id == 2]['mean'].values, 'b',
-                        label='Female')
-                ax.fill_between(tmp.year_id.unique(),
-                                tmp.loc[tmp.sex_id == 2]['lower'].values,
-                                tmp.loc[tmp.sex_id == 2]['upper'].values)
-
-                ax.text(0.7, 0.95, age_map[age_group_id],
-                        verticalalignment='top',
-                        horizontalalignment='left', transform=ax.transAxes,
-                        color='black', fontsize=12)
-            location = location_map[location_id]
-            suptitle = '{location}, {acause}'.format(location=location,
-                                                     acause=acause)
-            fig.suptitle(suptitle, fontsize=15)
-            pp.savefig()
+    location_dfs = df.loc[df.scenario == 0].groupby('location_id')
+    pages = [(location_id, location_dfs.get_group(location_id)
+              if location_id in location_dfs.groups else df.iloc[:0])
+             for location_id in location_ids]
+    render_kwargs = {'acause': acause, 'paf_cols': paf_cols,
+                     'demography_cols': demography_cols,
+                     'age_map': age_group_names(),
+                     'location_map': location_names()}
+    render_pdf(outfile, _render_paf_page, pages, workers=workers,
+               render_kwargs=render_kwargs)
+
+
+def _render_risk_attributable_page(location_id, ds, acause, sex_id, risk,
+                                   start_age_group_id, end_age_group_id,
+                                   age_map, location_map):
+    ''' Return the page of location_id of plot_risk_attributable. '''
+    color_map = ['r', 'b', 'g']
+    loc_ds = summarize_dataset(ds, {'sex_id': sex_id,
+                                    'location_id': location_id})
+    nrow = 4
+    ncol = 3
+    fig = plt.figure(figsize=(15, 12))
+    grid = gridspec.GridSpec(nrow, ncol)
+
+    for ix, age_group_id in enumerate(xrange(start_age_group_id,
+                                             end_age_group_id)):
+        ax = fig.add_subplot(grid[ix])
+        age_ds = loc_ds.loc[{"age_group_id": age_group_id}]
+        for scenario in [-1, 1, 0]:
+            scenario_ds = age_ds.loc[dict(scenario=scenario)]
+            ax.plot(scenario_ds['year_id'], scenario_ds['mean'],
+                    color=color_map[scenario+1])
+            ax.text(0.7, 0.95, age_map[age_group_id],
+                    verticalalignment='top',
+                    horizontalalignment='left',
+                    transform=ax.transAxes,
+                    color='black', fontsize=12)
+            ax.axvline(x=2015, color='k')
+
+    location = location_map[location_id]
+    suptitle = "{location}, {acause}, {risk}".format(
+                location=location, acause=acause,
+                scenario=scenario, risk=risk)
+    fig.suptitle(suptitle, fontsize=15)
+    return fig
 
 
 def plot_risk_attributable(ds, acause, sex_id, location_ids, risk, outdir,
-                           start_age_group_id=10, end_age_group_id=22):
+                           start_age_group_id=10, end_age_group_id=22,
+                           workers=1):
     ''' Plot risk attributable mortality across scenarios.
 
         # NOTE: this is called within plot_risk_attr_mort()
@@ -153,6 +373,7 @@ def plot_risk_attributable(ds, acause, sex_id, location_ids, risk, outdir,
         outdir: output directory
         start_age_group_id: int, default 10
         end_age_group_id: int, default 22
+        workers: int, number of processes rendering pages, see render_pdf.
     '''
     # TODO Kendrick said: This is kind of weird (I think), because if I call
     # a different plotting function plot_thing(), and then this plotting
@@ -161,46 +382,18 @@ def plot_risk_attributable(ds, acause, sex_id, location_ids, risk, outdir,
     sns.despine()
     sns.set_style('ticks')
 
-    age_map = get_ages().\
-        set_index('age_group_id')['age_group_name'].to_dict()
-    location_map = get_modeled_locations().\
-        set_index('location_id')['location_name'].to_dict()
-    color_map = ['r', 'b', 'g']
-
     sexn = 'male' if sex_id == 1 else 'female'
     outfile = os.path.join(outdir, '{}_{}_{}.pdf'.format(acause, risk, sexn))
     if not os.path.exists(os.path.dirname(outfile)):
         os.makedirs(os.path.dirname(outfile))
-    # Calculate statistics.
-    ds['mean'] = ds['value'].mean(dim='draw')
-    ds = ds.loc[dict(sex_id=sex_id)]
-
-    with PdfPages(outfile) as pp:
-        for location_id in location_ids:
-            loc_ds = ds.loc[{"location_id": location_id}]
-            nrow = 4
-            ncol = 3
-            fig = plt.figure(figsize=(15, 12))
-            grid = gridspec.GridSpec(nrow, ncol)
-
-            for ix, age_group_id in enumerate(xrange(start_age_group_id,
-                                                     end_age_group_id)):
-                ax = fig.add_subplot(grid[ix])
-                age_ds = loc_ds.loc[{"age_group_id": age_group_id}]
-                for scenario in [-1, 1, 0]:
-                    scenario_ds = age_ds.loc[dict(scenario=scenario)]
-                    ax.plot(scenario_ds['year_id'], scenario_ds['mean'],
-                            color=color_map[scenario+1])
-                    ax.text(0.7, 0.95, age_map[age_group_id],
-                            verticalalignment='top',
-                            horizontalalignment='left',
-                            transform=ax.transAxes,
-                            color='black', fontsize=12)
-                    ax.axvline(x=2015, color='k')
-
-            location = location_map[location_id]
-            suptitle = "{location}, {acause}, {risk}".format(
-                        location=location, acause=acause,
-                        scenario=scenario, risk=risk)
-            fig.suptitle(suptitle, fontsize=15)
-            pp.savefig()
+
+    pages = [(location_id, ds.loc[{'location_id': [location_id],
+                                   'sex_id': [sex_id]}])
+             for location_id in location_ids]
+    render_kwargs = {'acause': acause, 'sex_id': sex_id, 'risk': risk,
+                     'start_age_group_id': start_age_group_id,
+                     'end_age_group_id': end_age_group_id,
+                     'age_map': age_group_names(),
+                     'location_map': location_names()}
+    render_pdf(outfile, _render_risk_attributable_page, pages,
+               workers=workers, render_kwargs=render_kwargs)
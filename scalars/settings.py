@@ -1,5 +1,10 @@
 from collections import OrderedDict
-from fbd_core.db.forecasting_demographics import get_modeled_locations
+import os
+import re
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
 
 GBD_ROUND = None
 FORECAST_START_YEAR = 2016
@@ -8,8 +13,65 @@ END_YEAR = 2040
 
 DEFAULT_YEARS = (START_YEAR, FORECAST_START_YEAR, END_YEAR)
 
+# Demographic metadata queried from the database is cached in each process
+# for METADATA_CACHE_TTL seconds, see metadata.py. Set METADATA_SNAPSHOT_DIR
+# to also share it between processes through snapshot files.
+METADATA_VERSION = GBD_ROUND
+METADATA_CACHE_TTL = 24 * 60 * 60
+METADATA_SNAPSHOT_DIR = None
+
+# If set, this environment variable is the path of a file of location ids,
+# separated by commas or whitespace, used instead of the modeled locations.
+LOCATION_IDS_FIXTURE_ENV = 'FBD_SCALARS_LOCATION_IDS'
+
+
+class LazyLocationIds(Sequence):
+    ''' Modeled location ids, only looked up on first use.
+
+        They are read from the file in LOCATION_IDS_FIXTURE_ENV if set, else
+        from metadata.get_modeled_locations, which loads a snapshot or
+        queries the database. Importing settings never touches the database.
+    '''
+
+    def __init__(self):
+        self._ids = None
+
+    def _load(self):
+        if self._ids is None:
+            fixture = os.environ.get(LOCATION_IDS_FIXTURE_ENV)
+            if fixture:
+                with open(fixture) as f:
+                    self._ids = [int(location_id) for location_id in
+                                 re.split(r'[\s,]+', f.read()) if location_id]
+            else:
+                # Imported here because metadata imports settings.
+                from metadata import get_modeled_locations
+                self._ids =\
+                    get_modeled_locations().location_id.values.tolist()
+        return self._ids
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __len__(self):
+        return len(self._load())
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __repr__(self):
+        if self._ids is None:
+            return '{}(<not loaded>)'.format(type(self).__name__)
+        return '{}({!r})'.format(type(self).__name__, self._ids)
+
+
+def set_location_ids(location_ids):
+    ''' Use location_ids as the modeled locations, e.g. in tests. '''
+    LOCATION_IDS._ids = list(location_ids)
+
+
 # Now we define the demographic indices
-LOCATION_IDS = get_modeled_locations().location_id.values.tolist()
+LOCATION_IDS = LazyLocationIds()
 AGE_GROUP_IDS = range(2, 22)  # TODO use fbd_core.db.forecasting_demographics
 SEX_IDS = [1, 2]
 YEAR_IDS = range(START_YEAR, END_YEAR+1)
@@ -22,6 +84,14 @@ DEMOGRAPHY_INDICES = OrderedDict(location_id=LOCATION_IDS,
                                  scenario=SCENARIOS)
 DEMOGRAPHY_COLS = DEMOGRAPHY_INDICES.keys()
 
+# dtype of the draw matrices transformed in kernels.py, 'float32' halves
+# their memory at the cost of precision.
+DRAW_DTYPE = 'float64'
+# How kernels.py evaluates its transforms, "numpy" or "numexpr". numexpr
+# has to be installed, and isn't faster than NumPy in place operations in
+# `python benchmarks.py kernels`.
+KERNEL_BACKEND = 'numpy'
+
 DRAW_PREFIX = 'draw_'
 PAF_DRAW_PREFIX = 'paf_'
 SCALAR_DRAW_PREFIX = 'scalar_'
@@ -53,6 +123,12 @@ ALREADY_INCLUDED_ACAUSES = ['lri_hib', 'lri_pneumo', 'diarrhea_rotavirus']
 INDIR_SEV = '/ihme/forecasting/data/fbd_scenarios_data/forecast/sev/{d:s}'
 INDIR_RRMAX = '/ihme/forecasting/data/dalynator_gbd_2015_outputs/rrmax'
 RISKS_NOT_AVAILABLE = ['unsafe_sex', 'metab_gfr', 'abuse_ipv_exp']
+# SEV resampled to the number of draws of a run is cached here,
+# least recently used files are evicted beyond the size cap.
+SEV_CACHE_DIR = '/ihme/forecasting/data/fbd_scenarios_data/cache/sev'
+SEV_CACHE_DISK_BYTES = 200 * 1024 ** 3
+# Cap on SEV cached in memory by a run, split evenly between its workers.
+SEV_CACHE_MEMORY_BYTES = 2 * 1024 ** 3
 
 OUTDIR_PAF_FORECAST = '/ihme/forecasting/data/fbd_scenarios_data/forecast/' \
                       'paf/{d:s}/risk_acause_specific'
@@ -61,6 +137,13 @@ OUTDIR_PAF_PAST = '/ihme/forecasting/data/fbd_scenarios_data/past/paf/' \
 
 VACCINE_RISKS = ['rota', 'dtp3', 'pcv', 'measles', 'hib']
 
+# How PAF and aggregated PAF draws are stored, see storage.py.
+# "hdf" is what readers outside of this pipeline expect; "npy" and "zarr"
+# are pre-sorted and much faster to write and read.
+PAF_STORAGE_BACKEND = 'hdf'
+PAF_STORAGE_COMPLEVEL = 9
+PAF_STORAGE_DTYPE = 'float64'
+
 # Parameters for calculate_scalars.py.
 INPATH_MEDIATION = '/ihme/forecasting/ref/jiawei/mediation.csv'
 INPATH_PAF_SET_ONE = '/ihme/forecasting/ref/paf_set_one_risk_outcomes.lst'
@@ -0,0 +1,191 @@
+"""
+Storage backends for PAF and aggregated PAF draws.
+
+- "hdf": a PyTables table per file, as written by utils.dataframe_to_hdf.
+  Kept for the readers of these files outside of this pipeline.
+- "npy": a directory holding one .npy file per demography column and the
+  draws as one contiguous matrix in draws.npy, read memory-mapped.
+- "zarr": the same layout in a Zarr group compressed with blosc, if zarr is
+  installed.
+
+npy and zarr stores are sorted by demography when written, so readers don't
+have to sort them again.
+"""
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from utils import dataframe_to_hdf
+
+from settings import (PAF_STORAGE_BACKEND, PAF_STORAGE_COMPLEVEL,
+                      PAF_STORAGE_DTYPE)
+
+try:
+    import zarr
+    from numcodecs import Blosc
+except ImportError:
+    zarr = None
+
+
+__modname__ = "fbd_research.scalars.storage"
+logger = logging.getLogger(__modname__)
+
+
+def _replace_dir(tmp_path, path):
+    ''' Move the directory tmp_path to path, replacing what is there. '''
+    old_path = None
+    if os.path.exists(path):
+        old_path = '{}.{}.old'.format(path, uuid.uuid4().hex)
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    if old_path is not None:
+        shutil.rmtree(old_path)
+
+
+def _sorted_columns(df, demography_cols, dtype):
+    ''' Return the sorted demography columns and draw matrix of df. '''
+    df = df.sort_values(demography_cols, kind='mergesort')
+    draw_cols = [col for col in df.columns if col not in demography_cols]
+    index = [(col, df[col].values) for col in demography_cols]
+    draws = np.ascontiguousarray(df[draw_cols].values, dtype=dtype)
+    return index, draw_cols, draws
+
+
+def _to_dataframe(index, draw_cols, draws):
+    ''' Return the dataframe of the columns returned by _sorted_columns. '''
+    df = pd.DataFrame(draws, columns=draw_cols)
+    for position, (col, values) in enumerate(index):
+        df.insert(position, col, values)
+    return df
+
+
+class HDFStorage(object):
+    ''' PyTables tables with data columns for the demography. '''
+
+    extension = '.h5'
+    presorted = False
+
+    def __init__(self, complevel=PAF_STORAGE_COMPLEVEL):
+        self.complevel = complevel
+
+    def write(self, df, outpath, demography_cols, append=False):
+        dataframe_to_hdf(df, outpath, demography_cols,
+                         mode='a' if append else 'w', append=append,
+                         complevel=self.complevel)
+
+    def read(self, inpath):
+        return pd.read_hdf(inpath, 'data')
+
+
+class NPYStorage(object):
+    ''' Directories of uncompressed .npy files, read memory-mapped.
+
+        Parameters
+        ----------
+        dtype: dtype of the stored draws.
+    '''
+
+    extension = '.npy'
+    presorted = True
+
+    def __init__(self, dtype=PAF_STORAGE_DTYPE):
+        self.dtype = dtype
+
+    def write(self, df, outpath, demography_cols, append=False):
+        if append:
+            raise ValueError("npy storage can't be appended to.")
+        index, draw_cols, draws = _sorted_columns(df, demography_cols,
+                                                  self.dtype)
+        tmp_path = '{}.{}.tmp'.format(outpath, uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        for col, values in index:
+            np.save(os.path.join(tmp_path, '{}.npy'.format(col)), values)
+        np.save(os.path.join(tmp_path, 'draws.npy'), draws)
+        with open(os.path.join(tmp_path, 'columns.json'), 'w') as f:
+            json.dump({'index': [col for col, _ in index],
+                       'draws': draw_cols}, f)
+        _replace_dir(tmp_path, outpath)
+
+    def read(self, inpath):
+        ''' Return the dataframe stored at inpath. The draws are a
+            read-only memory map until modified.
+        '''
+        with open(os.path.join(inpath, 'columns.json')) as f:
+            columns = json.load(f)
+        index = [(col, np.load(os.path.join(inpath, '{}.npy'.format(col))))
+                 for col in columns['index']]
+        draws = np.load(os.path.join(inpath, 'draws.npy'), mmap_mode='r')
+        return _to_dataframe(index, columns['draws'], draws)
+
+
+class ZarrStorage(object):
+    ''' Zarr groups with the layout of NPYStorage, compressed with blosc.
+
+        Parameters
+        ----------
+        complevel: blosc compression level, 0 to 9.
+        dtype: dtype of the stored draws.
+        chunk_rows: number of rows per chunk of the draws.
+    '''
+
+    extension = '.zarr'
+    presorted = True
+
+    def __init__(self, complevel=PAF_STORAGE_COMPLEVEL,
+                 dtype=PAF_STORAGE_DTYPE, chunk_rows=2 ** 16):
+        if zarr is None:
+            raise ImportError("zarr storage requires zarr and numcodecs.")
+        self.compressor = Blosc(cname='lz4', clevel=complevel,
+                                shuffle=Blosc.SHUFFLE)
+        self.dtype = dtype
+        self.chunk_rows = chunk_rows
+
+    def write(self, df, outpath, demography_cols, append=False):
+        if append:
+            raise ValueError("zarr storage can't be appended to.")
+        index, draw_cols, draws = _sorted_columns(df, demography_cols,
+                                                  self.dtype)
+        tmp_path = '{}.{}.tmp'.format(outpath, uuid.uuid4().hex)
+        group = zarr.open_group(tmp_path, mode='w')
+        for col, values in index:
+            group.array(col, values, compressor=self.compressor)
+        group.array('draws', draws, chunks=(self.chunk_rows, None),
+                    compressor=self.compressor)
+        group.attrs['index'] = [col for col, _ in index]
+        group.attrs['draws'] = draw_cols
+        _replace_dir(tmp_path, outpath)
+
+    def read(self, inpath):
+        group = zarr.open_group(inpath, mode='r')
+        index = [(col, group[col][:]) for col in group.attrs['index']]
+        return _to_dataframe(index, group.attrs['draws'], group['draws'][:])
+
+
+BACKENDS = {'hdf': HDFStorage, 'npy': NPYStorage, 'zarr': ZarrStorage}
+
+
+def get_storage(backend=PAF_STORAGE_BACKEND):
+    ''' Return the storage of backend, "hdf", "npy" or "zarr". '''
+    if backend not in BACKENDS:
+        raise ValueError("Storage backend should be one of {}.".format(
+            sorted(BACKENDS.keys())))
+    return BACKENDS[backend]()
+
+
+def storage_path(path, backend=PAF_STORAGE_BACKEND):
+    ''' Return path with the extension of backend. '''
+    return os.path.splitext(path)[0] + BACKENDS[backend].extension
+
+
+def storage_for_path(path):
+    ''' Return the storage of the backend that wrote path. '''
+    extension = os.path.splitext(path)[1]
+    for backend, storage in BACKENDS.items():
+        if storage.extension == extension:
+            return get_storage(backend)
+    raise ValueError("No storage backend for {}.".format(path))
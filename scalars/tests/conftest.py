@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmarks  # noqa: E402
+import calculate_pafs  # noqa: E402
+import calculate_scalars  # noqa: E402
+import utils  # noqa: E402
+
+
+NUMBER_OF_DRAWS = 10
+YEARS = [1990, 1993, 1995]
+
+
+@pytest.fixture
+def demography(monkeypatch):
+    ''' Use a small demography of three locations and NUMBER_OF_DRAWS draws
+        in calculate_pafs, calculate_scalars, utils and the reference
+        implementations of benchmarks.
+
+        Returns
+        ----------
+        indices: OrderedDict of the demography dims and their values.
+    '''
+    indices = OrderedDict(location_id=[102, 6, 7], age_group_id=[2, 3, 4],
+                          sex_id=[1, 2],
+                          year_id=list(range(YEARS[0], YEARS[2] + 1)),
+                          scenario=[-1, 0, 1])
+    for module in (calculate_pafs, calculate_scalars, utils):
+        monkeypatch.setattr(module, 'DEMOGRAPHY_INDICES', indices)
+    for module in (benchmarks, calculate_pafs, calculate_scalars):
+        monkeypatch.setattr(module, 'DEMOGRAPHY_COLS', list(indices.keys()))
+    monkeypatch.setattr(calculate_pafs, 'NUMBER_OF_DRAWS', NUMBER_OF_DRAWS,
+                        raising=False)
+    monkeypatch.setattr(calculate_pafs, 'SEV_COLS',
+                        ['draw_{}'.format(i) for i in range(NUMBER_OF_DRAWS)],
+                        raising=False)
+    monkeypatch.setattr(calculate_pafs, 'RR_MAX_COLS',
+                        ['rr_{}'.format(i) for i in range(NUMBER_OF_DRAWS)],
+                        raising=False)
+    return indices
+
+
+def synthetic_sev(indices, seed=0):
+    ''' Return a SEV dataset like that of read_xarray_sev over indices, with
+        a missing location-year.
+    '''
+    rng = np.random.RandomState(seed)
+    coords = list(indices.values()) + [list(range(NUMBER_OF_DRAWS))]
+    dims = list(indices.keys()) + ['draw']
+    da = xr.DataArray(rng.uniform(0, 1, [len(coord) for coord in coords]),
+                      coords=coords, dims=dims, name='value')
+    da.loc[{'location_id': 7, 'year_id': YEARS[1]}] = np.nan
+    return da.to_dataset()
+
+
+def synthetic_rrmax(indices, seed=1):
+    ''' Return rrmax by age and sex like that of get_rrmax. '''
+    rng = np.random.RandomState(seed)
+    rr_max = pd.MultiIndex.from_product(
+        [indices['age_group_id'], indices['sex_id']],
+        names=['age_group_id', 'sex_id']).to_frame(index=False)
+    draws = pd.DataFrame(rng.uniform(1.001, 3,
+                                     (len(rr_max), NUMBER_OF_DRAWS)),
+                         columns=['rr_{}'.format(i)
+                                  for i in range(NUMBER_OF_DRAWS)])
+    return pd.concat([rr_max, draws], axis=1)
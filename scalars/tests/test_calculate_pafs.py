@@ -0,0 +1,128 @@
+from collections import Counter
+import os
+
+import pandas as pd
+import xarray as xr
+
+import calculate_pafs
+from benchmarks import merge_sev_rrmax_outer
+from cache import DiskCache, LRUCache
+
+from .conftest import YEARS, synthetic_rrmax, synthetic_sev
+
+
+def _patch_inputs(monkeypatch, indices):
+    ''' Serve synthetic SEV, rrmax and cause id to calculate_pafs and return
+        the count of calls of each.
+    '''
+    ds = synthetic_sev(indices)
+    rr_max = synthetic_rrmax(indices)
+    calls = Counter()
+
+    def read_xarray_sev(risk, date, chunks=None, year_ids=None):
+        calls['read_xarray_sev'] += 1
+        sev = ds if year_ids is None else ds.loc[{'year_id': year_ids}]
+        return sev.chunk(chunks) if chunks is not None else sev
+
+    def get_rrmax(risk, cause_id):
+        calls['get_rrmax'] += 1
+        return rr_max.copy()
+
+    def get_cause_id(acause):
+        calls['get_cause_id'] += 1
+        return 1
+
+    monkeypatch.setattr(calculate_pafs, 'read_xarray_sev', read_xarray_sev)
+    monkeypatch.setattr(calculate_pafs, 'get_rrmax', get_rrmax)
+    monkeypatch.setattr(calculate_pafs, 'get_cause_id', get_cause_id)
+    return calls
+
+
+def test_chunked_paf_equals_paf(demography, monkeypatch):
+    calls = _patch_inputs(monkeypatch, demography)
+    for version in ('past', 'forecast'):
+        expected = calculate_pafs.calculate_paf('risk', 'acause', version,
+                                                'date', YEARS)
+        calls.clear()
+        blocks = list(calculate_pafs.calculate_paf_chunked(
+            'risk', 'acause', version, 'date', YEARS, chunk_size=2))
+        assert len(blocks) == 2
+        assert calls == Counter(read_xarray_sev=1, get_rrmax=1,
+                                get_cause_id=1)
+        chunked = pd.concat(blocks).sort_values(
+            list(demography.keys())).reset_index(drop=True)
+        pd.testing.assert_frame_equal(chunked, expected)
+
+
+def _merge_inputs(indices):
+    sev = calculate_pafs.sev_to_dataframe(synthetic_sev(indices), 'past',
+                                          YEARS)
+    return sev, synthetic_rrmax(indices)
+
+
+def _assert_merge_equal(sev, rr_max):
+    sev_cols = calculate_pafs.SEV_COLS
+    rr_max_cols = calculate_pafs.RR_MAX_COLS
+    expected = merge_sev_rrmax_outer(sev, rr_max, sev_cols, rr_max_cols)
+    result = calculate_pafs.merge_sev_rrmax(sev, rr_max, sev_cols,
+                                            rr_max_cols)
+    pd.testing.assert_frame_equal(result.reset_index(drop=True),
+                                  expected.reset_index(drop=True))
+
+
+def test_merge_sev_rrmax(demography):
+    sev, rr_max = _merge_inputs(demography)
+    _assert_merge_equal(sev, rr_max)
+    # Unsorted SEV.
+    _assert_merge_equal(sev.sample(frac=1, random_state=0), rr_max)
+
+
+def test_merge_sev_rrmax_missing_keys(demography):
+    sev, rr_max = _merge_inputs(demography)
+    # SEV demographies missing from rrmax get rrmax 1.
+    _assert_merge_equal(sev, rr_max.loc[rr_max.age_group_id != 3])
+    # rrmax demographies missing from SEV are appended.
+    _assert_merge_equal(sev.loc[sev.age_group_id != 3], rr_max)
+
+
+def test_merge_sev_rrmax_duplicate_keys(demography):
+    sev, rr_max = _merge_inputs(demography)
+    _assert_merge_equal(sev, pd.concat([rr_max, rr_max.iloc[:2]],
+                                       ignore_index=True))
+
+
+def test_merge_sev_rrmax_by_location(demography):
+    sev, rr_max = _merge_inputs(demography)
+    rr_max = pd.concat([rr_max.assign(location_id=location_id)
+                        for location_id in demography['location_id'][:2]],
+                       ignore_index=True)
+    _assert_merge_equal(sev, rr_max)
+
+
+def test_read_xarray_sev_years(demography, monkeypatch, tmp_path):
+    ds = synthetic_sev(demography)
+    os.makedirs(str(tmp_path / 'date'))
+    ds.to_netcdf(str(tmp_path / 'date' / 'risk.nc'))
+    monkeypatch.setattr(calculate_pafs, 'INDIR_SEV',
+                        str(tmp_path / '{d:s}'))
+    monkeypatch.setattr(calculate_pafs, '_SEV_MEMORY_CACHE',
+                        LRUCache(ds.nbytes))
+    monkeypatch.setattr(calculate_pafs, '_SEV_DISK_CACHE',
+                        DiskCache(str(tmp_path / 'cache'), ds.nbytes))
+
+    open_dataset = xr.open_dataset
+    calls = Counter()
+
+    def counted_open_dataset(*args, **kwargs):
+        calls['open_dataset'] += 1
+        return open_dataset(*args, **kwargs)
+    monkeypatch.setattr(xr, 'open_dataset', counted_open_dataset)
+
+    for version in ('past', 'forecast'):
+        year_ids = calculate_pafs._year_ids(version, YEARS)
+        expected = ds.loc[{'year_id': year_ids}]
+        result = calculate_pafs.read_xarray_sev('risk', 'date',
+                                                year_ids=year_ids)
+        assert result.equals(expected)
+    # The past and forecast years are selected from one read of the file.
+    assert calls == Counter(open_dataset=1)
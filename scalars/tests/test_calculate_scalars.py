@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+import calculate_scalars
+from benchmarks import product_of_mediated_pafs_merge
+from utils import get_whole_index
+
+from .conftest import NUMBER_OF_DRAWS, YEARS
+
+PAF_COLS = ['paf_{}'.format(i) for i in range(NUMBER_OF_DRAWS)]
+
+
+def synthetic_paf(seed, frac=1.):
+    ''' Return a PAF over a random frac of the whole demography. '''
+    rng = np.random.RandomState(seed)
+    paf = get_whole_index('all', YEARS).sample(frac=frac, random_state=seed)
+    paf = paf.sort_values(list(paf.columns)).reset_index(drop=True)
+    draws = pd.DataFrame(rng.uniform(0, 0.5, (len(paf), NUMBER_OF_DRAWS)),
+                         columns=PAF_COLS)
+    return pd.concat([paf, draws], axis=1)
+
+
+def _assert_product_equal(mediated_pafs, expected_pafs):
+    result = calculate_scalars.product_of_mediated_pafs(mediated_pafs,
+                                                        PAF_COLS)
+    expected = product_of_mediated_pafs_merge(expected_pafs, PAF_COLS)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_product_of_mediated_pafs(demography):
+    mediated_pafs = [(synthetic_paf(0), 1.), (synthetic_paf(1, 0.8), 0.5),
+                     (synthetic_paf(2, 0.9), 0.3)]
+    _assert_product_equal(mediated_pafs, mediated_pafs)
+
+
+def test_product_of_mediated_pafs_duplicated_rows(demography):
+    paf = synthetic_paf(1, 0.8)
+    duplicated = pd.concat([paf, paf.iloc[[3, 5]].assign(paf_0=0.9)],
+                           ignore_index=True)
+    for pafs in ([synthetic_paf(0), duplicated], [duplicated,
+                                                  synthetic_paf(0)]):
+        mediated_pafs = [(p, 0.5) for p in pafs]
+        expected_pafs = [(p.drop_duplicates(list(demography.keys())), 0.5)
+                         for p in pafs]
+        _assert_product_equal(mediated_pafs, expected_pafs)
+
+
+def test_aggregate_paf_xr_sparse(demography, monkeypatch, tmp_path):
+    # Vaccine PAFs are read as dataframes on both paths, so a sparse one
+    # has NaN holes as a DataArray.
+    pafs = {'risk_a': synthetic_paf(0), 'risk_b': synthetic_paf(1, 0.7),
+            'risk_c': synthetic_paf(2)}
+    pafs['risk_c'].loc[:5, PAF_COLS] = 0.99999
+    med = pd.DataFrame({'acause': 'acause', 'mediator': 'risk_a',
+                        'risk': 'risk_b', 'mean': [0.4]})
+    monkeypatch.setattr(calculate_scalars, 'PAF_COLS', PAF_COLS,
+                        raising=False)
+    monkeypatch.setattr(calculate_scalars, 'VACCINE_RISKS', list(pafs))
+    monkeypatch.setattr(calculate_scalars, 'read_paf',
+                        lambda acause, risk, *args: pafs[risk].copy())
+    monkeypatch.setattr(calculate_scalars, 'get_paf_set_one', lambda: [])
+    monkeypatch.setattr(calculate_scalars, 'get_mediation_index',
+                        lambda: calculate_scalars.MediationIndex(med))
+    monkeypatch.setattr(calculate_scalars, 'save_paf',
+                        lambda *args, **kwargs: None)
+    monkeypatch.setattr(calculate_scalars, 'agg_paf_outpath',
+                        lambda *args: str(tmp_path / 'acause.h5'))
+
+    args = ('acause', list(pafs), 'forecast', 'date', YEARS)
+    expected = calculate_scalars.aggregate_paf(*args)
+    paf = calculate_scalars.aggregate_paf_xr(*args)
+    result = paf.to_series().unstack('draw').dropna(how='all')
+    result.columns = PAF_COLS
+    result = result.reset_index()
+    assert 0 < len(expected) < len(get_whole_index('all', YEARS))
+    pd.testing.assert_frame_equal(result, expected, check_names=False)
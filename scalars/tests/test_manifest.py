@@ -0,0 +1,56 @@
+import os
+import shutil
+
+import manifest
+from manifest import input_signature, is_up_to_date, record_signature
+
+
+def _write(path, contents):
+    with open(path, 'w') as f:
+        f.write(contents)
+
+
+def _setup(tmp_path):
+    inpath = str(tmp_path / 'sev.nc')
+    outpath = str(tmp_path / 'paf.h5')
+    _write(inpath, 'sev')
+    _write(outpath, 'paf')
+    record_signature(outpath, input_signature({'sev': inpath}, {'draws': 2}))
+    return inpath, outpath
+
+
+def test_unchanged_inputs_are_not_hashed(tmp_path, monkeypatch):
+    inpath, outpath = _setup(tmp_path)
+    monkeypatch.setattr(manifest, 'file_hash', None)
+    assert is_up_to_date(outpath, input_signature({'sev': inpath},
+                                                  {'draws': 2}))
+    assert not is_up_to_date(outpath, input_signature({'sev': inpath},
+                                                      {'draws': 3}))
+
+
+def test_touched_inputs_are_hashed_once(tmp_path, monkeypatch):
+    inpath, outpath = _setup(tmp_path)
+    copy = str(tmp_path / 'copy.nc')
+    shutil.copy(inpath, copy)
+    os.utime(copy, (0, 0))
+    signature = input_signature({'sev': copy}, {'draws': 2})
+    assert is_up_to_date(outpath, signature)
+    # The new size and mtime are recorded, so no hashing next time.
+    monkeypatch.setattr(manifest, 'file_hash', None)
+    assert is_up_to_date(outpath, signature)
+
+
+def test_changed_inputs(tmp_path):
+    inpath, outpath = _setup(tmp_path)
+    _write(inpath, 'new sev')
+    assert not is_up_to_date(outpath, input_signature({'sev': inpath},
+                                                      {'draws': 2}))
+
+
+def test_inputs_changed_during_the_run_are_not_recorded(tmp_path):
+    inpath, outpath = _setup(tmp_path)
+    signature = input_signature({'sev': inpath}, {'draws': 2})
+    _write(inpath, 'sev changed while the output is computed')
+    record_signature(outpath, signature)
+    assert not is_up_to_date(outpath, input_signature({'sev': inpath},
+                                                      {'draws': 2}))
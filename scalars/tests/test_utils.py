@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from benchmarks import xarray_to_dataframe_pivot
+from utils import xarray_to_dataframe
+
+from .conftest import NUMBER_OF_DRAWS, synthetic_sev
+
+
+def _assert_equal_to_pivot(ds, cols):
+    expected = xarray_to_dataframe_pivot(ds, cols, 'draw_', NUMBER_OF_DRAWS)
+    result = xarray_to_dataframe(ds, cols, 'draw_', NUMBER_OF_DRAWS)
+    pd.testing.assert_frame_equal(result, expected, check_names=False)
+
+
+def test_xarray_to_dataframe(demography):
+    # The keys of DEMOGRAPHY_INDICES, as in settings.DEMOGRAPHY_COLS.
+    _assert_equal_to_pivot(synthetic_sev(demography), demography.keys())
+
+
+def test_xarray_to_dataframe_all_nan_rows(demography):
+    ds = synthetic_sev(demography)
+    ds['value'][0, :, 1, :2] = np.nan
+    # A row missing some draws only is kept.
+    ds['value'][1, 0, 0, 0, 0, :3] = np.nan
+    result = xarray_to_dataframe(ds, list(demography.keys()), 'draw_',
+                                 NUMBER_OF_DRAWS)
+    num_rows = int(np.prod([len(v) for v in demography.values()]))
+    assert len(result) < num_rows
+    _assert_equal_to_pivot(ds, list(demography.keys()))
+
+
+def test_xarray_to_dataframe_unsorted_coords(demography):
+    ds = synthetic_sev(demography)
+    rng = np.random.RandomState(0)
+    ds = ds.isel(**{dim: rng.permutation(len(ds[dim]))
+                    for dim in ds['value'].dims})
+    ds = ds.transpose(*reversed(ds['value'].dims))
+    _assert_equal_to_pivot(ds, list(demography.keys()))
+
+
+def test_xarray_to_dataframe_other_dims(demography):
+    da = synthetic_sev(demography)['value']
+    da = xr.concat([da, da * 2], dim='measure')
+    _assert_equal_to_pivot(da.to_dataset(), list(demography.keys()))
@@ -1,7 +1,10 @@
+from collections import OrderedDict
 import os
+import numpy as np
 import pandas as pd
 import xarray as xr
-from fbd_core.db import db_engine, get_cause_risk_pairs
+from fbd_core.db import db_engine
+from metadata import get_cause_risk_pairs
 from settings import (RISKS_NOT_AVAILABLE, DEMOGRAPHY_INDICES, DEFAULT_YEARS,
                       FORECAST_RISK_ATTRIBUTABLE_DIR,
                       PAST_RISK_ATTRIBUTABLE_DIR)
@@ -10,45 +13,85 @@ from settings import (RISKS_NOT_AVAILABLE, DEMOGRAPHY_INDICES, DEFAULT_YEARS,
 # TODO can we minimize all this xr-to-df-to-xr conversion bs?
 
 
+class CauseRisks(object):
+    ''' Cause-risk pairs indexed by cause and by risk.
+
+        Causes and risks keep the order they first appear in, like
+        pandas.unique does.
+
+        Parameters
+        ----------
+        pairs: dataframe with columns of acause and rei.
+    '''
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self._risks_by_cause = OrderedDict()
+        self._causes_by_risk = OrderedDict()
+        for acause, rei in zip(pairs['acause'].values, pairs['rei'].values):
+            self._risks_by_cause.setdefault(acause, OrderedDict())[rei] = None
+            self._causes_by_risk.setdefault(rei, OrderedDict())[acause] = None
+
+    def causes(self):
+        return list(self._risks_by_cause.keys())
+
+    def risks(self):
+        return list(self._causes_by_risk.keys())
+
+    def risks_of(self, acause):
+        return list(self._risks_by_cause.get(acause, ()))
+
+    def causes_of(self, rei):
+        return list(self._causes_by_risk.get(rei, ()))
+
+
+_CAUSE_RISKS = None
+_RISKS_NOT_AVAILABLE = frozenset(RISKS_NOT_AVAILABLE)
+
+
+def get_cause_risks():
+    '''Return the CauseRisks of the cause-risk pairs.
+
+    It is built once per process, and again only when metadata.py queries
+    the pairs again.
+    '''
+    global _CAUSE_RISKS
+    pairs = get_cause_risk_pairs()
+    if _CAUSE_RISKS is None or _CAUSE_RISKS.pairs is not pairs:
+        _CAUSE_RISKS = CauseRisks(pairs)
+    return _CAUSE_RISKS
+
+
+def _available(risks):
+    return [risk for risk in risks if risk not in _RISKS_NOT_AVAILABLE]
+
+
 def get_acause_related_risks(acause):
     '''Return a list of risks contributing to certain acause.
     '''
     if acause in ['rotavirus']:  # TODO refactor this mapping to settings.py?
         risks = ['rota']
     else:
-        df_acause_risk = get_cause_risk_pairs()
-        risks = list(df_acause_risk.loc[df_acause_risk.acause == acause]['rei']
-                                   .unique())
-    return [risk for risk in risks if risk not in RISKS_NOT_AVAILABLE]
+        risks = get_cause_risks().risks_of(acause)
+    return _available(risks)
 
 
 def get_risk_related_acauses(rei):
     '''Return a list of acauses associated with certain risk.
     '''
-    df_acause_risk = get_cause_risk_pairs()
-    acauses = list(df_acause_risk.loc[df_acause_risk.rei == rei]['acause']
-                                 .unique())
-    return acauses
+    return get_cause_risks().causes_of(rei)
 
 
 def get_modeling_causes():
     '''Return the causes we are modeling
     '''
-    df_acause_risk = get_cause_risk_pairs()
-    acauses = list(df_acause_risk.acause.unique())
-    return acauses
+    return get_cause_risks().causes()
 
 
 def get_modeling_risks():
     '''Return risks we are modeling
     '''
-    df_acause_risk = get_cause_risk_pairs()
-    modeling_risks = list(df_acause_risk.rei.unique())
-
-    for risk in RISKS_NOT_AVAILABLE:
-        if risk in modeling_risks:
-            modeling_risks.remove(risk)
-    return modeling_risks
+    return _available(get_cause_risks().risks())
 
 
 def read_risk_table_from_db():  # TODO move to fbd_core.db?
@@ -61,15 +104,20 @@ def read_risk_table_from_db():  # TODO move to fbd_core.db?
     return df_risk
 
 
-def dataframe_to_hdf(df, outpath, demography_cols, key='data', mode='w'):
-    '''Save dataframe to disk as HDF format.'''
+def dataframe_to_hdf(df, outpath, demography_cols, key='data', mode='w',
+                     append=False, complevel=9):
+    '''Save dataframe to disk as HDF format.
+
+    With append=True, rows are appended to the table already at key.
+    '''
     df.to_hdf(outpath,
               mode=mode,
               key=key,
+              append=append,
               data_columns=demography_cols,
               format='table',
               complib='blosc',
-              complevel=9)
+              complevel=complevel)
     return
 
 
@@ -128,9 +176,14 @@ def xarray_to_dataframe(ds, cols, draw_prefix, num_draws):
     Converts xarray to dataframe.
     It is assumed that a draw-like dimension exists in the input xarray object.
 
+    The draw dimension is transposed last and the underlying array reshaped
+    into wide draw columns, which gives the same frame as pivoting the long
+    frame by draw without the hash-based aggregation.
+
     Args:
         ds (xarray.Dataset): input xarray Dataset
-        cols (list of str): columns used for indexing upon calling .pivot_table
+        cols (list of str): demography dimensions, in the order of the
+            returned columns.
         draw_prefix (str): name prefix of the draw dimension in xarray object.
             Example: "draw_", "sev_", "paf_", "paf_x_"
             (underscore always assumed)
@@ -139,18 +192,34 @@ def xarray_to_dataframe(ds, cols, draw_prefix, num_draws):
     Returns:
         Pandas.DataFrame
     """
-    df = ds.to_dataframe().reset_index()
-    # the draw column name
-    draw_dim_name =\
-        ["_".join(draw_prefix.split("_")[0:-1])]  # "paf_x_" -> ["paf_x"]
+    # cols may be the keys of DEMOGRAPHY_INDICES, not a list, on Python 3.
+    cols = list(cols)
+    # the draw dimension name, "paf_x_" -> "paf_x"
+    draw_dim_name = "_".join(draw_prefix.split("_")[0:-1])
     # The data variable name
-    data_var_name = str(ds.data_vars.keys()[0])
-
-    df = pd.pivot_table(df,
-                        values=data_var_name,
-                        index=cols,
-                        columns=draw_dim_name)\
-           .reset_index()\
-           .rename(columns={i: draw_prefix + '{}'.format(i)
-                            for i in range(num_draws)})
+    data_var_name = str(list(ds.data_vars.keys())[0])
+    da = ds[data_var_name]
+    # Average over any other dimension, like pivoting does.
+    other_dims = [dim for dim in da.dims if dim not in cols + [draw_dim_name]]
+    if other_dims:
+        da = da.mean(dim=other_dims)
+
+    # Sort labels like pivot_table does.
+    da = da.isel(**{dim: np.argsort(da[dim].values, kind='mergesort')
+                    for dim in cols + [draw_dim_name]})
+    da = da.transpose(*(cols + [draw_dim_name]))
+
+    values = da.values.reshape(-1, da.shape[-1])
+    draw_cols = [draw_prefix + '{}'.format(i)
+                 for i in da[draw_dim_name].values]
+    df = pd.DataFrame(values, columns=draw_cols)
+    coords = np.meshgrid(*[da[col].values for col in cols], indexing='ij')
+    for i, (col, coord) in enumerate(zip(cols, coords)):
+        df.insert(i, col, coord.ravel())
+
+    # pivot_table drops rows without any value.
+    if values.dtype.kind == 'f':
+        missing = np.isnan(values).all(axis=1)
+        if missing.any():
+            df = df.loc[~missing].reset_index(drop=True)
     return df
@@ -0,0 +1,222 @@
+"""
+Benchmarks of the SEV calculation on synthetic draws.
+
+The shared object has to be compiled for this platform first:
+    gcc -shared -o lib.so -fPIC lib.c
+
+Example:
+    python benchmarks.py integration --draws 1000 10000
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+import scipy.integrate
+
+import sev
+from sev import (INPUT_PREFIXES, calculate_sev, calculate_sev_table,
+                 calculate_sev_vectorized, exposure_risk_integrand)
+
+# benchmarking.py is shared with the benchmarks of the other projects.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarking import best_time  # noqa: E402
+
+
+__modname__ = "fbd_research.sev.benchmarks"
+logger = logging.getLogger(__modname__)
+
+SHARED_OBJECT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'lib.so')
+
+
+def synthetic_exposure(num_draws, seed=0):
+    ''' Return draws of a systolic blood pressure-like exposure and risk.
+
+        Returns
+        ----------
+        kwargs: dict of the arguments of calculate_sev but the shared
+            object file.
+    '''
+    rng = np.random.RandomState(seed)
+    return {'exp_mean': rng.uniform(120, 150, num_draws),
+            'exp_sd': rng.uniform(10, 25, num_draws),
+            'rr_mean': rng.uniform(1.01, 1.04, num_draws),
+            'rr_max': rng.uniform(1.5, 3, num_draws),
+            'tmrel': 115., 'integ_min': 50., 'integ_max': 300., 'flag': 0}
+
+
+def reference_integral(i, exp_mean, exp_sd, rr_mean, rr_max, tmrel,
+                       integ_min, integ_max, flag):
+    ''' Return the integral of draw i by quad, split at the kinks of the
+        integrand and to a much tighter tolerance than calculate_sev.
+        The float rounding of the integrand keeps quad from reaching that
+        tolerance, hence the ignored warnings.
+    '''
+    width = np.log(rr_max[i]) / np.log(rr_mean[i])
+    points = [point for point in (tmrel, tmrel - width, tmrel + width)
+              if integ_min < point < integ_max]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', scipy.integrate.IntegrationWarning)
+        return scipy.integrate.quad(
+            lambda x: float(exposure_risk_integrand(
+                x, exp_mean[i], exp_sd[i], tmrel, rr_mean[i], rr_max[i],
+                flag)),
+            integ_min, integ_max, points=points, epsabs=1e-10,
+            epsrel=1e-10, limit=200)[0]
+
+
+def benchmark_integration(num_draws=1000, shared_object_file=None,
+                          tol=1.49e-06, num_checked=20):
+    ''' Compare quad on the ctypes integrand per draw and the vectorized
+        Gauss-Legendre integration of all draws.
+
+        Both are checked against reference_integral on num_checked draws.
+        quad, unaware of the kinks of the integrand, can miss its own
+        tolerance by an order of magnitude; the vectorized integration
+        has to be within tol.
+    '''
+    shared_object_file = shared_object_file or SHARED_OBJECT_FILE
+    kwargs = synthetic_exposure(num_draws)
+    denominator = kwargs['rr_max'] - 1
+
+    sev_quad, _ = calculate_sev(shared_object_file=shared_object_file,
+                                **kwargs)
+    sev_vectorized, _ = calculate_sev_vectorized(tol=tol, **kwargs)
+    reference = np.array([reference_integral(i, **kwargs)
+                          for i in range(min(num_checked, num_draws))])
+    checked = slice(len(reference))
+    quad_error = sev_quad[checked] * denominator[checked] + 1 - reference
+    vectorized_error = (sev_vectorized[checked] * denominator[checked] + 1 -
+                        reference)
+    logger.info("Max integral error at {} draws: quad {:.2e}, "
+                "vectorized {:.2e}".format(num_draws,
+                                           np.abs(quad_error).max(),
+                                           np.abs(vectorized_error).max()))
+    assert np.abs(vectorized_error).max() <= tol
+
+    return {'quad': best_time(calculate_sev,
+                              shared_object_file=shared_object_file,
+                              **kwargs),
+            'vectorized': best_time(calculate_sev_vectorized, tol=tol,
+                                    **kwargs)}
+
+
+def benchmark_quad_callables(num_draws=1000, shared_object_file=None):
+    ''' Compare quad on the ctypes wrapper and on the LowLevelCallable of
+        the integrand, and loading the shared object on every call.
+    '''
+    shared_object_file = shared_object_file or SHARED_OBJECT_FILE
+    kwargs = synthetic_exposure(num_draws)
+
+    def uncached():
+        for cache in (sev._LIBRARIES, sev._CTYPES_WRAPPERS,
+                      sev._LOW_LEVEL_CALLABLES):
+            cache.clear()
+        return calculate_sev(shared_object_file=shared_object_file, **kwargs)
+
+    expected = calculate_sev(shared_object_file=shared_object_file,
+                             low_level=False, **kwargs)
+    for result in (calculate_sev(shared_object_file=shared_object_file,
+                                 **kwargs), uncached()):
+        np.testing.assert_array_equal(result, expected)
+
+    return {'ctypes': best_time(calculate_sev,
+                                shared_object_file=shared_object_file,
+                                low_level=False, **kwargs),
+            'low_level': best_time(calculate_sev,
+                                   shared_object_file=shared_object_file,
+                                   **kwargs),
+            'uncached': best_time(uncached)}
+
+
+def synthetic_table(num_rows, num_draws, seed=0):
+    ''' Return a table of calculate_sev_table of num_rows locations with
+        the draws of synthetic_exposure.
+    '''
+    table = pd.DataFrame({'location_id': range(num_rows)})
+    draws = [synthetic_exposure(num_rows * num_draws, seed)[name]
+             for name in ('exp_mean', 'exp_sd', 'rr_mean', 'rr_max')]
+    for prefix, values in zip(INPUT_PREFIXES, draws):
+        cols = [prefix + '{}'.format(i) for i in range(num_draws)]
+        table = pd.concat([table, pd.DataFrame(
+            values.reshape(num_rows, num_draws), columns=cols)], axis=1)
+    return table
+
+
+def benchmark_table(num_draws=1000, shared_object_file=None, num_rows=100,
+                    workers=None, tol=1.49e-06, num_checked=20):
+    ''' Compare calculate_sev_table integrating rows with quad and chunks
+        with the vectorized integration, both across workers processes.
+
+        Both tables are checked against reference_integral on num_checked
+        draws like in benchmark_integration, the vectorized one has to be
+        within tol.
+    '''
+    shared_object_file = shared_object_file or SHARED_OBJECT_FILE
+    table = synthetic_table(num_rows, num_draws)
+    kwargs = synthetic_exposure(0)
+    for name in ('exp_mean', 'exp_sd', 'rr_mean', 'rr_max'):
+        del kwargs[name]
+
+    # The draws of table, row after row.
+    exposure = synthetic_exposure(num_rows * num_draws)
+    reference = np.array([reference_integral(i, **exposure)
+                          for i in range(min(num_checked,
+                                             num_rows * num_draws))])
+    denominator = exposure['rr_max'][:len(reference)] - 1
+
+    outdir = tempfile.mkdtemp()
+    try:
+        quad = os.path.join(outdir, 'quad')
+        vectorized = os.path.join(outdir, 'vectorized')
+        timings = {'quad': best_time(calculate_sev_table, table, quad,
+                                     shared_object_file=shared_object_file,
+                                     workers=workers, **kwargs),
+                   'vectorized': best_time(calculate_sev_table, table,
+                                           vectorized, tol=tol,
+                                           workers=workers, **kwargs)}
+
+        errors = {}
+        for name, path in (('quad', quad), ('vectorized', vectorized)):
+            sev_table = np.load(os.path.join(path, 'sev.npy')).ravel()
+            paf_table = np.load(os.path.join(path, 'paf.npy')).ravel()
+            integral = sev_table[:len(reference)] * denominator + 1
+            np.testing.assert_allclose(paf_table[:len(reference)],
+                                       1 - 1. / integral, rtol=1e-12)
+            errors[name] = np.abs(integral - reference).max()
+    finally:
+        shutil.rmtree(outdir)
+
+    logger.info("Max integral error of the table at {} draws: quad {:.2e}, "
+                "vectorized {:.2e}".format(num_draws, errors['quad'],
+                                           errors['vectorized']))
+    assert errors['vectorized'] <= tol
+    return timings
+
+
+BENCHMARKS = {'integration': benchmark_integration,
+              'quad_callables': benchmark_quad_callables,
+              'table': benchmark_table}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark SEV code")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument("--draws", type=int, nargs="+", default=[1000])
+    parser.add_argument("--shared-object-file", default=SHARED_OBJECT_FILE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    for num_draws in args.draws:
+        timings = BENCHMARKS[args.benchmark](
+            num_draws=num_draws, shared_object_file=args.shared_object_file)
+        for path, seconds in sorted(timings.items()):
+            logger.info("{} at {} draws: {} {:.3f}s".format(
+                args.benchmark, num_draws, path, seconds))
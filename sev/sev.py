@@ -4,12 +4,57 @@
 import pandas as pd
 import numpy as np
 import scipy.integrate
+from scipy import LowLevelCallable
 import ctypes
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
 import fbd  # team repository containing some utility functions
 
+__modname__ = "fbd_research.sev.sev"
+logger = logging.getLogger(__modname__)
+
+# Prefixes of the draw columns of the tables of calculate_sev_table.
+EXPOSURE_MEAN_PREFIX = 'exp_mean_'
+EXPOSURE_SD_PREFIX = 'exp_sd_'
+RR_MEAN_PREFIX = 'rr_mean_'
+RR_MAX_PREFIX = 'rr_max_'
+INPUT_PREFIXES = (EXPOSURE_MEAN_PREFIX, EXPOSURE_SD_PREFIX, RR_MEAN_PREFIX,
+                  RR_MAX_PREFIX)
+
+# Libraries and integrands already loaded, keyed by absolute path of the
+# shared object file. A file rebuilt in place needs a new process.
+_LIBRARIES = {}
+_CTYPES_WRAPPERS = {}
+_LOW_LEVEL_CALLABLES = {}
+
+
+def load_library(shared_object_file):
+    '''Load a shared object file once per process.
+
+       Parameters
+       ----------
+       shared_object_file: str
+            A .so file compiled from C file.
+
+       Returns
+       -------
+       lib: ctypes.CDLL of the file.
+    '''
+    path = os.path.abspath(shared_object_file)
+    if path not in _LIBRARIES:
+        _LIBRARIES[path] = ctypes.CDLL(path)
+    return _LIBRARIES[path]
+
 
 def get_ctypes_wrapper(shared_object_file):
-    '''Create a ctypes wrapper.
+    '''Create a ctypes wrapper, once per shared object file.
+
+       Its argtypes (int, double) are what quad expects of a ctypes function
+       double f(int n, double args[n]), quad passing x then args.
 
        Parameters
        ----------
@@ -20,15 +65,41 @@ def get_ctypes_wrapper(shared_object_file):
        -------
        func: a ctypes wrapper.
     '''
-    lib = ctypes.CDLL(shared_object_file)
-    func = lib.f
-    func.restype = ctypes.c_double
-    func.argtypes = (ctypes.c_int, ctypes.c_double)
-    return func
+    path = os.path.abspath(shared_object_file)
+    if path not in _CTYPES_WRAPPERS:
+        func = load_library(path).f
+        func.restype = ctypes.c_double
+        func.argtypes = (ctypes.c_int, ctypes.c_double)
+        _CTYPES_WRAPPERS[path] = func
+    return _CTYPES_WRAPPERS[path]
+
+
+def get_low_level_callable(shared_object_file):
+    '''Wrap f of a shared object file as a scipy.LowLevelCallable, once
+       per file, so that quad calls it directly without going through
+       ctypes.
+
+       Parameters
+       ----------
+       shared_object_file: str
+            A .so file compiled from C file.
+
+       Returns
+       -------
+       func: scipy.LowLevelCallable of signature double (int, double *).
+    '''
+    path = os.path.abspath(shared_object_file)
+    if path not in _LOW_LEVEL_CALLABLES:
+        prototype = ctypes.CFUNCTYPE(ctypes.c_double, ctypes.c_int,
+                                     ctypes.POINTER(ctypes.c_double))
+        _LOW_LEVEL_CALLABLES[path] = LowLevelCallable(
+            prototype(('f', load_library(path))))
+    return _LOW_LEVEL_CALLABLES[path]
 
 
 def calculate_sev(exp_mean, exp_sd, rr_mean, rr_max, tmrel,
-                    integ_min, integ_max, flag, shared_object_file):
+                    integ_min, integ_max, flag, shared_object_file,
+                    low_level=True):
     '''Calculate sev with ctypes.
 
        Parameters
@@ -52,6 +123,9 @@ def calculate_sev(exp_mean, exp_sd, rr_mean, rr_max, tmrel,
             0 indicates detrimental risk factors.
        shared_object_file: str
             A .so file compiled from C file.
+       low_level: bool
+            Integrate the scipy.LowLevelCallable of the file instead of
+            its ctypes wrapper. Both give the same results.
 
        Returns
        -------
@@ -63,7 +137,10 @@ def calculate_sev(exp_mean, exp_sd, rr_mean, rr_max, tmrel,
     assert len(exp_mean) == len(exp_sd) == len(rr_mean) == len(rr_max), \
            print("Length of array doesn't match")
 
-    func = get_ctypes_wrapper(shared_object_file)
+    if low_level:
+        func = get_low_level_callable(shared_object_file)
+    else:
+        func = get_ctypes_wrapper(shared_object_file)
 
     def integ(i):
         '''Integration of the proudct of relative risk and exposure.
@@ -97,6 +174,365 @@ def calculate_sev(exp_mean, exp_sd, rr_mean, rr_max, tmrel,
     return sev, paf
 
 
+def _as_float(values):
+    '''Round to the float precision of lib.c, as float64.'''
+    return np.asarray(values, dtype=np.float32).astype(np.float64)
+
+
+def exposure_risk_integrand(x, exp_mean, exp_sd, tmrel, rr_mean, rr_max,
+                            flag):
+    '''Vectorized f of lib.c: the lognormal exposure density at x, times
+       the relative risk at x capped at rr_max.
+
+       Intermediates are rounded to float like in lib.c, which also uses
+       3.14 for pi, so that results match the ctypes integrand.
+
+       Parameters
+       ----------
+       x: array of exposure levels.
+       exp_mean, exp_sd, rr_mean, rr_max: arrays broadcasting against x.
+       tmrel: int or float.
+       flag: int(0 or 1), see calculate_sev.
+
+       Returns
+       -------
+       y: array of the integrand at x.
+    '''
+    x = _as_float(x)
+    exp_mean = _as_float(exp_mean)
+    exp_sd = _as_float(exp_sd)
+    rr_mean = _as_float(rr_mean)
+    rr_max = _as_float(rr_max)
+    tmrel = _as_float(tmrel)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        ratio = exp_sd ** 2 / exp_mean ** 2
+        mu = _as_float(np.log(exp_mean / np.sqrt(1 + ratio)))
+        sigma = _as_float(np.sqrt(np.log(1 + ratio)))
+        px = _as_float(1 / (_as_float(x * sigma) * np.sqrt(2 * 3.14)) *
+                       np.exp(-(np.log(x) - mu) ** 2 / (2 * sigma ** 2)))
+
+        if flag == 1:
+            exposed = x < tmrel
+            rr = rr_mean ** _as_float(tmrel - x)
+        else:
+            exposed = x > tmrel
+            rr = rr_mean ** _as_float(x - tmrel)
+        y = _as_float(np.where(rr < rr_max, rr, rr_max) * px)
+    return np.where(exposed, y, px)
+
+
+def _breakpoints(exp_mean, exp_sd, rr_mean, rr_max, tmrel,
+                 integ_min, integ_max):
+    '''Return the sorted (draws, 6) array of the bounds of integration
+       and, in between, the kinks and the peak of the integrand of each
+       draw: tmrel, where the relative risk reaches rr_max on either side
+       of tmrel and the median of exposure.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rr_width = np.where(rr_mean > 1, np.log(rr_max) / np.log(rr_mean),
+                            0)
+        rr_width = np.nan_to_num(rr_width)
+        median = exp_mean / np.sqrt(1 + exp_sd ** 2 / exp_mean ** 2)
+    points = np.column_stack([np.full(len(exp_mean), integ_min, dtype=float),
+                              np.full(len(exp_mean), tmrel, dtype=float),
+                              tmrel - rr_width, tmrel + rr_width,
+                              np.nan_to_num(median),
+                              np.full(len(exp_mean), integ_max,
+                                      dtype=float)])
+    return np.sort(np.clip(points, integ_min, integ_max), axis=1)
+
+
+def _gauss_legendre(edges, panels, nodes, weights, integrand):
+    '''Integrate integrand of each draw with the composite Gauss-Legendre
+       rule of panels panels between each pair of consecutive edges.
+
+       Parameters
+       ----------
+       edges: (draws, k) array of the bounds of the k - 1 segments.
+       panels: int, number of panels per segment.
+       nodes, weights: Gauss-Legendre nodes and weights on [-1, 1].
+       integrand: function of the (draws, points) array of x.
+
+       Returns
+       -------
+       integral: 1-D array, the integral of each draw.
+    '''
+    lower = edges[:, :-1, None, None]
+    width = np.diff(edges, axis=1) / panels
+    offsets = np.arange(panels)[:, None] + (nodes + 1) / 2
+    x = lower + width[:, :, None, None] * offsets
+    y = integrand(x.reshape(len(edges), -1)).reshape(x.shape)
+    segments = y.dot(weights).sum(axis=2) * width / 2
+    # Empty segments, e.g. at x = 0, contribute nothing even if y is nan.
+    return np.where(width > 0, segments, 0).sum(axis=1)
+
+
+def integrate_exposure_risk(exp_mean, exp_sd, rr_mean, rr_max, tmrel,
+                            integ_min, integ_max, flag, tol=1.49e-06,
+                            order=8, min_panels=4, max_panels=256,
+                            max_points=2 ** 20):
+    '''Integrate exposure_risk_integrand for all draws at once.
+
+       The interval is split at the breakpoints of each draw, and the
+       number of Gauss-Legendre panels between them doubled from
+       min_panels until the integral of each draw changes by at most tol.
+       Starting from a few panels keeps coarse estimates from agreeing by
+       chance. Draws that still
+       haven't converged at max_panels are integrated by quad.
+
+       Parameters
+       ----------
+       exp_mean, exp_sd, rr_mean, rr_max, tmrel, integ_min, integ_max,
+       flag: see calculate_sev.
+       tol: float, absolute tolerance of the integrals.
+       order: int, number of Gauss-Legendre nodes per panel.
+       min_panels: int, initial number of panels per segment.
+       max_panels: int, maximum number of panels per segment.
+       max_points: int, maximum number of points evaluated at once.
+
+       Returns
+       -------
+       integral: 1-D array, the integral of each draw.
+    '''
+    exp_mean, exp_sd, rr_mean, rr_max = [
+        np.asarray(values, dtype=float)
+        for values in (exp_mean, exp_sd, rr_mean, rr_max)]
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    edges = _breakpoints(exp_mean, exp_sd, rr_mean, rr_max, tmrel,
+                         integ_min, integ_max)
+
+    def integrate_block(draws, panels):
+        def integrand(x):
+            return exposure_risk_integrand(
+                x, exp_mean[draws, None], exp_sd[draws, None], tmrel,
+                rr_mean[draws, None], rr_max[draws, None], flag)
+        return _gauss_legendre(edges[draws], panels, nodes, weights,
+                               integrand)
+
+    def integrate(draws, panels):
+        # Integrate blocks of draws to bound the memory of the grid.
+        block_size = max(1, max_points // (edges.shape[1] * panels * order))
+        return np.concatenate([
+            integrate_block(draws[start:start + block_size], panels)
+            for start in range(0, len(draws), block_size)])
+
+    active = np.arange(len(exp_mean))
+    panels = min_panels
+    integral = integrate(active, panels)
+    while len(active) and panels < max_panels:
+        panels *= 2
+        refined = integrate(active, panels)
+        converged = np.abs(refined - integral[active]) <= tol
+        integral[active] = refined
+        active = active[~converged]
+
+    for i in active:
+        integral[i] = scipy.integrate.quad(
+            lambda x: exposure_risk_integrand(
+                x, exp_mean[i], exp_sd[i], tmrel, rr_mean[i], rr_max[i],
+                flag),
+            integ_min, integ_max, epsabs=tol, epsrel=tol)[0]
+    return integral
+
+
+def calculate_sev_vectorized(exp_mean, exp_sd, rr_mean, rr_max, tmrel,
+                             integ_min, integ_max, flag, tol=1.49e-06):
+    '''Calculate sev like calculate_sev, integrating all draws at once in
+       NumPy instead of calling quad on the ctypes integrand per draw.
+
+       Parameters
+       ----------
+       exp_mean, exp_sd, rr_mean, rr_max, tmrel, integ_min, integ_max,
+       flag: see calculate_sev.
+       tol: float,
+            Absolute tolerance of the integrals, the epsabs of quad.
+
+       Returns
+       -------
+       sev: 1-D array
+        summary exposure value.
+       paf: 1-D array
+        population attributable fraction.
+    '''
+    assert len(exp_mean) == len(exp_sd) == len(rr_mean) == len(rr_max), \
+           "Length of array doesn't match"
+
+    integral = integrate_exposure_risk(exp_mean, exp_sd, rr_mean, rr_max,
+                                       tmrel, integ_min, integ_max, flag,
+                                       tol=tol)
+    denominator = np.asarray(rr_max, dtype=float) - 1
+    sev = (integral - 1) / denominator
+    paf = 1 - 1. / (sev * denominator + 1)
+    return sev, paf
+
+
+# Memory maps and parameters of the table being calculated by
+# calculate_sev_table, opened once per worker by _init_table_worker.
+_TABLE = {}
+
+
+def _init_table_worker(inputs_path, sev_path, paf_path, params):
+    _TABLE['inputs'] = np.load(inputs_path, mmap_mode='r')
+    _TABLE['sev'] = np.load(sev_path, mmap_mode='r+')
+    _TABLE['paf'] = np.load(paf_path, mmap_mode='r+')
+    _TABLE['params'] = params
+
+
+def _calculate_table_chunk(bounds):
+    '''Calculate SEV and PAF of rows start to stop of the table and write
+       them to the output memory maps.
+
+       Parameters
+       ----------
+       bounds: tuple of int, (start, stop).
+
+       Returns
+       -------
+       rows: int, number of rows calculated.
+    '''
+    start, stop = bounds
+    params = dict(_TABLE['params'])
+    shared_object_file = params.pop('shared_object_file')
+    tol = params.pop('tol')
+    exp_mean, exp_sd, rr_mean, rr_max = _TABLE['inputs'][:, start:stop]
+
+    if shared_object_file is None:
+        sev, paf = calculate_sev_vectorized(
+            exp_mean.ravel(), exp_sd.ravel(), rr_mean.ravel(),
+            rr_max.ravel(), tol=tol, **params)
+        sev = sev.reshape(exp_mean.shape)
+        paf = paf.reshape(exp_mean.shape)
+    else:
+        rows = [calculate_sev(exp_mean[i], exp_sd[i], rr_mean[i], rr_max[i],
+                              shared_object_file=shared_object_file,
+                              **params)
+                for i in range(len(exp_mean))]
+        sev = np.array([row_sev for row_sev, _ in rows])
+        paf = np.array([row_paf for _, row_paf in rows])
+
+    _TABLE['sev'][start:stop] = sev
+    _TABLE['paf'][start:stop] = paf
+    _TABLE['sev'].flush()
+    _TABLE['paf'].flush()
+    return stop - start
+
+
+def _draw_columns(columns, prefix):
+    '''Return the columns named prefix followed by a draw number, sorted
+       by draw, and their draws.
+    '''
+    draws = sorted((int(col[len(prefix):]), col) for col in columns
+                   if col.startswith(prefix))
+    return [col for _, col in draws], [draw for draw, _ in draws]
+
+
+def calculate_sev_table(table, outdir, tmrel, integ_min, integ_max, flag,
+                        shared_object_file=None, tol=1.49e-06,
+                        chunk_size=100, workers=None):
+    '''Calculate SEV and PAF draws of every row of a table of exposure and
+       relative risk draws, by chunks of rows across a pool of processes.
+
+       The draws are copied once to a memory-mapped .npy file that workers
+       share instead of receiving pickled chunks. Each worker writes the
+       SEV and PAF of its chunks straight into sev.npy and paf.npy of
+       outdir, in the order of the rows of table, so finished chunks are on
+       disk while the others are still running. Throughput is logged as
+       chunks finish.
+
+       Parameters
+       ----------
+       table: dataframe
+            One row per location/age/sex/year, with draw columns of each of
+            INPUT_PREFIXES, e.g. exp_mean_0 to exp_mean_999, in any order.
+            Every prefix needs the same draws. Other columns are the index
+            of the rows, saved to index.csv of outdir.
+       outdir: str
+            Directory of the outputs.
+       tmrel, integ_min, integ_max, flag: see calculate_sev.
+       shared_object_file: str
+            If given, integrate each row with calculate_sev and this file,
+            else all draws of a chunk at once with
+            calculate_sev_vectorized.
+       tol: float
+            Absolute tolerance of calculate_sev_vectorized.
+       chunk_size: int
+            Number of rows per chunk.
+       workers: int
+            Number of processes, all CPUs if None, in this process if 1.
+
+       Returns
+       -------
+       sev: 2-D array of rows by draws, in order of draw number,
+            read-only memory map of sev.npy.
+       paf: 2-D array of rows by draws, in order of draw number,
+            read-only memory map of paf.npy.
+    '''
+    draw_cols, draws = zip(*[_draw_columns(table.columns, prefix)
+                             for prefix in INPUT_PREFIXES])
+    assert all(prefix_draws == draws[0] for prefix_draws in draws), \
+           "Draws of {} don't match".format(', '.join(INPUT_PREFIXES))
+    index_cols = [col for col in table.columns
+                  if not col.startswith(INPUT_PREFIXES)]
+    num_rows, num_draws = len(table), len(draw_cols[0])
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    table[index_cols].to_csv(os.path.join(outdir, 'index.csv'), index=False)
+    sev_path = os.path.join(outdir, 'sev.npy')
+    paf_path = os.path.join(outdir, 'paf.npy')
+    for path in (sev_path, paf_path):
+        np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                  shape=(num_rows, num_draws))
+
+    tmpdir = tempfile.mkdtemp(dir=outdir)
+    try:
+        inputs_path = os.path.join(tmpdir, 'inputs.npy')
+        inputs = np.lib.format.open_memmap(inputs_path, mode='w+',
+                                           dtype=np.float64,
+                                           shape=(4, num_rows, num_draws))
+        for i, cols in enumerate(draw_cols):
+            inputs[i] = table[cols].values
+        inputs.flush()
+        del inputs
+
+        params = {'tmrel': tmrel, 'integ_min': integ_min,
+                  'integ_max': integ_max, 'flag': flag,
+                  'shared_object_file': shared_object_file, 'tol': tol}
+        initargs = (inputs_path, sev_path, paf_path, params)
+        chunks = [(start, min(start + chunk_size, num_rows))
+                  for start in range(0, num_rows, chunk_size)]
+
+        start = time.time()
+        done = 0
+        if workers != 1 and len(chunks) > 1:
+            pool = multiprocessing.Pool(workers,
+                                        initializer=_init_table_worker,
+                                        initargs=initargs)
+            results = pool.imap_unordered(_calculate_table_chunk, chunks)
+        else:
+            pool = None
+            _init_table_worker(*initargs)
+            results = (_calculate_table_chunk(chunk) for chunk in chunks)
+        try:
+            for rows in results:
+                done += rows
+                logger.info("{}/{} rows, {:.1f} rows/s".format(
+                    done, num_rows, done / (time.time() - start)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _TABLE.clear()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    logger.info("{} rows of {} draws in {:.1f}s".format(
+        num_rows, num_draws, time.time() - start))
+    return (np.load(sev_path, mmap_mode='r'),
+            np.load(paf_path, mmap_mode='r'))
+
+
 def pull_acause_risk(db_name, server):
     '''Query acause, risk pairs from database.
        Return a dataframe with two columns, acause and risk.